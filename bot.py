@@ -1,17 +1,33 @@
 import os
 import re
+import sys
+import csv
 import json
 import time
+import math
 import base64
+import hashlib
+import hmac
+import sqlite3
+import heapq
+import random
 import asyncio
+import argparse
+import bisect
+import threading
+import concurrent.futures
 from io import BytesIO
+from datetime import datetime, timezone
+from collections import OrderedDict, deque
 
-import requests
-from PIL import Image
+import httpx
+import numpy as np
+from PIL import Image, ImageChops, ImageDraw, ImageFilter, ImageStat
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.constants import ChatAction
+from telegram.error import BadRequest, ChatMigrated, Forbidden, RetryAfter
 from telegram.ext import (
-    Application, CommandHandler, MessageHandler, CallbackQueryHandler,
+    Application, BaseUpdateProcessor, CommandHandler, MessageHandler, CallbackQueryHandler,
     ContextTypes, filters
 )
 
@@ -21,6 +37,49 @@ from telegram.ext import (
 BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN", "").strip()
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "").strip()
 MODEL_VISION = os.getenv("MODEL_VISION", "gpt-4.1-mini").strip()
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL", "https://api.openai.com/v1").strip().rstrip("/")
+
+# --- Webhook mode (`uvicorn bot:app`): Telegram POSTs updates to WEBHOOK_URL + WEBHOOK_PATH.
+# WEBHOOK_URL defaults to Render's RENDER_EXTERNAL_URL; the secret defaults to a hash of the
+# bot token so every worker agrees on it without extra configuration.
+# Only the user store, sessions and outbox are shared between workers. Chat ordering, the
+# analysis cap, the analysis cache and the circuit breaker are per process: with
+# `--workers N` chats lose ordering and the limits below apply N times over.
+WEBHOOK_URL = (os.getenv("WEBHOOK_URL", "") or os.getenv("RENDER_EXTERNAL_URL", "")).strip().rstrip("/")
+WEBHOOK_PATH = "/" + os.getenv("WEBHOOK_PATH", "telegram/webhook").strip().strip("/")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "").strip() or hashlib.sha256(f"webhook:{BOT_TOKEN}".encode()).hexdigest()
+WEBHOOK_MAX_BODY = int(os.getenv("WEBHOOK_MAX_BODY", str(1024 * 1024)))
+
+# --- Shared async HTTP pool for the vision call
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "60"))
+OPENAI_CONNECT_TIMEOUT = float(os.getenv("OPENAI_CONNECT_TIMEOUT", "10"))
+OPENAI_MAX_CONNECTIONS = int(os.getenv("OPENAI_MAX_CONNECTIONS", "200"))
+OPENAI_MAX_KEEPALIVE = int(os.getenv("OPENAI_MAX_KEEPALIVE", "50"))
+OPENAI_KEEPALIVE_EXPIRY = float(os.getenv("OPENAI_KEEPALIVE_EXPIRY", "60"))
+OPENAI_HTTP2 = os.getenv("OPENAI_HTTP2", "1").strip() == "1"
+
+# --- Vision backend: "openai" (Responses API at OPENAI_BASE_URL) or "mock" (in-process)
+VISION_BACKEND = os.getenv("VISION_BACKEND", "openai").strip().lower()
+MOCK_LATENCY = os.getenv("MOCK_LATENCY", "lognormal:0.0,0.4").strip()  # see _latency_sampler
+MOCK_ERROR_RATE = float(os.getenv("MOCK_ERROR_RATE", "0"))
+MOCK_MALFORMED_RATE = float(os.getenv("MOCK_MALFORMED_RATE", "0"))
+MOCK_SEED = int(os.getenv("MOCK_SEED", "1"))
+
+# --- Structured output budget: the compact schema needs ~40 tokens
+OPENAI_MAX_OUTPUT_TOKENS = int(os.getenv("OPENAI_MAX_OUTPUT_TOKENS", "120"))
+
+# --- Vision call resilience: retries with jittered backoff, optional hedging, circuit breaker
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "3"))
+OPENAI_BACKOFF_BASE = float(os.getenv("OPENAI_BACKOFF_BASE", "0.5"))
+OPENAI_BACKOFF_MAX = float(os.getenv("OPENAI_BACKOFF_MAX", "8"))
+OPENAI_HEDGE_PERCENTILE = float(os.getenv("OPENAI_HEDGE_PERCENTILE", "0"))  # e.g. 95; 0 = no hedging
+OPENAI_HEDGE_MIN_SAMPLES = int(os.getenv("OPENAI_HEDGE_MIN_SAMPLES", "50"))
+CIRCUIT_FAILURES = int(os.getenv("CIRCUIT_FAILURES", "5"))  # consecutive failures to open (per process)
+CIRCUIT_COOLDOWN = float(os.getenv("CIRCUIT_COOLDOWN", "30"))  # seconds before a probe
+
+# --- Streamed replies: placeholder message edited as the model output arrives
+STREAM_REPLIES = os.getenv("STREAM_REPLIES", "1").strip() == "1"
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.5"))  # seconds between edits
 
 FREE_TRIAL_LIMIT = int(os.getenv("FREE_TRIAL_LIMIT", "5"))
 
@@ -38,6 +97,46 @@ TP3_WEAK_POINTS = int(os.getenv("TP3_WEAK_POINTS", "600"))
 TP2_STRONG_POINTS = int(os.getenv("TP2_STRONG_POINTS", "500"))
 TP3_STRONG_POINTS = int(os.getenv("TP3_STRONG_POINTS", "700"))
 
+# --- Per-symbol point size / digits / TP-SL profiles; the JSON file adds or overrides symbols.
+# Unknown symbols use POINT_VALUE and the decimals of the entry zone.
+INSTRUMENTS_FILE = os.getenv("INSTRUMENTS_FILE", "").strip()
+
+# --- Image preprocessing pool: "process" (default) or "thread"
+PREPROCESS_POOL = os.getenv("PREPROCESS_POOL", "process").strip().lower()
+PREPROCESS_WORKERS = int(os.getenv("PREPROCESS_WORKERS", str(min(4, os.cpu_count() or 1))))
+
+# --- Vision input budget: crop to the plot area + price axis, then size to the token grid of
+# MODEL_VISION (32 px patches or 512 px tiles, see IMAGE_TOKEN_MODELS)
+IMAGE_AUTOCROP = os.getenv("IMAGE_AUTOCROP", "1").strip() == "1"
+IMAGE_LEGIBLE_SIDE = int(os.getenv("IMAGE_LEGIBLE_SIDE", "1024"))  # keep candles readable
+
+# --- Telegram downloads: smallest PhotoSize that still feeds the encoder at full size
+PHOTO_MIN_SIDE = int(os.getenv("PHOTO_MIN_SIDE", "1100"))
+IMAGE_MAX_FILE_MB = float(os.getenv("IMAGE_MAX_FILE_MB", "20"))  # Bot API getFile limit
+
+# --- Local chart gate: images scoring below this never reach the model (0 = gate off).
+# Off by default: fixtures/gate has no real chart screenshots yet, and real MT4 bar/candle and
+# line charts score around 0.45. Check `eval-gate` on real charts before turning it on.
+CHART_GATE_THRESHOLD = float(os.getenv("CHART_GATE_THRESHOLD", "0"))
+
+# --- Analysis result cache: keyed by Telegram file_unique_id, then perceptual hash.
+# In-memory per process; only the optional on-disk tier is seen by other workers.
+ANALYSIS_CACHE_SIZE = int(os.getenv("ANALYSIS_CACHE_SIZE", "5000"))
+ANALYSIS_CACHE_TTL = int(os.getenv("ANALYSIS_CACHE_TTL", "21600"))  # seconds
+ANALYSIS_CACHE_DIR = os.getenv("ANALYSIS_CACHE_DIR", "").strip()  # optional on-disk tier
+ANALYSIS_CACHE_PHASH_DISTANCE = int(os.getenv("ANALYSIS_CACHE_PHASH_DISTANCE", "6"))  # max differing bits (of 256)
+# near (not identical) hashes only match entries this young: a screenshot of the same chart a few
+# candles later is 2-6 bits away and must not get the older entry/TP/SL
+ANALYSIS_CACHE_NEAR_TTL = int(os.getenv("ANALYSIS_CACHE_NEAR_TTL", "300"))  # seconds
+
+# --- Analysis admission control (PAID users are served first). The concurrency cap and queue are
+# per process (divide by the worker count); the per-user limit is shared through the session store.
+ANALYSIS_MAX_CONCURRENCY = int(os.getenv("ANALYSIS_MAX_CONCURRENCY", "32"))  # model calls in flight
+ANALYSIS_MAX_PER_USER = int(os.getenv("ANALYSIS_MAX_PER_USER", "2"))
+ANALYSIS_QUEUE_MAX = int(os.getenv("ANALYSIS_QUEUE_MAX", "500"))
+ANALYSIS_QUEUE_TIMEOUT_PAID = float(os.getenv("ANALYSIS_QUEUE_TIMEOUT_PAID", "180"))
+ANALYSIS_QUEUE_TIMEOUT_FREE = float(os.getenv("ANALYSIS_QUEUE_TIMEOUT_FREE", "90"))
+
 # Admin IDs: "7269750900,123"
 ADMIN_IDS = set()
 _admin_raw = os.getenv("ADMIN_IDS", "").strip()
@@ -47,8 +146,50 @@ if _admin_raw:
         if x.isdigit():
             ADMIN_IDS.add(int(x))
 
+# --- User store backend: "sqlite" (default) or "json" (legacy db.json)
+DB_BACKEND = os.getenv("DB_BACKEND", "sqlite").strip().lower()
 DB_FILE = "db.json"
-DB_LOCK = asyncio.Lock()
+DB_SQLITE_FILE = os.getenv("DB_SQLITE_FILE", "db.sqlite3").strip()
+# json backend write-behind: append the journal every N seconds, or sooner once this many
+# mutations are pending; fold the journal into a new db.json snapshot every N entries
+DB_FLUSH_INTERVAL = float(os.getenv("DB_FLUSH_INTERVAL", "2.0"))
+DB_FLUSH_MAX_DIRTY = int(os.getenv("DB_FLUSH_MAX_DIRTY", "500"))
+DB_COMPACT_EVERY = int(os.getenv("DB_COMPACT_EVERY", "50000"))
+
+# --- Session state (pending activation, awaiting photo, per-user in-flight analyses):
+# "sqlite" (default; shared by all processes on this host), "memory" (single process), or
+# "redis" (shared across hosts; needs the redis package and SESSION_REDIS_URL)
+SESSION_BACKEND = os.getenv("SESSION_BACKEND", "sqlite").strip().lower()
+SESSION_SQLITE_FILE = os.getenv("SESSION_SQLITE_FILE", "sessions.sqlite3").strip()
+SESSION_REDIS_URL = os.getenv("SESSION_REDIS_URL", "redis://localhost:6379/0").strip()
+SESSION_TTL_PENDING_EMAIL = int(os.getenv("SESSION_TTL_PENDING_EMAIL", "1800"))  # seconds
+SESSION_TTL_AWAITING_PHOTO = int(os.getenv("SESSION_TTL_AWAITING_PHOTO", "3600"))
+SESSION_TTL_INFLIGHT = int(os.getenv("SESSION_TTL_INFLIGHT", "600"))  # outlives any analysis; frees markers of crashed workers
+
+# --- Update dispatch: updates of different chats run concurrently, each chat's in order
+# (UPDATE_WORKERS=1 restores PTB's sequential processing). Ordering holds within one process
+# only: webhook workers each get a share of every chat's updates.
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", "256"))  # handlers running at once
+UPDATE_HEAVY_WORKERS = int(os.getenv("UPDATE_HEAVY_WORKERS", "192"))  # of which photo/document updates
+UPDATE_PENDING_MAX = int(os.getenv("UPDATE_PENDING_MAX", "8192"))  # accepted, not yet finished
+
+# --- Outbound sender (admin notifications, /broadcast): Bot API flood limits per bot token
+SEND_QUEUE_FILE = os.getenv("SEND_QUEUE_FILE", "outbox.sqlite3").strip()
+SEND_GLOBAL_RATE = float(os.getenv("SEND_GLOBAL_RATE", "25"))  # msg/s (hard limit ~30)
+SEND_CHAT_RATE = float(os.getenv("SEND_CHAT_RATE", "1"))  # msg/s to one private chat
+SEND_GROUP_PER_MIN = float(os.getenv("SEND_GROUP_PER_MIN", "20"))  # msg/min to one group
+SEND_CONCURRENCY = int(os.getenv("SEND_CONCURRENCY", "8"))  # requests in flight
+SEND_MAX_ATTEMPTS = int(os.getenv("SEND_MAX_ATTEMPTS", "5"))  # network errors only
+SEND_LEASE_TTL = float(os.getenv("SEND_LEASE_TTL", "30"))
+BROADCAST_REPORT_INTERVAL = float(os.getenv("BROADCAST_REPORT_INTERVAL", "15"))
+
+# --- Prometheus /metrics: served by the ASGI app in webhook mode; in polling mode by a small
+# HTTP listener on METRICS_PORT (0 = off)
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1").strip()
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9464"))
+
+# --- Signal history: columnar, one directory per UTC day ("" = off)
+HISTORY_DIR = os.getenv("HISTORY_DIR", "history").strip()
 
 # ✅ Plans: ONLY FREE + PAID (Lifetime)
 PLANS = ["FREE", "PAID"]  # PAID = Lifetime
@@ -109,6 +250,13 @@ T = {
         "setplan_usage": "Usage:\n/setplan <user_id> FREE\n/setplan <user_id> PAID",
         "setplan_ok": "✅ Set {uid} plan={plan}",
         "analysis_failed": "❌ Analysis failed.\nTry a clearer screenshot (zoom candles) and make sure price/symbol/TF are visible.",
+        "image_too_large": "📎 This file is too large. Please send a chart screenshot under {mb:g} MB.",
+        "not_a_chart": "🖼️ This doesn\u2019t look like a trading chart.\nPlease send a screenshot of a candlestick chart (no trial credit was used).",
+        "queue_position": "⏳ High demand — you are #{pos} in the queue. Your analysis will start shortly.",
+        "busy_user": "⏳ Your previous chart is still being analyzed. Please wait for it to finish.",
+        "busy_full": "⏳ The bot is very busy right now. Please try again in a minute.",
+        "busy_timeout": "⌛ The queue is taking too long. Please try again in a minute.",
+        "analyzing": "⏳ Analyzing your chart...",
         "header": "━━━━━━━━━━━━━━━━\n🤖 Trading AI — Signal\n━━━━━━━━━━━━━━━━",
         "market_state": "Market State",
         "market": "Market",
@@ -173,6 +321,13 @@ T = {
         "setplan_usage": "الاستخدام:\n/setplan <user_id> FREE\n/setplan <user_id> PAID",
         "setplan_ok": "✅ تم ضبط {uid} على خطة {plan}",
         "analysis_failed": "❌ فشل التحليل.\nجرّب صورة أوضح (قرّب الشموع) وتأكد أن السعر/الزوج/الفريم ظاهرين.",
+        "image_too_large": "📎 الملف كبير جدًا. أرسل لقطة شاشة للشارت أقل من {mb:g} ميغابايت.",
+        "not_a_chart": "🖼️ هذه الصورة لا تبدو شارت تداول.\nأرسل لقطة شاشة لشارت الشموع (لم يتم خصم أي محاولة).",
+        "queue_position": "⏳ ضغط مرتفع — ترتيبك #{pos} في قائمة الانتظار. سيبدأ التحليل قريبًا.",
+        "busy_user": "⏳ ما زال تحليل صورتك السابقة قيد التنفيذ. انتظر حتى ينتهي.",
+        "busy_full": "⏳ البوت مشغول جدًا حاليًا. حاول مرة أخرى بعد دقيقة.",
+        "busy_timeout": "⌛ الانتظار طال أكثر من اللازم. حاول مرة أخرى بعد دقيقة.",
+        "analyzing": "⏳ جاري تحليل الشارت...",
         "header": "━━━━━━━━━━━━━━━━\n🤖 Trading AI — Signal\n━━━━━━━━━━━━━━━━",
         "market_state": "حالة السوق",
         "market": "السوق",
@@ -237,6 +392,13 @@ T = {
         "setplan_usage": "Usage:\n/setplan <user_id> FREE\n/setplan <user_id> PAID",
         "setplan_ok": "✅ Plan défini: {uid} = {plan}",
         "analysis_failed": "❌ Analyse échouée.\nEssayez une image plus claire et assurez-vous que prix/symbole/TF sont visibles.",
+        "image_too_large": "📎 Fichier trop volumineux. Envoyez une capture du graphique de moins de {mb:g} Mo.",
+        "not_a_chart": "🖼️ Cette image ne ressemble pas à un graphique de trading.\nEnvoyez une capture d\u2019un graphique en chandeliers (aucun essai n\u2019a été décompté).",
+        "queue_position": "⏳ Forte demande — vous êtes n°{pos} dans la file. Votre analyse va bientôt commencer.",
+        "busy_user": "⏳ Votre graphique précédent est encore en cours d’analyse. Patientez jusqu’à la fin.",
+        "busy_full": "⏳ Le bot est très sollicité. Réessayez dans une minute.",
+        "busy_timeout": "⌛ L’attente est trop longue. Réessayez dans une minute.",
+        "analyzing": "⏳ Analyse du graphique en cours...",
         "header": "━━━━━━━━━━━━━━━━\n🤖 Trading AI — Signal\n━━━━━━━━━━━━━━━━",
         "market_state": "État du marché",
         "market": "Marché",
@@ -278,36 +440,387 @@ def _default_user():
         "lang": DEFAULT_LANG,
     }
 
-async def load_db():
-    async with DB_LOCK:
-        if not os.path.exists(DB_FILE):
+_USER_FIELDS = ("plan", "expires_at", "trial_used", "created_at", "lang")
+
+def _atomic_write_json(path, obj):
+    # temp file + fsync + rename: readers never see a truncated file
+    tmp = f"{path}.tmp.{os.getpid()}"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(obj, f, ensure_ascii=False, separators=(",", ":"))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+def _apply_journal_entry(users, e):
+    uid = e["u"]
+    op = e["op"]
+    if op == "new":
+        users.setdefault(uid, dict(e["v"]))
+    elif op == "set":
+        users.setdefault(uid, _default_user()).update(e["f"])
+    elif op == "incr":
+        u = users.setdefault(uid, _default_user())
+        u[e["k"]] = int(u.get(e["k"], 0) or 0) + int(e["n"])
+
+def _replay_journal(path, users, after_seq):
+    # Apply entries newer than the snapshot; a torn last line (crash mid-append) is skipped.
+    seq, n = after_seq, 0
+    if not os.path.exists(path):
+        return seq, n
+    loads = json.loads
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                e = loads(line)
+            except ValueError:
+                continue
+            if e["q"] <= seq:
+                continue
+            _apply_journal_entry(users, e)
+            seq = e["q"]
+            n += 1
+    return seq, n
+
+class JsonUserStore:
+    # db.json snapshot + append-only journal of per-user mutations (db.json.journal).
+    # Handlers only touch memory; db_flush_loop() appends pending entries in batches and
+    # compacts the journal into a fresh snapshot once it grows past DB_COMPACT_EVERY entries.
+    def __init__(self, path):
+        self.path = path
+        self.journal_path = path + ".journal"
+        self._lock = threading.Lock()
+        self._io_lock = threading.Lock()
+        self._owner = self._take_ownership()
+        snap = self._load()
+        self._users = snap.get("users", {})
+        self._seq = int(snap.get("seq", 0) or 0)
+        # compactions of older versions rotated the journal and could leave a .old segment behind
+        self._seq, n_old = _replay_journal(self.journal_path + ".old", self._users, self._seq)
+        self._seq, n_cur = _replay_journal(self.journal_path, self._users, self._seq)
+        self._journal_len = n_old + n_cur
+        self._pending = []
+        self.wakeup = None  # asyncio.Event set by db_flush_loop
+
+    def _take_ownership(self):
+        # Single-process store: every process keeps its own seq and pending entries, so a second
+        # one (e.g. another uvicorn worker) must fail at startup instead of interleaving the journal.
+        try:
+            import fcntl
+        except ImportError:
+            return None  # no flock (Windows): single process by convention only
+        owner = open(self.path + ".lock", "a")
+        try:
+            fcntl.flock(owner, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            owner.close()
+            raise RuntimeError(f"{self.path} is in use by another process: DB_BACKEND=json supports one "
+                               "process only (use DB_BACKEND=sqlite with several workers)")
+        return owner
+
+    def _load(self):
+        if not os.path.exists(self.path):
             return {"users": {}}
         try:
-            with open(DB_FILE, "r", encoding="utf-8") as f:
+            with open(self.path, "r", encoding="utf-8") as f:
                 return json.load(f)
         except Exception:
             return {"users": {}}
 
-async def save_db(db):
-    async with DB_LOCK:
-        with open(DB_FILE, "w", encoding="utf-8") as f:
-            json.dump(db, f, ensure_ascii=False, indent=2)
+    def _log(self, uid, op, **kw):
+        # caller holds self._lock
+        self._seq += 1
+        kw.update(q=self._seq, u=uid, op=op)
+        _apply_journal_entry(self._users, kw)
+        self._pending.append(kw)
+        if self.wakeup is not None and len(self._pending) >= DB_FLUSH_MAX_DIRTY:
+            self.wakeup.set()
+
+    def get(self, user_id):
+        with self._lock:
+            u = self._users.get(str(user_id))
+            return dict(u) if u is not None else None
+
+    def insert(self, user_id, user):
+        uid = str(user_id)
+        with self._lock:
+            if uid not in self._users:
+                self._log(uid, "new", v=dict(user))
+
+    def update(self, user_id, **fields):
+        with self._lock:
+            self._log(str(user_id), "set", f=fields)
+
+    def incr(self, user_id, field, n=1, limit=None):
+        # compare-and-add: returns the new value, or None if it would exceed `limit`
+        uid = str(user_id)
+        with self._lock:
+            u = self._users.get(uid)
+            cur = int((u or {}).get(field, 0) or 0)
+            if limit is not None and cur + n > limit:
+                return None
+            n = max(n, -cur)  # never below 0
+            if n or u is None:
+                self._log(uid, "incr", k=field, n=n)
+            return self._users[uid][field]
+
+    def ids(self):
+        with self._lock:
+            return [int(x) for x in self._users if str(x).lstrip("-").isdigit()]
+
+    def dirty_count(self):
+        return len(self._pending)
+
+    def _append(self, entries):
+        # caller holds self._io_lock
+        if not entries:
+            return 0
+        dumps = json.dumps
+        data = "".join(dumps(e, ensure_ascii=False, separators=(",", ":")) + "\n" for e in entries)
+        with open(self.journal_path, "a", encoding="utf-8") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        self._journal_len += len(entries)
+        return len(entries)
+
+    def flush(self):
+        with self._io_lock:
+            with self._lock:
+                entries, self._pending = self._pending, []
+            try:
+                return self._append(entries)
+            except Exception:
+                with self._lock:
+                    self._pending[:0] = entries
+                raise
+
+    def needs_compaction(self):
+        return self._journal_len >= DB_COMPACT_EVERY
+
+    def compact(self):
+        # Fold the journal into a fresh snapshot. The snapshot is written and fsynced before any
+        # journal segment is removed, and appends wait on _io_lock meanwhile, so every removed
+        # entry is already in the snapshot (seq) and a crash at any step replays safely.
+        with self._io_lock:
+            with self._lock:
+                entries, self._pending = self._pending, []
+                self._append(entries)
+                snapshot = {"seq": self._seq, "users": {uid: dict(u) for uid, u in self._users.items()}}
+            _atomic_write_json(self.path, snapshot)
+            for path in (self.journal_path + ".old", self.journal_path):  # .old: left by older versions
+                if os.path.exists(path):
+                    os.remove(path)
+            self._journal_len = 0
+        return len(snapshot["users"])
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            if self._owner is not None:
+                self._owner.close()  # releases the flock
+                self._owner = None
+
+class SqliteUserStore:
+    # One row per user, keyed by Telegram user id -> O(1) reads/writes.
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("PRAGMA busy_timeout=5000")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS users ("
+            " id INTEGER PRIMARY KEY,"
+            " plan TEXT NOT NULL DEFAULT 'FREE',"
+            " expires_at INTEGER NOT NULL DEFAULT 0,"
+            " trial_used INTEGER NOT NULL DEFAULT 0,"
+            " created_at INTEGER NOT NULL DEFAULT 0,"
+            " lang TEXT NOT NULL DEFAULT ''"
+            ")"
+        )
+
+    def get(self, user_id):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT plan, expires_at, trial_used, created_at, lang FROM users WHERE id = ?",
+                (int(user_id),),
+            ).fetchone()
+        return dict(row) if row is not None else None
+
+    def insert(self, user_id, user):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR IGNORE INTO users (id, plan, expires_at, trial_used, created_at, lang)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                (int(user_id),) + tuple(user.get(k, _default_user()[k]) for k in _USER_FIELDS),
+            )
+
+    def update(self, user_id, **fields):
+        fields = {k: v for k, v in fields.items() if k in _USER_FIELDS}
+        if not fields:
+            return
+        self.insert(user_id, _default_user())
+        cols = ", ".join(f"{k} = ?" for k in fields)
+        with self._lock:
+            self._conn.execute(f"UPDATE users SET {cols} WHERE id = ?", tuple(fields.values()) + (int(user_id),))
+
+    def ids(self):
+        with self._lock:
+            return [r[0] for r in self._conn.execute("SELECT id FROM users ORDER BY id")]
+
+    def count(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+
+    def import_users(self, users):
+        # users: iterable of (user_id, user_dict); one transaction, existing rows win
+        rows = []
+        for uid, u in users:
+            if not str(uid).lstrip("-").isdigit():
+                continue
+            base = _default_user()
+            base.update({k: u[k] for k in _USER_FIELDS if k in u})
+            rows.append((int(uid),) + tuple(base[k] for k in _USER_FIELDS))
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.executemany(
+                    "INSERT OR IGNORE INTO users (id, plan, expires_at, trial_used, created_at, lang)"
+                    " VALUES (?, ?, ?, ?, ?, ?)",
+                    rows,
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return len(rows)
+
+    def incr(self, user_id, field, n=1, limit=None):
+        # compare-and-add in one statement: returns the new value, or None if it would exceed `limit`
+        if field not in _USER_FIELDS:
+            raise ValueError("Invalid field")
+        self.insert(user_id, _default_user())
+        with self._lock:
+            row = self._conn.execute(
+                f"UPDATE users SET {field} = MAX(0, {field} + ?)"
+                f" WHERE id = ? AND (? IS NULL OR {field} + ? <= ?) RETURNING {field}",
+                (int(n), int(user_id), limit, int(n), limit),
+            ).fetchone()
+        return row[0] if row is not None else None
+
+    def flush(self):
+        return 0
+
+    def needs_compaction(self):
+        return False
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+def _json_store_files(json_path):
+    # db.json, its journal, and the .old segment older versions could leave behind
+    return [p for p in (json_path, json_path + ".journal", json_path + ".journal.old") if os.path.exists(p)]
+
+def migrate_json_to_sqlite(json_path=DB_FILE, sqlite_path=DB_SQLITE_FILE):
+    # One-shot: import the json store (snapshot + replayed journal) into SQLite, then rename its
+    # files so they are never imported twice. Several workers may start at once: the first one
+    # to take the flock migrates, the others find the files gone and return 0.
+    try:
+        import fcntl
+    except ImportError:
+        fcntl = None  # no flock (Windows): single worker process only
+    with open(sqlite_path + ".migrate.lock", "a") as lock:
+        if fcntl is not None:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        if not _json_store_files(json_path):
+            return 0  # already migrated
+        source = JsonUserStore(json_path)
+        try:
+            users = [(uid, source.get(uid)) for uid in source.ids()]
+        finally:
+            source.close()
+        store = SqliteUserStore(sqlite_path)
+        try:
+            n = store.import_users(users)
+        finally:
+            store.close()
+        for path in _json_store_files(json_path):
+            os.replace(path, path + ".migrated")
+    return n
+
+_STORE = None
+
+def open_store():
+    global _STORE
+    if _STORE is None:
+        if DB_BACKEND == "json":
+            _STORE = JsonUserStore(DB_FILE)
+        else:
+            if _json_store_files(DB_FILE):
+                n = migrate_json_to_sqlite(DB_FILE, DB_SQLITE_FILE)
+                if n:
+                    print(f"✅ Migrated {n} users from {DB_FILE} to {DB_SQLITE_FILE}")
+            _STORE = SqliteUserStore(DB_SQLITE_FILE)
+    return _STORE
+
+async def load_db():
+    return open_store()
+
+async def db_flush_loop():
+    store = open_store()
+    store.wakeup = asyncio.Event()
+    while True:
+        try:
+            await asyncio.wait_for(store.wakeup.wait(), timeout=DB_FLUSH_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        store.wakeup.clear()
+        try:
+            with DB_SECONDS.time("flush"):
+                await asyncio.to_thread(store.flush)
+            if store.needs_compaction():
+                await asyncio.to_thread(store.compact)
+        except Exception as e:
+            print(f"WARNING: DB flush failed: {e}")
+        try:
+            await asyncio.to_thread(sessions().sweep)
+        except Exception as e:
+            print(f"WARNING: session sweep failed: {e}")
+        history = history_store()
+        if history is not None and history.dirty_count():
+            try:
+                await asyncio.to_thread(history.flush)
+            except Exception as e:
+                print(f"WARNING: history flush failed: {e}")
+
+async def store_call(store, method, *args, **kwargs):
+    # SQLite (busy_timeout) and Redis calls are blocking round trips: run them off the event loop.
+    # The in-memory stores (json users, memory sessions) are called directly.
+    fn = getattr(store, method)
+    if isinstance(store, (JsonUserStore, MemorySessionStore)):
+        return fn(*args, **kwargs)
+    return await asyncio.to_thread(fn, *args, **kwargs)
 
 async def get_user(db, user_id):
-    uid = str(user_id)
-    if uid not in db["users"]:
-        db["users"][uid] = _default_user()
-        await save_db(db)
+    with DB_SECONDS.time("load"):
+        u = await store_call(db, "get", user_id)
+    if u is None:
+        u = _default_user()
+        with DB_SECONDS.time("insert"):
+            await store_call(db, "insert", user_id, u)
     # ensure lang exists
-    if "lang" not in db["users"][uid] or db["users"][uid]["lang"] not in LANGS:
-        db["users"][uid]["lang"] = DEFAULT_LANG
-        await save_db(db)
-    return db["users"][uid]
+    if u.get("lang") not in LANGS:
+        u["lang"] = DEFAULT_LANG
+        await store_call(db, "update", user_id, lang=DEFAULT_LANG)
+    return u
 
 async def set_lang(db, user_id, lang):
-    u = await get_user(db, user_id)
-    u["lang"] = lang
-    await save_db(db)
+    await get_user(db, user_id)
+    await store_call(db, "update", user_id, lang=lang)
 
 def is_admin(user_id):
     return user_id in ADMIN_IDS
@@ -316,15 +829,158 @@ async def set_plan(db, user_id, plan):
     plan = (plan or "").strip().upper()
     if plan not in PLANS:
         raise ValueError("Invalid plan")
-    u = await get_user(db, user_id)
-    u["plan"] = plan
-    u["expires_at"] = 0
-    await save_db(db)
+    await get_user(db, user_id)
+    await store_call(db, "update", user_id, plan=plan, expires_at=0)
 
 async def trial_remaining(u):
     used = int(u.get("trial_used", 0) or 0)
     return max(0, FREE_TRIAL_LIMIT - used)
 
+# Trial credits: reserve before the analysis starts, commit on success, refund on failure.
+# The reservation is an atomic compare-and-add on the user's own record, so concurrent photos
+# from one user cannot overspend and different users never contend.
+async def reserve_trial(db, user_id):
+    with DB_SECONDS.time("reserve_trial"):
+        return await store_call(db, "incr", user_id, "trial_used", 1, limit=FREE_TRIAL_LIMIT) is not None
+
+async def trial_left(db, user_id):
+    # remaining free analyses after a reservation
+    with DB_SECONDS.time("load"):
+        u = await store_call(db, "get", user_id) or _default_user()
+    return await trial_remaining(u)
+
+async def refund_trial(db, user_id):
+    with DB_SECONDS.time("refund_trial"):
+        await store_call(db, "incr", user_id, "trial_used", -1)
+
+# ============================================================
+# Signal history (columnar, append-only, per-day segments)
+# ============================================================
+# HISTORY_DIR/YYYY-MM-DD/<column>.bin holds one fixed-width little-endian array per column;
+# appends are plain file appends and scans np.memmap only the columns they need. A flush
+# interrupted between columns leaves some files a row longer; readers use the shortest.
+HISTORY_COLUMNS = (
+    ("ts", "<f8"), ("user", "<i8"), ("symbol", "S12"), ("timeframe", "S3"),
+    ("signal", "i1"), ("confidence", "u1"), ("anchor", "<f8"),
+    ("tp1", "<f8"), ("tp2", "<f8"), ("tp3", "<f8"), ("sl", "<f8"),
+    ("latency_ms", "<u4"), ("tokens_in", "<u4"), ("tokens_out", "<u4"), ("source", "u1"),
+)
+HISTORY_SOURCES = ("model", "file_cache", "phash_cache", "shared")
+
+class HistoryStore:
+    def __init__(self, root):
+        self.root = root
+        self.dtype = np.dtype(list(HISTORY_COLUMNS))
+        self._pending = []
+        self._lock = threading.Lock()
+        self._io_lock = threading.Lock()  # one flush at a time (flusher thread vs. shutdown)
+        os.makedirs(root, exist_ok=True)
+
+    def append(self, row):
+        # row: tuple in HISTORY_COLUMNS order; written on the next flush()
+        with self._lock:
+            self._pending.append(row)
+
+    def dirty_count(self):
+        return len(self._pending)
+
+    def flush(self):
+        with self._io_lock:
+            with self._lock:
+                rows, self._pending = self._pending, []
+            if not rows:
+                return
+            arr = np.array(rows, dtype=self.dtype)
+            days = (arr["ts"] // 86400).astype(np.int64)
+            for day in np.unique(days):
+                path = os.path.join(self.root, time.strftime("%Y-%m-%d", time.gmtime(int(day) * 86400)))
+                self._append_segment(path, arr[days == day])
+
+    def _append_segment(self, path, seg):
+        # All columns of a day are appended under an exclusive flock on the day's .lock file, so
+        # writers in other processes (uvicorn workers) cannot interleave rows between columns.
+        # Columns are first cut back to their common length: that drops a torn earlier append.
+        try:
+            import fcntl
+        except ImportError:
+            fcntl = None  # no flock (Windows): single writer process only
+        os.makedirs(path, exist_ok=True)
+        with open(os.path.join(path, ".lock"), "a") as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            schema = os.path.join(path, "schema.json")
+            if not os.path.exists(schema):
+                with open(schema, "w", encoding="utf-8") as f:
+                    json.dump(HISTORY_COLUMNS, f)
+            files = [(os.path.join(path, name + ".bin"), np.dtype(dt).itemsize) for name, dt in HISTORY_COLUMNS]
+            n = min(os.path.getsize(p) // size if os.path.exists(p) else 0 for p, size in files)
+            for (p, size), (name, _) in zip(files, HISTORY_COLUMNS):
+                with open(p, "ab") as f:
+                    if f.tell() != n * size:
+                        f.truncate(n * size)
+                    f.write(np.ascontiguousarray(seg[name]).tobytes())
+
+    def segments(self, since="", until=""):
+        # day directory names, oldest first; since/until are inclusive YYYY-MM-DD bounds
+        days = sorted(d for d in os.listdir(self.root) if re.fullmatch(r"\d{4}-\d{2}-\d{2}", d))
+        return [d for d in days if (not since or d >= since) and (not until or d <= until)]
+
+    def read(self, day, columns=None):
+        # {column: read-only memmap} for one segment
+        columns = columns or [c for c, _ in HISTORY_COLUMNS]
+        path = os.path.join(self.root, day)
+        dtypes = dict(HISTORY_COLUMNS)
+        sizes = []
+        for name, dt in HISTORY_COLUMNS:
+            p = os.path.join(path, name + ".bin")
+            sizes.append(os.path.getsize(p) // np.dtype(dt).itemsize if os.path.exists(p) else 0)
+        n = min(sizes)
+        out = {}
+        for c in columns:
+            if n == 0:
+                out[c] = np.empty(0, dtype=dtypes[c])
+            else:
+                out[c] = np.memmap(os.path.join(path, c + ".bin"), dtype=dtypes[c], mode="r", shape=(n,))
+        return out
+
+    def scan(self, columns=None, since="", until=""):
+        # requested columns concatenated over the selected days (only those columns are read)
+        columns = columns or [c for c, _ in HISTORY_COLUMNS]
+        parts = [self.read(day, columns) for day in self.segments(since, until)]
+        dtypes = dict(HISTORY_COLUMNS)
+        return {c: np.concatenate([p[c] for p in parts]) if parts else np.empty(0, dtype=dtypes[c])
+                for c in columns}
+
+_HISTORY = None
+
+def history_store():
+    global _HISTORY
+    if _HISTORY is None and HISTORY_DIR:
+        _HISTORY = HistoryStore(HISTORY_DIR)
+    return _HISTORY
+
+def record_signal(user_id, symbol, timeframe, result, latency, meta):
+    history = history_store()
+    if history is None:
+        return
+
+    def price(key):
+        nums = _extract_floats(str(result.get(key, "") or ""))
+        return nums[0] if nums else float("nan")
+
+    anchor = _parse_entry_anchor(str(result.get("entry_zone", "") or ""))
+    usage = meta.get("usage") or {}
+    history.append((
+        time.time(), int(user_id),
+        (symbol or "").encode("ascii", "ignore")[:12], (timeframe or "").encode("ascii", "ignore")[:3],
+        -1 if str(result.get("signal", "")).upper() == "SELL" else 1,
+        max(0, min(100, int(result.get("confidence", 0) or 0))),
+        float("nan") if anchor is None else anchor,
+        price("tp1"), price("tp2"), price("tp3"), price("sl"),
+        int(latency * 1000), int(usage.get("input_tokens", 0)), int(usage.get("output_tokens", 0)),
+        HISTORY_SOURCES.index(meta.get("source", "shared")),
+    ))
+
 # ============================================================
 # Menus (INLINE ONLY) - no reply keyboard (prevents email trap)
 # ============================================================
@@ -363,9 +1019,181 @@ def cancel_keyboard(lang):
     ])
 
 # ============================================================
-# Pending activation state
+# Session state (TTL keys shared by all bot processes)
 # ============================================================
-PENDING_EMAIL = set()  # user_id set
+# Stores keep small string values under keys like "pending_email:<uid>" with a TTL.
+# incr() is an atomic bounded counter (per-user in-flight analyses across replicas).
+class MemorySessionStore:
+    def __init__(self):
+        self._data = {}  # key -> (value, expires_at)
+        self._lock = threading.Lock()
+
+    def _live(self, key, now):
+        item = self._data.get(key)
+        if item is not None and item[1] <= now:
+            del self._data[key]
+            return None
+        return item
+
+    def get(self, key):
+        with self._lock:
+            item = self._live(key, time.time())
+        return item[0] if item else None
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._data[key] = (str(value), time.time() + ttl)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def incr(self, key, n, ttl, limit=None):
+        # new value, or None (unchanged) if it would exceed limit
+        now = time.time()
+        with self._lock:
+            item = self._live(key, now)
+            v = max(0, (int(item[0]) if item else 0) + n)
+            if limit is not None and v > limit:
+                return None
+            self._data[key] = (str(v), now + ttl)
+        return v
+
+    def sweep(self):
+        now = time.time()
+        with self._lock:
+            for key in [k for k, (_, exp) in self._data.items() if exp <= now]:
+                del self._data[key]
+
+    def close(self):
+        pass
+
+class SqliteSessionStore:
+    # WAL database of its own (separate from the user store: no lock contention with it)
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("PRAGMA busy_timeout=5000")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS sessions (k TEXT PRIMARY KEY, v TEXT NOT NULL, exp REAL NOT NULL)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS sessions_exp ON sessions (exp)")
+        self._last_sweep = 0.0
+
+    def get(self, key):
+        with self._lock:
+            row = self._conn.execute("SELECT v FROM sessions WHERE k = ? AND exp > ?", (key, time.time())).fetchone()
+        return row[0] if row else None
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO sessions (k, v, exp) VALUES (?, ?, ?)"
+                " ON CONFLICT(k) DO UPDATE SET v = excluded.v, exp = excluded.exp",
+                (key, str(value), time.time() + ttl),
+            )
+
+    def delete(self, key):
+        with self._lock:
+            self._conn.execute("DELETE FROM sessions WHERE k = ?", (key,))
+
+    def incr(self, key, n, ttl, limit=None):
+        # one statement: expired rows restart from 0; the WHERE clause enforces limit
+        now = time.time()
+        if limit is not None and n > limit:
+            return None
+        with self._lock:
+            row = self._conn.execute(
+                "INSERT INTO sessions (k, v, exp) VALUES (:k, MAX(0, :n), :exp)"
+                " ON CONFLICT(k) DO UPDATE SET"
+                "  v = MAX(0, (CASE WHEN exp <= :now THEN 0 ELSE CAST(v AS INTEGER) END) + :n), exp = :exp"
+                " WHERE :limit IS NULL"
+                "  OR (CASE WHEN exp <= :now THEN 0 ELSE CAST(v AS INTEGER) END) + :n <= :limit"
+                " RETURNING v",
+                {"k": key, "n": int(n), "exp": now + ttl, "now": now, "limit": limit},
+            ).fetchone()
+        return int(row[0]) if row else None
+
+    def sweep(self):
+        now = time.time()
+        if now - self._last_sweep < 60:
+            return
+        self._last_sweep = now
+        with self._lock:
+            self._conn.execute("DELETE FROM sessions WHERE exp <= ?", (now,))
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+_REDIS_INCR = """
+local v = tonumber(redis.call('GET', KEYS[1]) or '0') + tonumber(ARGV[1])
+if v < 0 then v = 0 end
+if ARGV[3] ~= '' and v > tonumber(ARGV[3]) then return false end
+redis.call('SET', KEYS[1], v, 'PX', ARGV[2])
+return v
+"""
+
+class RedisSessionStore:
+    # Redis (or anything speaking its protocol, e.g. a local Valkey/KeyDB) for multi-host setups.
+    # Calls are synchronous like the other stores: sub-millisecond on a nearby server.
+    def __init__(self, url):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError("SESSION_BACKEND=redis needs the redis package (pip install redis)")
+        self._r = redis.Redis.from_url(url, decode_responses=True)
+        self._incr = self._r.register_script(_REDIS_INCR)
+
+    def get(self, key):
+        return self._r.get(key)
+
+    def set(self, key, value, ttl):
+        self._r.set(key, str(value), px=int(ttl * 1000))
+
+    def delete(self, key):
+        self._r.delete(key)
+
+    def incr(self, key, n, ttl, limit=None):
+        v = self._incr(keys=[key], args=[int(n), int(ttl * 1000), "" if limit is None else int(limit)])
+        return None if v is None else int(v)
+
+    def sweep(self):
+        pass  # keys expire on their own
+
+    def close(self):
+        self._r.close()
+
+_SESSIONS = None
+
+def sessions():
+    global _SESSIONS
+    if _SESSIONS is None:
+        if SESSION_BACKEND == "memory":
+            _SESSIONS = MemorySessionStore()
+        elif SESSION_BACKEND == "redis":
+            _SESSIONS = RedisSessionStore(SESSION_REDIS_URL)
+        else:
+            _SESSIONS = SqliteSessionStore(SESSION_SQLITE_FILE)
+    return _SESSIONS
+
+async def session_call(method, *args, **kwargs):
+    return await store_call(sessions(), method, *args, **kwargs)
+
+async def is_pending_email(user_id):
+    return await session_call("get", f"pending_email:{user_id}") is not None
+
+async def set_pending_email(user_id, pending):
+    if pending:
+        await session_call("set", f"pending_email:{user_id}", 1, SESSION_TTL_PENDING_EMAIL)
+    else:
+        await session_call("delete", f"pending_email:{user_id}")
+
+async def set_awaiting_photo(user_id, awaiting):
+    if awaiting:
+        await session_call("set", f"awaiting_photo:{user_id}", 1, SESSION_TTL_AWAITING_PHOTO)
+    else:
+        await session_call("delete", f"awaiting_photo:{user_id}")
 
 # ============================================================
 # TP enforcement helpers
@@ -397,47 +1225,187 @@ def _parse_entry_anchor(entry_zone):
         return (nums[0] + nums[1]) / 2.0
     return nums[0]
 
-def enforce_tp_rules(result):
-    try:
-        conf = int(result.get("confidence", 50) or 50)
-    except Exception:
-        conf = 50
+# ============================================================
+# Instruments (point size, digits, TP/SL point profiles)
+# ============================================================
+# A profile gives TP1 points, TP2/TP3 points as [weak, strong] (strong = confidence >= CONF_STRONG)
+# and SL points (0 = keep the model's SL). "profiles" is keyed by timeframe; "*" = any timeframe.
+# INSTRUMENTS_FILE example:
+#   {"XAUUSD": {"point": 0.01, "digits": 2, "aliases": ["GOLD"],
+#               "profiles": {"*": {"tp1": 200, "tp2": [400, 500], "tp3": [600, 700], "sl": 0},
+#                            "D1": {"tp1": 200, "tp2": [800, 1000], "tp3": [1200, 1500], "sl": 600}}}}
+def _default_profile():
+    return {
+        "tp1": TP1_FIXED_POINTS,
+        "tp2": [TP2_WEAK_POINTS, TP2_STRONG_POINTS],
+        "tp3": [TP3_WEAK_POINTS, TP3_STRONG_POINTS],
+        "sl": 0,
+    }
+
+# symbol: (point, digits, aliases). The default profile is tuned for XAUUSD (200 points = $2);
+# other symbols take the same point counts on their own point size.
+_BUILTIN_INSTRUMENTS = {
+    "XAUUSD": (0.01, 2, ["GOLD", "XAU"]),
+    "XAGUSD": (0.001, 3, ["SILVER"]),
+    "EURUSD": (0.00001, 5, []),
+    "GBPUSD": (0.00001, 5, []),
+    "AUDUSD": (0.00001, 5, []),
+    "USDCHF": (0.00001, 5, []),
+    "USDCAD": (0.00001, 5, []),
+    "USDJPY": (0.001, 3, []),
+    "BTCUSD": (1.0, 2, ["BTCUSDT", "BITCOIN"]),
+    "ETHUSD": (0.1, 2, ["ETHUSDT"]),
+    "US30": (1.0, 1, ["DJ30", "DOW"]),
+    "NAS100": (0.1, 1, ["US100", "USTEC"]),
+    "SPX": (0.1, 1, ["US500", "SPX500"]),
+    "WTI": (0.001, 2, ["USOIL", "XTIUSD"]),
+    "BRENT": (0.001, 2, ["UKOIL", "XBRUSD"]),
+}
+
+def load_instruments(path=""):
+    table, aliases = {}, {}
+    for sym, (point, digits, names) in _BUILTIN_INSTRUMENTS.items():
+        table[sym] = {"point": point, "digits": digits, "profiles": {"*": _default_profile()}}
+        aliases.update({a: sym for a in names})
+    if path:
+        with open(path, "r", encoding="utf-8") as f:
+            custom = json.load(f)
+        for sym, spec in custom.items():
+            sym = sym.upper()
+            base = table.get(sym, {"point": POINT_VALUE, "digits": 2, "profiles": {"*": _default_profile()}})
+            profiles = dict(base["profiles"])
+            for tf, prof in sorted((spec.get("profiles") or {}).items(), key=lambda kv: kv[0] != "*"):
+                profiles[tf.upper()] = dict(profiles.get(tf.upper(), profiles["*"]), **prof)
+            table[sym] = {
+                "point": float(spec.get("point", base["point"])),
+                "digits": int(spec.get("digits", base["digits"])),
+                "profiles": profiles,
+            }
+            aliases.update({a.upper(): sym for a in spec.get("aliases", [])})
+    return table, aliases
+
+INSTRUMENTS, INSTRUMENT_ALIASES = load_instruments(INSTRUMENTS_FILE)
+
+_SYMBOL_JUNK_RE = re.compile(r"[^A-Z0-9]")
+# broker account-type suffixes longer than the two-letter ones ("m", "c", "i", "sb", ...)
+_BROKER_SUFFIXES = {"PRO", "ECN", "RAW", "STD", "VIP", "MINI", "MICRO", "CENT", "PLUS", "ZERO"}
+
+def instrument_symbol(symbol):
+    # Canonical table symbol for broker spellings ("XAUUSD.m", "xauusdm", "GOLD"), or "" if unknown
+    s = _SYMBOL_JUNK_RE.sub("", (symbol or "").upper())
+    if not s:
+        return ""
+    if s in INSTRUMENTS:
+        return s
+    if s in INSTRUMENT_ALIASES:
+        return INSTRUMENT_ALIASES[s]
+    for sym in INSTRUMENTS:
+        if len(sym) >= 5 and s.startswith(sym):  # broker suffix: m, sb, pro, ecn, ...
+            suffix = s[len(sym):]
+            if len(suffix) <= 2 or suffix in _BROKER_SUFFIXES:
+                return sym
+    return ""
+
+def _profile_params(symbol, timeframe):
+    # (point, digits or -1, tp1, tp2 weak, tp2 strong, tp3 weak, tp3 strong, sl)
+    spec = INSTRUMENTS.get(instrument_symbol(symbol))
+    if spec is None:
+        p = _default_profile()
+        return (POINT_VALUE, -1, p["tp1"], p["tp2"][0], p["tp2"][1], p["tp3"][0], p["tp3"][1], p["sl"])
+    p = spec["profiles"].get((timeframe or "").upper()) or spec["profiles"]["*"]
+    return (spec["point"], spec["digits"], p["tp1"], p["tp2"][0], p["tp2"][1], p["tp3"][0], p["tp3"][1], p["sl"])
+
+def compute_tp_sl(symbols, timeframes, buy, conf, anchor, entry_digits, model_sl):
+    # Vectorized TP/SL for N signals (bulk recomputation, backtests: N = millions); one live
+    # signal goes through tp_sl_one(), which computes the same values without array overhead.
+    # symbols/timeframes: sequences of str; buy: bool; conf, anchor, model_sl (NaN = none): float;
+    # entry_digits: decimals seen in the entry zone (used for unknown symbols).
+    # Returns (tps (N, 3), sl (N,), digits (N,)).
+    symbols = np.asarray(symbols, dtype=str)
+    timeframes = np.asarray(timeframes, dtype=str)
+    sym_u, sym_i = np.unique(symbols, return_inverse=True)
+    tf_u, tf_i = np.unique(timeframes, return_inverse=True)
+    params = np.array([_profile_params(sy, tf) for sy in sym_u for tf in tf_u], dtype=np.float64)
+    prm = params[sym_i.ravel() * len(tf_u) + tf_i.ravel()]
+
+    point, digits = prm[:, 0], prm[:, 1]
+    strong = np.asarray(conf, dtype=np.float64) >= CONF_STRONG
+    side = np.where(np.asarray(buy, dtype=bool), 1.0, -1.0)
+    anchor = np.asarray(anchor, dtype=np.float64)
+
+    pts = np.empty((len(anchor), 3))
+    pts[:, 0] = prm[:, 2]
+    pts[:, 1] = np.where(strong, prm[:, 4], prm[:, 3])
+    pts[:, 2] = np.where(strong, prm[:, 6], prm[:, 5])
+    tps = anchor[:, None] + (side * point)[:, None] * pts
+    sl = np.where(prm[:, 7] > 0, anchor - side * point * prm[:, 7], np.asarray(model_sl, dtype=np.float64))
+    digits = np.where(digits >= 0, digits, np.asarray(entry_digits, dtype=np.float64)).astype(np.int64)
+    return tps, sl, digits
+
+def tp_sl_one(symbol, timeframe, buy, conf, anchor, entry_digits, model_sl):
+    # compute_tp_sl() for a single signal, in plain floats (same operations, same results).
+    # Returns ((tp1, tp2, tp3), sl, digits).
+    point, digits, tp1, tp2w, tp2s, tp3w, tp3s, sl_pts = _profile_params(symbol, timeframe)
+    strong = conf >= CONF_STRONG
+    step = (1.0 if buy else -1.0) * point
+    tps = (anchor + step * tp1, anchor + step * (tp2s if strong else tp2w), anchor + step * (tp3s if strong else tp3w))
+    sl = anchor - step * sl_pts if sl_pts > 0 else model_sl
+    return tps, sl, int(digits if digits >= 0 else entry_digits)
 
+def _signal_arrays(result, symbol, timeframe):
+    # one result -> the scalar inputs of compute_tp_sl, or None when there is no entry price
     entry_zone = str(result.get("entry_zone", "") or "")
     anchor = _parse_entry_anchor(entry_zone)
     if anchor is None:
+        return None
+    try:
+        conf = int(result.get("confidence", 50) or 50)
+    except Exception:
+        conf = 50
+    buy = str(result.get("signal", "BUY") or "BUY").upper() != "SELL"
+    sl_nums = _extract_floats(str(result.get("sl", "") or ""))
+    sym = symbol if symbol is not None else result.get("symbol", "")
+    tf = timeframe if timeframe is not None else result.get("timeframe", "")
+    return (sym or "", tf or "", buy, conf, anchor, _detect_decimals(entry_zone, default=1),
+            sl_nums[0] if sl_nums else float("nan"))
+
+def enforce_tp_rules(result, symbol=None, timeframe=None):
+    # symbol/timeframe: what the caller settled on (e.g. caption fallback); default: the model's.
+    # Returns a new dict; cached results are shared and must not be mutated.
+    row = _signal_arrays(result, symbol, timeframe)
+    if row is None:
         return result
-
-    decimals = _detect_decimals(entry_zone, default=1)
-
-    sig = str(result.get("signal", "BUY") or "BUY").upper()
-    if sig not in ("BUY", "SELL"):
-        sig = "BUY"
-
-    strong = conf >= CONF_STRONG
-
-    p1 = TP1_FIXED_POINTS
-    p2 = TP2_STRONG_POINTS if strong else TP2_WEAK_POINTS
-    p3 = TP3_STRONG_POINTS if strong else TP3_WEAK_POINTS
-
-    d1 = p1 * POINT_VALUE
-    d2 = p2 * POINT_VALUE
-    d3 = p3 * POINT_VALUE
-
-    if sig == "BUY":
-        tp1 = anchor + d1
-        tp2 = anchor + d2
-        tp3 = anchor + d3
-    else:
-        tp1 = anchor - d1
-        tp2 = anchor - d2
-        tp3 = anchor - d3
-
-    result["tp1"] = _format_price(tp1, decimals)
-    result["tp2"] = _format_price(tp2, decimals)
-    result["tp3"] = _format_price(tp3, decimals)
+    tps, sl, d = tp_sl_one(*row)
+    result = dict(result)
+    result["tp1"] = _format_price(tps[0], d)
+    result["tp2"] = _format_price(tps[1], d)
+    result["tp3"] = _format_price(tps[2], d)
+    if not math.isnan(sl) and sl != row[6]:
+        result["sl"] = _format_price(sl, d)  # profile SL replaces the model's
     return result
 
+def recompute_tp(records):
+    # Bulk recomputation (e.g. after editing INSTRUMENTS_FILE): bulk-mode JSONL records in, same
+    # records with fresh tp1-tp3/sl out. One compute_tp_sl pass over all signals.
+    rows, idx = [], []
+    for i, rec in enumerate(records):
+        row = _signal_arrays(rec["result"], None, None) if rec.get("ok") else None
+        if row is not None:
+            rows.append(row)
+            idx.append(i)
+    if not rows:
+        return records
+    cols = list(zip(*rows))
+    tps, sl, digits = compute_tp_sl(*cols)
+    model_sl = np.asarray(cols[6], dtype=np.float64)
+    for j, i in enumerate(idx):
+        r = records[i]["result"] = dict(records[i]["result"])
+        d = int(digits[j])
+        r["tp1"], r["tp2"], r["tp3"] = (_format_price(x, d) for x in tps[j])
+        if not np.isnan(sl[j]) and sl[j] != model_sl[j]:
+            r["sl"] = _format_price(sl[j], d)
+    return records
+
 # ============================================================
 # Confidence profile -> marketing label (localized)
 # ============================================================
@@ -457,47 +1425,389 @@ def confidence_label_key(conf):
 # ============================================================
 # OpenAI vision call (Responses API)
 # ============================================================
-def image_to_base64_jpeg(image_bytes, max_side=1024, quality=85):
-    img = Image.open(BytesIO(image_bytes)).convert("RGB")
+def _downscale_rgb(image_bytes, max_side, exact=True):
+    # exact=False stops after the (free) draft decode; the caller resizes once after cropping
+    img = Image.open(BytesIO(image_bytes))
     w, h = img.size
     scale = min(1.0, float(max_side) / float(max(w, h)))
-    if scale < 1.0:
-        img = img.resize((int(w * scale), int(h * scale)))
+    tw, th = max(1, int(w * scale)), max(1, int(h * scale))
+    if scale < 1.0 and img.format == "JPEG":
+        # JPEG draft mode: the decoder scales by 1/2, 1/4 or 1/8 in the DCT domain (never below tw x th)
+        img.draft("RGB", (tw, th))
+    if img.mode == "P":
+        img = img.convert("RGB")  # palette images cannot be filtered
+    if exact and img.size != (tw, th):
+        # resize before colour conversion: fewer pixels to convert
+        img = img.resize((tw, th), Image.BILINEAR, reducing_gap=3.0)
+    if img.mode != "RGB":
+        img = img.convert("RGB")
+    return img
+
+def _jpeg_base64(img, quality):
     out = BytesIO()
-    img.save(out, format="JPEG", quality=quality, optimize=True)
+    # no optimize=True: the extra Huffman pass costs more CPU than the bytes it saves
+    img.save(out, format="JPEG", quality=quality)
     return base64.b64encode(out.getvalue()).decode("utf-8")
 
-def openai_analyze_chart(b64jpeg):
-    if not OPENAI_API_KEY:
+def image_phash(img, n=16):
+    # 256-bit difference hash: survives rescaling and recompression. 64 bits is too coarse
+    # for charts - different screenshots with the same layout land within a few bits.
+    g = img.convert("L").resize((n + 1, n), Image.BILINEAR)
+    px = g.tobytes()
+    bits = 0
+    for row in range(n):
+        for col in range(n):
+            bits = (bits << 1) | (px[row * (n + 1) + col] > px[row * (n + 1) + col + 1])
+    return bits
+
+# Image input accounting per model family (OpenAI vision docs), first matching prefix wins:
+# ("patch", multiplier): 32 px patches, at most 1536 (larger images are scaled down to fit),
+# billed as patches * multiplier; ("tile", base, per_tile): high detail, fit in 2048x2048,
+# shortest side to 768, then base + per_tile * 512 px tiles.
+IMAGE_TOKEN_MODELS = (
+    ("gpt-4.1-mini", "patch", 1.62),
+    ("gpt-4.1-nano", "patch", 2.46),
+    ("o4-mini", "patch", 1.72),
+    ("gpt-4o-mini", "tile", 2833, 5667),
+    ("o1", "tile", 75, 150),
+    ("o3", "tile", 75, 150),
+    ("", "tile", 85, 170),  # gpt-4o, gpt-4.1 and anything unknown
+)
+IMAGE_PATCH_PX, IMAGE_PATCH_MAX, IMAGE_TILE_PX = 32, 1536, 512
+
+def image_token_model(model=None):
+    model = (model or MODEL_VISION).lower()
+    return next(m[1:] for m in IMAGE_TOKEN_MODELS if model.startswith(m[0]))
+
+def _patch_fit(w, h):
+    # the size a patch-billed model actually sees (scaled down to IMAGE_PATCH_MAX patches)
+    p = IMAGE_PATCH_PX
+    if math.ceil(w / p) * math.ceil(h / p) <= IMAGE_PATCH_MAX:
+        return w, h
+    s = math.sqrt(p * p * IMAGE_PATCH_MAX / (w * h))
+    s *= min(math.floor(w * s / p) / (w * s / p), math.floor(h * s / p) / (h * s / p))
+    return w * s, h * s
+
+def estimate_image_tokens(w, h, model=None):
+    acct = image_token_model(model)
+    if acct[0] == "patch":
+        w, h = _patch_fit(w, h)
+        return math.ceil(math.ceil(w / IMAGE_PATCH_PX) * math.ceil(h / IMAGE_PATCH_PX) * acct[1])
+    s = min(1.0, 2048.0 / max(w, h))
+    w, h = w * s, h * s
+    s = min(1.0, 768.0 / min(w, h))
+    w, h = w * s, h * s
+    return acct[1] + acct[2] * math.ceil(w / IMAGE_TILE_PX) * math.ceil(h / IMAGE_TILE_PX)
+
+def token_aligned_size(w, h, max_side, ref_scale=None, model=None):
+    # Fewest tokens whose long side stays legible, on the model's token grid.
+    # ref_scale: scale the uncropped screenshot would get; a crop never demands more resolution
+    # than that (so cropping never costs more tokens). It may end up smaller: the long side is
+    # only kept at min(IMAGE_LEGIBLE_SIDE, uncropped resolution).
+    cap = min(1.0, float(max_side) / max(w, h))
+    legible = min(IMAGE_LEGIBLE_SIDE, max(w, h) * cap)
+    if ref_scale is not None:
+        legible = min(legible, max(w, h) * ref_scale)
+    if image_token_model(model)[0] == "patch":
+        # cost follows the area (patch count): the smallest legible size is the cheapest
+        fw, fh = _patch_fit(*(x * legible / float(max(w, h)) for x in (w, h)))
+        return max(1, int(fw)), max(1, int(fh))
+    best = None
+    for tx in range(1, 5):
+        for ty in range(1, 5):
+            s = min(cap, tx * IMAGE_TILE_PX / float(w), ty * IMAGE_TILE_PX / float(h))
+            size = (max(1, int(w * s)), max(1, int(h * s)))
+            if max(size) < legible - 1:
+                continue
+            key = (estimate_image_tokens(*size, model=model), -s)
+            if best is None or key < best[0]:
+                best = (key, size)
+    return best[1] if best else (max(1, int(w * cap)), max(1, int(h * cap)))
+
+def _active_span(profile, threshold, max_gap):
+    # [start, end) of the run with the most active cells, bridging gaps up to max_gap
+    best, best_score = None, 0
+    start, score, gap = None, 0, 0
+    for i, v in enumerate(list(profile) + [0] * (max_gap + 1)):
+        if v >= threshold:
+            if start is None:
+                start, score = i, 0
+            score += 1
+            gap = 0
+            end = i + 1
+        elif start is not None:
+            gap += 1
+            if gap > max_gap:
+                if score > best_score:
+                    best, best_score = (start, end), score
+                start = None
+    return best
+
+def _grow_span(profile, span, threshold, max_gap):
+    lo, hi = span
+    for step, edge in ((-1, lo - 1), (1, hi)):
+        i, gap = edge, 0
+        while 0 <= i < len(profile):
+            if profile[i] >= threshold:
+                gap = 0
+                if step < 0:
+                    lo = i
+                else:
+                    hi = i + 1
+            else:
+                gap += 1
+                if gap > max_gap:
+                    break
+            i += step
+    return lo, hi
+
+def _chart_thumbnail(img, thumb=192):
+    W, H = img.size
+    return img.resize((thumb, max(8, round(H * thumb / float(W)))), Image.BOX, reducing_gap=2.0)
+
+def _candle_mask(sm):
+    # saturated, not-too-dark pixels: candle bodies/wicks and coloured indicator lines
+    _, sat, val = sm.convert("HSV").split()
+    return ImageChops.multiply(sat.point(lambda x: 255 if x > 80 else 0), val.point(lambda x: 255 if x > 60 else 0))
+
+def detect_chart_region(img, sm=None):
+    # Plot area + price axis from cheap colour statistics on a small thumbnail: candles are the
+    # saturated pixels; the pane is the run of rows/columns around them that share the chart
+    # background. Toolbars, phone status/nav bars and watchlists fall outside it.
+    W, H = img.size
+    if sm is None:
+        sm = _chart_thumbnail(img)
+    sw, sh = sm.size
+
+    candles = _candle_mask(sm)
+    rows = candles.resize((1, sh), Image.BOX).tobytes()
+    cols = candles.resize((sw, 1), Image.BOX).tobytes()
+    r = _active_span(rows, 3, max(2, sh // 25))
+    c = _active_span(cols, 3, max(2, sw // 25))
+    if r is None or c is None:
+        return None
+
+    bg = tuple(int(x) for x in ImageStat.Stat(sm.crop((c[0], r[0], c[1], r[1]))).median)
+    diff = ImageChops.difference(sm, Image.new("RGB", sm.size, bg)).convert("L")
+    pane = diff.point(lambda x: 255 if x < 10 else 0)
+    r = _grow_span(pane.resize((1, sh), Image.BOX).tobytes(), r, 110, 2)
+    c = _grow_span(pane.resize((sw, 1), Image.BOX).tobytes(), c, 110, 2)
+
+    box = (
+        max(0, int((c[0] - 1) * W / sw)), max(0, int((r[0] - 1) * H / sh)),
+        min(W, int(math.ceil((c[1] + 1) * W / sw))), min(H, int(math.ceil((r[1] + 1) * H / sh))),
+    )
+    frac = (box[2] - box[0]) * (box[3] - box[1]) / float(W * H)
+    if frac < 0.15 or frac > 0.95:
+        return None  # detection unsure, or nothing worth cropping
+    return box
+
+def chart_features(sm):
+    # Cheap whole-image features on the 192 px thumbnail (a few ms):
+    #   bg     share of the most common coarse colour (charts: one flat background)
+    #   sat    share of saturated pixels (photos: most of the frame; charts: only the candles)
+    #   edges  share of pixels on a luminance step (blank screens: ~0)
+    #   thin   saturated pixels continuing vertically without a horizontal neighbour (wicks,
+    #          bodies, separated by gaps) vs. blobs that continue both ways (faces, objects)
+    #   cover  share of columns holding any saturated pixel (candles span the time axis)
+    w, h = sm.size
+    n = float(w * h)
+    counts = sorted((c for c, _ in sm.point(lambda x: x & 0xC0).getcolors(64)), reverse=True)
+
+    g = sm.convert("L")
+    dx = ImageChops.difference(g, ImageChops.offset(g, 1, 0))
+    dy = ImageChops.difference(g, ImageChops.offset(g, 0, 1))
+    edges = ImageChops.lighter(dx, dy).point(lambda x: 255 if x > 24 else 0).histogram()[255]
+
+    m = _candle_mask(sm)
+    vert = ImageChops.multiply(m, ImageChops.offset(m, 0, 1))
+    blob = ImageChops.multiply(vert, ImageChops.lighter(ImageChops.offset(m, 1, 0), ImageChops.offset(m, -1, 0)))
+    nv = vert.histogram()[255]
+    cover = sum(1 for v in m.resize((w, 1), Image.BOX).tobytes() if v) / float(w)
+    return {
+        "bg": counts[0] / n,
+        "sat": m.histogram()[255] / n,
+        "edges": edges / n,
+        "thin": (nv - blob.histogram()[255]) / float(max(1, nv)),
+        "cover": cover,
+    }
+
+def chart_score(f):
+    # 0..1; candle-like marks dominate, a flat background and low overall saturation support
+    clamp = lambda x: max(0.0, min(1.0, x))
+    marks = clamp(f["thin"] / 0.15) * clamp(f["cover"] / 0.4)
+    score = 0.55 * marks + 0.25 * clamp((f["bg"] - 0.3) / 0.4) + 0.2 * clamp((0.4 - f["sat"]) / 0.3)
+    return score * clamp(f["edges"] / 0.01)  # nothing drawn at all: not a chart
+
+def prepare_chart_image(image_bytes, max_side=1100, quality=85):
+    if not IMAGE_AUTOCROP:
+        img = _downscale_rgb(image_bytes, max_side)
+        score = chart_score(chart_features(_chart_thumbnail(img)))
+        return {"b64": _jpeg_base64(img, quality), "phash": image_phash(img), "size": img.size, "crop": None,
+                "chart_score": score}
+    img = _downscale_rgb(image_bytes, max_side * 2, exact=False)  # headroom so the crop keeps its resolution
+    full_scale = min(1.0, float(max_side) / max(img.size))
+    sm = _chart_thumbnail(img)
+    score = chart_score(chart_features(sm))
+    box = detect_chart_region(img, sm)
+    if box is not None:
+        img = img.crop(box)
+    size = token_aligned_size(img.size[0], img.size[1], max_side, full_scale)
+    if size != img.size:
+        img = img.resize(size, Image.BILINEAR, reducing_gap=3.0)
+    return {"b64": _jpeg_base64(img, quality), "phash": image_phash(img), "size": img.size, "crop": box,
+            "chart_score": score}
+
+_PREPROCESS_POOL = None
+
+def preprocess_pool():
+    # Image decode/resize/encode never runs on the event loop.
+    global _PREPROCESS_POOL
+    if _PREPROCESS_POOL is None:
+        if PREPROCESS_POOL == "thread":
+            _PREPROCESS_POOL = concurrent.futures.ThreadPoolExecutor(PREPROCESS_WORKERS, thread_name_prefix="preprocess")
+        else:
+            _PREPROCESS_POOL = concurrent.futures.ProcessPoolExecutor(PREPROCESS_WORKERS)
+    return _PREPROCESS_POOL
+
+def shutdown_preprocess_pool():
+    global _PREPROCESS_POOL
+    if _PREPROCESS_POOL is not None:
+        _PREPROCESS_POOL.shutdown(wait=True, cancel_futures=True)
+        _PREPROCESS_POOL = None
+
+async def run_preprocess(fn, *args):
+    return await asyncio.get_running_loop().run_in_executor(preprocess_pool(), fn, *args)
+
+class VisionError(RuntimeError):
+    # retryable: 429 / 5xx / timeouts / connection errors
+    def __init__(self, message, status=0, retryable=False, retry_after=None, outcome="error"):
+        super().__init__(message)
+        self.status = status
+        self.retryable = retryable
+        self.retry_after = retry_after
+        self.outcome = outcome
+
+def _vision_http_error(status, headers, body):
+    retry_after = None
+    try:
+        if headers.get("retry-after-ms"):
+            retry_after = float(headers["retry-after-ms"]) / 1000.0
+        elif headers.get("retry-after"):
+            retry_after = float(headers["retry-after"])
+    except ValueError:
+        pass
+    retryable = status == 429 or status >= 500
+    outcome = "http_429" if status == 429 else ("http_5xx" if status >= 500 else "http_4xx")
+    return VisionError(f"OpenAI error {status}: {body[:300]}", status, retryable, retry_after, outcome)
+
+_OPENAI_CLIENT = None
+
+def openai_client():
+    # One pooled client per process: keep-alive (HTTP/2 when h2 is installed), bounded sockets.
+    global _OPENAI_CLIENT
+    if _OPENAI_CLIENT is None or _OPENAI_CLIENT.is_closed:
+        http2 = OPENAI_HTTP2
+        if http2:
+            try:
+                import h2  # noqa: F401
+            except ImportError:
+                http2 = False
+        _OPENAI_CLIENT = httpx.AsyncClient(
+            base_url=OPENAI_BASE_URL,
+            headers={"Authorization": f"Bearer {OPENAI_API_KEY}"},
+            http2=http2,
+            timeout=httpx.Timeout(OPENAI_TIMEOUT, connect=OPENAI_CONNECT_TIMEOUT),
+            limits=httpx.Limits(
+                max_connections=OPENAI_MAX_CONNECTIONS,
+                max_keepalive_connections=OPENAI_MAX_KEEPALIVE,
+                keepalive_expiry=OPENAI_KEEPALIVE_EXPIRY,
+            ),
+        )
+    return _OPENAI_CLIENT
+
+async def close_openai_client():
+    global _OPENAI_CLIENT
+    if _OPENAI_CLIENT is not None:
+        await _OPENAI_CLIENT.aclose()
+        _OPENAI_CLIENT = None
+
+# Strict structured output: compact keys and enums keep the model's answer to ~40 tokens.
+# TP1-TP3 are not requested (enforce_tp_rules derives them from the entry zone).
+TIMEFRAMES = ("M1", "M5", "M15", "M30", "H1", "H4", "D1")
+
+SIGNAL_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "sym": {"type": "string", "description": "symbol shown on the chart, e.g. XAUUSD; empty if not visible"},
+        "tf": {"type": "string", "enum": [""] + list(TIMEFRAMES), "description": "timeframe; empty if not visible"},
+        "ms": {"type": "string", "enum": ["U", "D", "N"], "description": "market state: U bullish, D bearish, N neutral"},
+        "sig": {"type": "string", "enum": ["B", "S"], "description": "B buy, S sell"},
+        "c": {"type": "integer", "description": "confidence 0-100"},
+        "e": {"type": "string", "description": "entry zone in chart prices, e.g. '4420.0 - 4424.0' or 'Breakout above 4435.0'"},
+        "sl": {"type": "string", "description": "stop-loss price"},
+    },
+    "required": ["sym", "tf", "ms", "sig", "c", "e", "sl"],
+    "additionalProperties": False,
+}
+
+def _enum_field(mapping):
+    return lambda v: mapping[v]
+
+def _text_field(v):
+    if not isinstance(v, str):
+        raise TypeError(v)
+    return v.strip()[:64]
+
+def _int_field(v):
+    if isinstance(v, bool) or not isinstance(v, (int, float)):
+        raise TypeError(v)
+    return max(0, min(100, int(v)))
+
+# wire key -> (result key, converter); result keys are what the rest of the bot reads
+_SIGNAL_FIELDS = {
+    "sym": ("symbol", lambda v: _text_field(v).upper()),
+    "tf": ("timeframe", _enum_field({tf: tf for tf in ("",) + TIMEFRAMES})),
+    "ms": ("market_state", _enum_field({"U": "Bullish", "D": "Bearish", "N": "Neutral"})),
+    "sig": ("signal", _enum_field({"B": "BUY", "S": "SELL"})),
+    "c": ("confidence", _int_field),
+    "e": ("entry_zone", lambda v: _text_field(v) or "N/A"),
+    "sl": ("sl", lambda v: _text_field(v) or "N/A"),
+}
+
+def decode_signal(raw, partial=False):
+    # The one decoder for model output. Complete output must match SIGNAL_SCHEMA exactly;
+    # partial=True (streamed fields so far) keeps whatever already decodes and skips the rest.
+    if not isinstance(raw, dict):
+        raise VisionError("Model output is not a JSON object", outcome="invalid")
+    out = {}
+    for key, (name, conv) in _SIGNAL_FIELDS.items():
+        if key not in raw:
+            if partial:
+                continue
+            raise VisionError(f"Model output missing '{key}'", outcome="invalid")
+        try:
+            out[name] = conv(raw[key])
+        except (KeyError, TypeError, ValueError):
+            if partial:
+                continue
+            raise VisionError(f"Model output has invalid '{key}': {str(raw[key])[:40]}", outcome="invalid")
+    return out
+
+async def openai_analyze_chart(b64jpeg, on_partial=None):
+    backend = vision_backend()
+    if backend.needs_api_key and not OPENAI_API_KEY:
         raise RuntimeError("Missing OPENAI_API_KEY")
 
-    # IMPORTANT: We keep core analysis same, just add symbol/timeframe extraction if visible
     prompt = (
-        "You are a trading assistant analyzing a chart screenshot.\n"
-        "Return STRICT JSON ONLY (no markdown, no extra text) with these keys:\n"
-        "symbol: string like 'XAUUSD' or 'EURUSD' or 'BTCUSD' (best guess from chart; if unknown return empty string)\n"
-        "timeframe: string like 'M1','M5','M15','M30','H1','H4','D1' (best guess from chart; if unknown empty)\n"
-        "market_state: one of ['Bullish','Bearish','Neutral']\n"
-        "signal: one of ['BUY','SELL'] (NEVER return WAIT)\n"
-        "confidence: integer 0-100\n"
-        "entry_zone: string like '4420.0 - 4424.0' or 'Breakout above 4435.0'\n"
-        "tp1,tp2,tp3: strings (price levels)\n"
-        "sl: string (price level)\n"
-        "caution: short string\n"
-        "reasoning_short: short 1-2 lines\n\n"
+        "You are a trading assistant analyzing a chart screenshot. Fill in the schema.\n"
         "Rules:\n"
-        "- If chart is unclear, still give a CONDITIONAL setup (breakout/breakdown) and lower confidence.\n"
-        "- Use visible prices from chart when possible.\n"
-        "- Keep TP/SL realistic relative to entry.\n"
-        "- Do NOT mention policy, do NOT mention that you are an AI.\n"
+        "- Always pick B or S (never wait). If the chart is unclear, give a conditional "
+        "breakout/breakdown entry and lower confidence.\n"
+        "- Use prices visible on the chart; keep the stop-loss realistic relative to the entry.\n"
+        "- Read symbol and timeframe from the chart header when visible.\n"
     )
 
-    url = "https://api.openai.com/v1/responses"
-    headers = {
-        "Authorization": f"Bearer {OPENAI_API_KEY}",
-        "Content-Type": "application/json",
-    }
-
     payload = {
         "model": MODEL_VISION,
         "input": [
@@ -509,70 +1819,955 @@ def openai_analyze_chart(b64jpeg):
                 ],
             }
         ],
-        "max_output_tokens": 500,
+        "text": {"format": {"type": "json_schema", "name": "chart_signal", "strict": True, "schema": SIGNAL_SCHEMA}},
+        "max_output_tokens": OPENAI_MAX_OUTPUT_TOKENS,
     }
 
-    r = requests.post(url, headers=headers, json=payload, timeout=60)
-    if r.status_code >= 400:
-        raise RuntimeError(f"OpenAI error {r.status_code}: {r.text}")
+    if on_partial is not None:
+        payload["stream"] = True
+    out_text, usage = await backend.complete(payload, on_partial)
+    out_text = (out_text or "").strip()
+    if not out_text:
+        raise VisionError("Empty OpenAI output", outcome="invalid")
 
-    data = r.json()
+    with STAGE_SECONDS.time("parse"):
+        try:
+            raw = json.loads(out_text)
+        except ValueError:
+            raise VisionError(f"Invalid JSON from model: {out_text[:300]}", outcome="invalid")
+        result = decode_signal(raw)
+    usage = usage or {}
+    result["usage"] = {"input_tokens": int(usage.get("input_tokens") or 0),
+                       "output_tokens": int(usage.get("output_tokens") or 0)}
+    return result
 
+def _response_output_text(data):
     out_text = ""
     for item in data.get("output", []):
         for c in item.get("content", []):
             if c.get("type") in ("output_text", "text") and "text" in c:
                 out_text += c["text"]
+    return out_text
+
+# a completed "key": value pair inside a JSON object that is still being streamed (wire keys)
+_PARTIAL_FIELD_RE = re.compile(r'"(\w+)"\s*:\s*(?:"((?:[^"\\]|\\.)*)"|(-?\d+(?:\.\d+)?)\s*[,}\n])')
+
+def _partial_fields(text):
+    fields = {}
+    for m in _PARTIAL_FIELD_RE.finditer(text):
+        key, sval, nval = m.group(1), m.group(2), m.group(3)
+        if sval is not None:
+            try:
+                fields[key] = json.loads(f'"{sval}"')
+            except ValueError:
+                fields[key] = sval
+        else:
+            fields[key] = float(nval) if "." in nval else int(nval)
+    return fields
+
+async def _consume_sse(lines, on_partial):
+    # Responses API server-sent events -> (output text, usage).
+    # on_partial(fields) fires each time another field completes.
+    out_text = ""
+    n_fields = 0
+    async for line in lines:
+        if not line.startswith("data:"):
+            continue
+        data = line[5:].strip()
+        if not data or data == "[DONE]":
+            continue
+        ev = json.loads(data)
+        etype = ev.get("type", "")
+        if etype == "response.output_text.delta":
+            out_text += ev.get("delta", "")
+            fields = _partial_fields(out_text)
+            if len(fields) > n_fields and on_partial is not None:
+                n_fields = len(fields)
+                try:
+                    await on_partial(decode_signal(fields, partial=True))
+                except Exception:
+                    pass
+        elif etype == "response.completed":
+            resp = ev.get("response", {})
+            return (_response_output_text(resp) or out_text), resp.get("usage")
+        elif etype in ("response.failed", "response.incomplete", "error"):
+            err = ev.get("response", {}).get("error") or ev.get("error") or ev.get("message") or etype
+            raise VisionError(f"OpenAI stream error: {str(err)[:300]}", retryable=True, outcome="stream_error")
+    return out_text, None
 
-    out_text = (out_text or "").strip()
-    if not out_text:
-        raise RuntimeError("Empty OpenAI output")
+# ============================================================
+# Vision backends (VISION_BACKEND=openai | mock)
+# ============================================================
+class ResponsesHTTPBackend:
+    # Responses API over HTTP: OpenAI itself, or anything speaking the same protocol
+    # (e.g. `python bot.py mock-server` with OPENAI_BASE_URL=http://127.0.0.1:8765/v1).
+    needs_api_key = True
+
+    async def complete(self, payload, on_partial=None):
+        # -> (output text, usage)
+        if not payload.get("stream"):
+            r = await openai_client().post("/responses", json=payload)
+            if r.status_code >= 400:
+                raise _vision_http_error(r.status_code, r.headers, r.text)
+            data = r.json()
+            return _response_output_text(data), data.get("usage")
+        async with openai_client().stream("POST", "/responses", json=payload) as r:
+            if r.status_code >= 400:
+                body = (await r.aread()).decode("utf-8", "replace")
+                raise _vision_http_error(r.status_code, r.headers, body)
+            return await _consume_sse(r.aiter_lines(), on_partial)
+
+class MockVisionBackend:
+    # In-process mock: same payload in, same response shapes out, no sockets.
+    needs_api_key = False
+
+    def __init__(self, responder=None):
+        self.responder = responder or MockResponder()
+
+    async def complete(self, payload, on_partial=None):
+        plan = self.responder.respond(payload)
+        if "error" in plan:
+            await asyncio.sleep(plan["delay"])
+            headers = {"retry-after": str(plan["retry_after"])} if plan.get("retry_after") else {}
+            raise _vision_http_error(plan["status"], headers, json.dumps(plan["error"]))
+        if not payload.get("stream"):
+            await asyncio.sleep(plan["delay"])
+            return _response_output_text(plan["response"]), plan["response"].get("usage")
+
+        async def lines():
+            for delay, event in self.responder.sse_events(plan):
+                await asyncio.sleep(delay)
+                yield "data: " + json.dumps(event)
+        return await _consume_sse(lines(), on_partial)
+
+_VISION_BACKEND = None
+
+def vision_backend():
+    global _VISION_BACKEND
+    if _VISION_BACKEND is None:
+        _VISION_BACKEND = MockVisionBackend() if VISION_BACKEND == "mock" else ResponsesHTTPBackend()
+    return _VISION_BACKEND
 
+# ============================================================
+# Mock Responses API (deterministic; load tests and dry runs)
+# ============================================================
+def _latency_sampler(spec):
+    # "const:0.8" | "uniform:0.3,2.0" | "exp:1.0" | "lognormal:MU,SIGMA" (seconds)
+    kind, _, args = (spec or "const:0").partition(":")
+    vals = [float(x) for x in args.split(",") if x.strip()] or [0.0]
+    kind = kind.strip().lower()
+    if kind == "uniform":
+        return lambda rng: rng.uniform(vals[0], vals[1])
+    if kind == "exp":
+        return lambda rng: rng.expovariate(1.0 / vals[0]) if vals[0] > 0 else 0.0
+    if kind == "lognormal":
+        return lambda rng: rng.lognormvariate(vals[0], vals[1] if len(vals) > 1 else 0.5)
+    return lambda rng: vals[0]
+
+class MockResponder:
+    # Deterministic stand-in for the vision model: the analysis is derived from a hash of the
+    # image, and latency / error / malformed-output draws come from a seeded RNG.
+    SYMBOLS = [("XAUUSD", 2350.0, 1), ("EURUSD", 1.0850, 4), ("BTCUSD", 64000.0, 0), ("GBPUSD", 1.2700, 4)]
+    TIMEFRAMES = ["M5", "M15", "M30", "H1", "H4", "D1"]
+
+    def __init__(self, latency=None, error_rate=None, malformed_rate=None, seed=None):
+        self.sample_latency = _latency_sampler(MOCK_LATENCY if latency is None else latency)
+        self.error_rate = MOCK_ERROR_RATE if error_rate is None else error_rate
+        self.malformed_rate = MOCK_MALFORMED_RATE if malformed_rate is None else malformed_rate
+        self.rng = random.Random(MOCK_SEED if seed is None else seed)
+        self.n = 0
+
+    @staticmethod
+    def _image_digest(payload):
+        for item in payload.get("input", []):
+            for c in item.get("content", []):
+                if c.get("type") == "input_image":
+                    return hashlib.sha256(c.get("image_url", "").encode("utf-8")).digest()
+        return hashlib.sha256(b"").digest()
+
+    def analysis(self, payload):
+        d = self._image_digest(payload)
+        sym, base, digits = self.SYMBOLS[d[0] % len(self.SYMBOLS)]
+        sig = "BUY" if d[1] % 2 == 0 else "SELL"
+        conf = 45 + d[2] % 50
+        step = 10 ** -digits if digits else 1.0
+        px = base * (1 + ((d[3] - 128) / 128.0) * 0.02)
+        lo, hi = px, px + 20 * step
+        sl = lo - 60 * step if sig == "BUY" else hi + 60 * step
+        fmt = "{:." + str(digits) + "f}"
+        return {
+            "sym": sym,
+            "tf": self.TIMEFRAMES[d[4] % len(self.TIMEFRAMES)],
+            "ms": "U" if sig == "BUY" else "D",
+            "sig": sig[0],
+            "c": conf,
+            "e": f"{fmt.format(lo)} - {fmt.format(hi)}",
+            "sl": fmt.format(sl),
+        }
+
+    def respond(self, payload):
+        self.n += 1
+        rng = self.rng
+        delay = max(0.0, self.sample_latency(rng))
+        if rng.random() < self.error_rate:
+            status = rng.choice([429, 500, 502, 503])
+            return {
+                "delay": min(delay, 0.2),
+                "status": status,
+                "retry_after": 1 if status == 429 else None,
+                "error": {"error": {"message": f"mock error {status}", "type": "server_error"}},
+            }
+        text = json.dumps(self.analysis(payload), separators=(",", ":"))
+        if rng.random() < self.malformed_rate:
+            # truncated JSON, or JSON wrapped in prose (what strict structured output rules out)
+            text = text[: rng.randrange(1, len(text) - 1)] if rng.random() < 0.5 else f"Sure! Here it is: {text} Hope it helps."
+        response = {
+            "id": f"resp_mock_{self.n}",
+            "object": "response",
+            "status": "completed",
+            "model": payload.get("model", "mock"),
+            "output": [{
+                "type": "message",
+                "role": "assistant",
+                "content": [{"type": "output_text", "text": text}],
+            }],
+            "usage": {
+                "input_tokens": len(json.dumps(payload)) // 1000 + 85,
+                "output_tokens": max(1, len(text) // 4),
+            },
+        }
+        return {"delay": delay, "status": 200, "text": text, "response": response}
+
+    def sse_events(self, plan, chunk=12):
+        # (delay_before, event) pairs; first token after ~30% of the latency, rest spread evenly
+        text = plan["text"]
+        parts = [text[i:i + chunk] for i in range(0, len(text), chunk)] or [""]
+        first = plan["delay"] * 0.3
+        each = (plan["delay"] - first) / len(parts)
+        yield 0.0, {"type": "response.created", "response": {"id": plan["response"]["id"], "status": "in_progress"}}
+        for i, part in enumerate(parts):
+            yield (first if i == 0 else each), {"type": "response.output_text.delta", "delta": part}
+        yield 0.0, {"type": "response.completed", "response": plan["response"]}
+
+async def _mock_http_send(writer, status, body, content_type="application/json", headers=None):
+    reason = {200: "OK", 400: "Bad Request", 404: "Not Found", 429: "Too Many Requests"}.get(status, "Error")
+    head = [f"HTTP/1.1 {status} {reason}", f"Content-Type: {content_type}", f"Content-Length: {len(body)}"]
+    head += [f"{k}: {v}" for k, v in (headers or {}).items()]
+    writer.write(("\r\n".join(head) + "\r\n\r\n").encode("utf-8") + body)
+    await writer.drain()
+
+async def _mock_http_conn(reader, writer, responder):
+    # Minimal HTTP/1.1 keep-alive server for POST /v1/responses (plain JSON or SSE when stream=true)
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            method, path = line.decode("latin-1").split(" ")[:2]
+            headers = {}
+            while True:
+                h = await reader.readline()
+                if h in (b"\r\n", b"\n", b""):
+                    break
+                k, _, v = h.decode("latin-1").partition(":")
+                headers[k.strip().lower()] = v.strip()
+            body = await reader.readexactly(int(headers.get("content-length", "0") or 0))
+
+            if method == "GET" and path.rstrip("/") in ("", "/health"):
+                await _mock_http_send(writer, 200, b'{"ok":true}')
+                continue
+            if method != "POST" or not path.rstrip("/").endswith("/responses"):
+                await _mock_http_send(writer, 404, b'{"error":{"message":"not found"}}')
+                continue
+            try:
+                payload = json.loads(body)
+            except ValueError:
+                await _mock_http_send(writer, 400, b'{"error":{"message":"invalid json"}}')
+                continue
+
+            plan = responder.respond(payload)
+            if "error" in plan:
+                await asyncio.sleep(plan["delay"])
+                extra = {"Retry-After": str(plan["retry_after"])} if plan.get("retry_after") else None
+                await _mock_http_send(writer, plan["status"], json.dumps(plan["error"]).encode("utf-8"), headers=extra)
+            elif not payload.get("stream"):
+                await asyncio.sleep(plan["delay"])
+                await _mock_http_send(writer, 200, json.dumps(plan["response"]).encode("utf-8"))
+            else:
+                writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nTransfer-Encoding: chunked\r\n\r\n")
+                for delay, event in responder.sse_events(plan):
+                    await asyncio.sleep(delay)
+                    chunk = f"event: {event['type']}\ndata: {json.dumps(event)}\n\n".encode("utf-8")
+                    writer.write(f"{len(chunk):x}\r\n".encode("ascii") + chunk + b"\r\n")
+                    await writer.drain()
+                writer.write(b"0\r\n\r\n")
+                await writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+        pass
+    finally:
+        writer.close()
+
+async def run_mock_server(host="127.0.0.1", port=8765, responder=None):
+    responder = responder or MockResponder()
+    server = await asyncio.start_server(lambda r, w: _mock_http_conn(r, w, responder), host, port)
+    print(f"✅ Mock Responses API on http://{host}:{port}/v1/responses")
+    async with server:
+        await server.serve_forever()
+
+# ============================================================
+# Vision resilience (retry / hedge / circuit breaker)
+# ============================================================
+class LatencyTracker:
+    # Rolling window of successful attempt latencies -> p50/p95/p99 and the hedge threshold
+    def __init__(self, size=1000):
+        self._samples = deque(maxlen=size)
+
+    def record(self, seconds):
+        self._samples.append(seconds)
+
+    def count(self):
+        return len(self._samples)
+
+    def percentile(self, p):
+        if not self._samples:
+            return None
+        xs = sorted(self._samples)
+        return xs[min(len(xs) - 1, int(round(p / 100.0 * (len(xs) - 1))))]
+
+class CircuitBreaker:
+    # closed -> open after CIRCUIT_FAILURES consecutive provider failures;
+    # after CIRCUIT_COOLDOWN one probe is let through (half-open); its outcome closes or re-opens.
+    def __init__(self, failures, cooldown):
+        self.failures = failures
+        self.cooldown = cooldown
+        self._count = 0
+        self._opened_at = None
+        self._probing = False
+
+    @property
+    def state(self):
+        if self._opened_at is None:
+            return "closed"
+        if time.monotonic() - self._opened_at >= self.cooldown:
+            return "half_open"
+        return "open"
+
+    def check(self):
+        state = self.state
+        if state == "open" or (state == "half_open" and self._probing):
+            stat_incr("vision_circuit_rejected")
+            raise VisionError("Vision backend unavailable (circuit open)", status=503, outcome="circuit_open")
+        if state == "half_open":
+            self._probing = True
+
+    def success(self):
+        self._count = 0
+        self._opened_at = None
+        self._probing = False
+
+    def release_probe(self):
+        # the probe ended without a verdict (cancelled, unexpected error): let the next call probe
+        self._probing = False
+
+    def failure(self):
+        self._count += 1
+        self._probing = False
+        if self._count >= self.failures or self._opened_at is not None:
+            if self._opened_at is None:
+                stat_incr("vision_circuit_opened")
+            self._opened_at = time.monotonic()
+
+VISION_LATENCY = LatencyTracker()
+VISION_BREAKER = CircuitBreaker(CIRCUIT_FAILURES, CIRCUIT_COOLDOWN)
+
+async def _vision_attempt(b64jpeg, on_partial):
+    t0 = time.monotonic()
+    outcome = "ok"
     try:
-        parsed = json.loads(out_text)
+        return await openai_analyze_chart(b64jpeg, on_partial=on_partial)
+    except VisionError as e:
+        outcome = e.outcome
+        raise
+    except httpx.TimeoutException as e:
+        outcome = "timeout"
+        raise VisionError(f"OpenAI timeout: {type(e).__name__}", retryable=True, outcome=outcome) from e
+    except httpx.TransportError as e:
+        outcome = "network"
+        raise VisionError(f"OpenAI connection error: {type(e).__name__}", retryable=True, outcome=outcome) from e
+    except asyncio.CancelledError:
+        outcome = "cancelled"
+        raise
     except Exception:
-        m = re.search(r"\{.*\}", out_text, re.S)
-        if not m:
-            raise RuntimeError(f"Invalid JSON from model: {out_text[:300]}")
-        parsed = json.loads(m.group(0))
-
-    # defaults
-    parsed.setdefault("symbol", "")
-    parsed.setdefault("timeframe", "")
-    parsed.setdefault("market_state", "Neutral")
-    parsed.setdefault("signal", "BUY")
-    parsed.setdefault("confidence", 50)
-    parsed.setdefault("entry_zone", "N/A")
-    parsed.setdefault("tp1", "N/A")
-    parsed.setdefault("tp2", "N/A")
-    parsed.setdefault("tp3", "N/A")
-    parsed.setdefault("sl", "N/A")
-    parsed.setdefault("caution", "Use risk management.")
-    parsed.setdefault("reasoning_short", "")
-
-    # sanitize
+        outcome = "invalid"
+        raise
+    finally:
+        dt = time.monotonic() - t0
+        stat_incr(f"vision_attempts_{outcome}")
+        VISION_SECONDS.observe(dt, outcome)
+        if outcome == "ok":
+            VISION_LATENCY.record(dt)
+
+async def _vision_hedged(b64jpeg, on_partial):
+    # Fire a second (non-streamed) request once the primary is slower than the configured
+    # latency percentile; the first success wins and the other request is cancelled.
+    threshold = None
+    if OPENAI_HEDGE_PERCENTILE > 0 and VISION_LATENCY.count() >= OPENAI_HEDGE_MIN_SAMPLES:
+        threshold = VISION_LATENCY.percentile(OPENAI_HEDGE_PERCENTILE)
+    if threshold is None:
+        return await _vision_attempt(b64jpeg, on_partial)
+
+    pending = {asyncio.ensure_future(_vision_attempt(b64jpeg, on_partial))}
+    try:
+        done, pending = await asyncio.wait(pending, timeout=threshold)
+        if done:
+            return done.pop().result()
+        stat_incr("vision_hedges")
+        pending.add(asyncio.ensure_future(_vision_attempt(b64jpeg, None)))
+        error = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for t in done:
+                if t.exception() is None:
+                    return t.result()
+                error = t.exception()
+        raise error
+    finally:
+        for t in pending:
+            t.cancel()
+
+async def call_vision(b64jpeg, on_partial=None):
+    # Retries 429/5xx/timeouts with full-jitter exponential backoff, honoring Retry-After.
+    for attempt in range(OPENAI_MAX_RETRIES + 1):
+        VISION_BREAKER.check()
+        try:
+            result = await _vision_hedged(b64jpeg, on_partial)
+        except VisionError as e:
+            if e.retryable:
+                VISION_BREAKER.failure()
+            # 4xx / unusable replies say nothing about provider health: breaker state is left as is
+            if not e.retryable or attempt >= OPENAI_MAX_RETRIES:
+                raise
+            delay = random.uniform(0, min(OPENAI_BACKOFF_MAX, OPENAI_BACKOFF_BASE * (2 ** attempt)))
+            if e.retry_after is not None:
+                delay = max(delay, min(e.retry_after, OPENAI_TIMEOUT))
+            stat_incr("vision_retries")
+            await asyncio.sleep(delay)
+        else:
+            VISION_BREAKER.success()
+            return result
+        finally:
+            VISION_BREAKER.release_probe()
+
+# ============================================================
+# Stats (admin: /stats) and metrics (/metrics)
+# ============================================================
+STATS = {}
+
+def stat_incr(name, n=1):
+    STATS[name] = STATS.get(name, 0) + n
+
+def stat_set(name, value):
+    STATS[name] = value
+
+def stat_max(name, value):
+    if value > STATS.get(name, 0):
+        STATS[name] = value
+
+# Prometheus text exposition (GET /metrics) of the metrics below plus every STATS key.
+# Hot-path cost is a dict lookup, a bisect and two adds per observation (no locks: the
+# event loop is the only writer).
+def _metric_labels(names, values):
+    if not names:
+        return ""
+    esc = lambda v: str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return "{" + ",".join(f'{n}="{esc(v)}"' for n, v in zip(names, values)) + "}"
+
+class Counter:
+    def __init__(self, name, doc, labels=()):
+        self.name, self.doc, self.labels = name, doc, tuple(labels)
+        self._values = {}  # label values -> count
+
+    def inc(self, *values, n=1):
+        self._values[values] = self._values.get(values, 0) + n
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} counter"]
+        for values, v in sorted(self._values.items()):
+            lines.append(f"{self.name}{_metric_labels(self.labels, values)} {v}")
+        return lines
+
+class Gauge:
+    def __init__(self, name, doc):
+        self.name, self.doc = name, doc
+        self.value = 0
+
+    def inc(self, n=1):
+        self.value += n
+
+    def dec(self, n=1):
+        self.value -= n
+
+    def render(self):
+        return [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} gauge", f"{self.name} {self.value}"]
+
+class Histogram:
+    def __init__(self, name, doc, buckets, labels=()):
+        self.name, self.doc, self.labels = name, doc, tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}  # label values -> [per-bucket counts (last = +Inf), sum]
+
+    def observe(self, seconds, *values):
+        s = self._series.get(values)
+        if s is None:
+            s = self._series[values] = [[0] * (len(self.buckets) + 1), 0.0]
+        s[0][bisect.bisect_left(self.buckets, seconds)] += 1
+        s[1] += seconds
+
+    def time(self, *values):
+        return _Timed(self, values)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} histogram"]
+        for values, (counts, total) in sorted(self._series.items()):
+            acc = 0
+            for le, c in zip(self.buckets + ("+Inf",), counts):
+                acc += c
+                lines.append(f"{self.name}_bucket{_metric_labels(self.labels + ('le',), values + (le,))} {acc}")
+            lines.append(f"{self.name}_sum{_metric_labels(self.labels, values)} {total}")
+            lines.append(f"{self.name}_count{_metric_labels(self.labels, values)} {acc}")
+        return lines
+
+class _Timed:
+    # `with HIST.time("stage"):` around sync or awaited code; also times failed attempts
+    __slots__ = ("hist", "values", "t0")
+
+    def __init__(self, hist, values):
+        self.hist, self.values = hist, values
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.hist.observe(time.perf_counter() - self.t0, *self.values)
+        return False
+
+_LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+
+STAGE_SECONDS = Histogram("tradingbot_stage_seconds", "handle_photo stage latency", _LATENCY_BUCKETS, ["stage"])
+ANALYSIS_SECONDS = Histogram("tradingbot_analysis_seconds", "handle_photo end to end", _LATENCY_BUCKETS, ["outcome"])
+VISION_SECONDS = Histogram("tradingbot_vision_attempt_seconds", "vision backend attempts", _LATENCY_BUCKETS, ["outcome"])
+DB_SECONDS = Histogram("tradingbot_db_seconds", "user store operations", _LATENCY_BUCKETS, ["op"])
+ANALYSES = Counter("tradingbot_analyses_total", "handle_photo outcomes", ["outcome"])
+ANALYSIS_ERRORS = Counter("tradingbot_analysis_errors_total", "handle_photo failures by exception type", ["type"])
+ANALYSES_IN_FLIGHT = Gauge("tradingbot_analyses_in_flight", "handle_photo calls past admission")
+METRICS = (STAGE_SECONDS, ANALYSIS_SECONDS, VISION_SECONDS, DB_SECONDS, ANALYSES, ANALYSIS_ERRORS, ANALYSES_IN_FLIGHT)
+
+def render_metrics():
+    lines = []
+    for m in METRICS:
+        lines += m.render()
+    for k in sorted(STATS):
+        v = STATS[k]
+        if isinstance(v, (int, float)):
+            name = "tradingbot_" + re.sub(r"[^a-zA-Z0-9_]", "_", k)
+            lines += [f"# TYPE {name} untyped", f"{name} {v}"]
+    lines.append(f"tradingbot_vision_circuit_open {int(VISION_BREAKER.state != 'closed')}")
+    return "\n".join(lines) + "\n"
+
+METRICS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+async def _metrics_conn(reader, writer):
+    # one request per connection: GET /metrics (polling mode; webhook mode serves it from `app`)
+    try:
+        line = await reader.readline()
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+            pass
+        parts = line.decode("latin-1").split(" ")
+        if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+            status, body, ctype = "200 OK", render_metrics().encode("utf-8"), METRICS_CONTENT_TYPE
+        else:
+            status, body, ctype = "404 Not Found", b"not found\n", "text/plain"
+        writer.write(f"HTTP/1.1 {status}\r\nContent-Type: {ctype}\r\nContent-Length: {len(body)}\r\n"
+                     f"Connection: close\r\n\r\n".encode("latin-1") + body)
+        await writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+async def start_metrics_server():
+    if not METRICS_PORT:
+        return None
+    server = await asyncio.start_server(_metrics_conn, METRICS_HOST, METRICS_PORT)
+    print(f"✅ Metrics on http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    return server
+
+# ============================================================
+# Analysis scheduler (admission control + priority queue)
+# ============================================================
+class AnalysisBusy(Exception):
+    # reason: "user_limit" | "queue_full" | "timeout"
+    def __init__(self, reason):
+        super().__init__(reason)
+        self.reason = reason
+
+async def _quietly(coroutine):
+    # best-effort side message: failures must not affect the caller
     try:
-        parsed["confidence"] = int(parsed["confidence"])
+        await coroutine
     except Exception:
-        parsed["confidence"] = 50
+        pass
+
+class AnalysisScheduler:
+    # Cap on this process's model calls in flight; waiters are served PAID first, then FIFO.
+    def __init__(self, max_concurrency, max_per_user, queue_max):
+        self.max_concurrency = max_concurrency
+        self.max_per_user = max_per_user
+        self.queue_max = queue_max
+        self._running = 0
+        self._seq = 0
+        self._heap = []  # [priority, seq, future]
+
+    def _gauges(self):
+        stat_set("scheduler_running", self._running)
+        stat_set("scheduler_queue_depth", len(self._heap))
+
+    async def enter_user(self, user_id):
+        # per-user limit counts analyses in flight on every replica (shared session store)
+        if await session_call("incr", f"inflight:{user_id}", 1, SESSION_TTL_INFLIGHT, limit=self.max_per_user) is None:
+            stat_incr("scheduler_rejected_user_limit")
+            raise AnalysisBusy("user_limit")
+
+    async def leave_user(self, user_id):
+        await session_call("incr", f"inflight:{user_id}", -1, SESSION_TTL_INFLIGHT)
+
+    async def acquire(self, paid, on_queued=None):
+        if self._running < self.max_concurrency and not self._heap:
+            self._running += 1
+            self._gauges()
+            return
+        if len(self._heap) >= self.queue_max:
+            stat_incr("scheduler_rejected_queue_full")
+            raise AnalysisBusy("queue_full")
+
+        prio = 0 if paid else 1
+        self._seq += 1
+        fut = asyncio.get_running_loop().create_future()
+        entry = [prio, self._seq, fut]
+        heapq.heappush(self._heap, entry)
+        self._gauges()
+
+        t0 = time.monotonic()
+        notify = None
+        if on_queued is not None:
+            # the queue-position message is sent beside the wait, never in front of it
+            pos = 1 + sum(1 for e in self._heap if e[:2] < entry[:2] and not e[2].done())
+            notify = asyncio.create_task(_quietly(on_queued(pos)))
+        try:
+            timeout = ANALYSIS_QUEUE_TIMEOUT_PAID if paid else ANALYSIS_QUEUE_TIMEOUT_FREE
+            await asyncio.wait({fut}, timeout=timeout)
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                self.release()  # release() already handed us the slot: pass it on
+            raise
+        finally:
+            if notify is not None and not notify.done():
+                notify.cancel()  # slot granted (or given up) first: a late position would be stale
+            if not fut.done():
+                fut.cancel()
+                self._heap.remove(entry)
+                heapq.heapify(self._heap)
+                self._gauges()
+
+        wait_ms = int((time.monotonic() - t0) * 1000)
+        stat_incr("scheduler_wait_count")
+        stat_incr("scheduler_wait_ms_total", wait_ms)
+        stat_max("scheduler_wait_ms_max", wait_ms)
+        if fut.cancelled():
+            stat_incr("scheduler_rejected_timeout")
+            raise AnalysisBusy("timeout")
+
+    def release(self):
+        while self._heap:
+            _, _, fut = heapq.heappop(self._heap)
+            if not fut.done():
+                fut.set_result(True)  # slot handed over; _running unchanged
+                self._gauges()
+                return
+        self._running -= 1
+        self._gauges()
+
+SCHEDULER = AnalysisScheduler(ANALYSIS_MAX_CONCURRENCY, ANALYSIS_MAX_PER_USER, ANALYSIS_QUEUE_MAX)
+
+# ============================================================
+# Analysis cache (LRU + TTL in memory, optional on-disk tier)
+# ============================================================
+class AnalysisCache:
+    def __init__(self, max_items, ttl, disk_dir="", near_distance=0, near_ttl=0):
+        self.max_items = max_items
+        self.ttl = ttl
+        self.disk_dir = disk_dir
+        self.near_distance = near_distance
+        self.near_ttl = near_ttl
+        self._mem = OrderedDict()  # key -> (expires_at, result)
+        self._puts = 0
+        # Recent hashes for near-duplicate lookups, indexed by near_distance + 1 bands: two
+        # hashes within near_distance bits agree exactly on at least one band (pigeonhole).
+        self._near = OrderedDict()  # phash -> created_at, oldest first
+        self._bands = {}  # (band, bits) -> set of phash
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, hashlib.sha1(key.encode("utf-8")).hexdigest() + ".json")
+
+    def _disk_get(self, key):
+        path = self._disk_path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                item = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if item.get("exp", 0) < time.time():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+        return item.get("v")
+
+    def _disk_put(self, key, value, expires_at):
+        path = self._disk_path(key)
+        tmp = f"{path}.tmp.{os.getpid()}"
+        try:
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump({"exp": expires_at, "v": value}, f, ensure_ascii=False)
+            os.replace(tmp, path)
+        except OSError:
+            pass
+
+    def prune_disk(self):
+        now = time.time()
+        for name in os.listdir(self.disk_dir):
+            path = os.path.join(self.disk_dir, name)
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    if json.load(f).get("exp", 0) >= now:
+                        continue
+            except (OSError, ValueError):
+                pass
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def _mem_get(self, key):
+        item = self._mem.get(key)
+        if item is None:
+            return None
+        if item[0] < time.time():
+            del self._mem[key]
+            return None
+        self._mem.move_to_end(key)
+        return item[1]
+
+    def _mem_put(self, key, value, expires_at):
+        self._mem[key] = (expires_at, value)
+        self._mem.move_to_end(key)
+        while len(self._mem) > self.max_items:
+            self._mem.popitem(last=False)
+
+    def get(self, key):
+        value = self._mem_get(key)
+        if value is None and self.disk_dir:
+            value = self._disk_get(key)
+            if value is not None:
+                stat_incr("analysis_cache_disk_hits")
+                self._mem_put(key, value, time.time() + self.ttl)
+        return dict(value) if value is not None else None
+
+    def _band_keys(self, phash):
+        n = self.near_distance + 1
+        width = -(-256 // n)
+        mask = (1 << width) - 1
+        return [(i, (phash >> (i * width)) & mask) for i in range(n)]
+
+    def _prune_near(self, now):
+        while self._near:
+            phash, created = next(iter(self._near.items()))
+            if now - created <= self.near_ttl:
+                break
+            del self._near[phash]
+            for band in self._band_keys(phash):
+                keys = self._bands.get(band)
+                if keys is not None:
+                    keys.discard(phash)
+                    if not keys:
+                        del self._bands[band]
+
+    def get_similar(self, phash):
+        # exact perceptual-hash hit first, then the nearest recent hash within near_distance bits
+        hit = self.get(f"p:{phash:064x}")
+        if hit is not None or self.near_distance <= 0 or self.near_ttl <= 0:
+            return hit
+        self._prune_near(time.time())
+        best, best_d = None, self.near_distance + 1
+        for band in self._band_keys(phash):
+            for other in self._bands.get(band, ()):
+                d = (other ^ phash).bit_count()
+                if d < best_d:
+                    best, best_d = other, d
+        return self.get(f"p:{best:064x}") if best is not None else None
+
+    def put(self, key, value):
+        expires_at = time.time() + self.ttl
+        value = dict(value)
+        self._mem_put(key, value, expires_at)
+        if self.disk_dir:
+            self._disk_put(key, value, expires_at)
+            self._puts += 1
+            if self._puts % 1000 == 0:
+                threading.Thread(target=self.prune_disk, daemon=True).start()
+
+    def put_phash(self, phash, value):
+        self.put(f"p:{phash:064x}", value)
+        if self.near_distance > 0 and self.near_ttl > 0:
+            now = time.time()
+            self._prune_near(now)
+            self._near.pop(phash, None)
+            self._near[phash] = now
+            for band in self._band_keys(phash):
+                self._bands.setdefault(band, set()).add(phash)
+
+ANALYSIS_CACHE = AnalysisCache(ANALYSIS_CACHE_SIZE, ANALYSIS_CACHE_TTL, ANALYSIS_CACHE_DIR,
+                               ANALYSIS_CACHE_PHASH_DISTANCE, ANALYSIS_CACHE_NEAR_TTL)
+
+# ============================================================
+# In-flight coalescing (single-flight)
+# ============================================================
+_INFLIGHT = {}  # key -> asyncio.Future shared by every concurrent caller
 
-    sig = str(parsed.get("signal", "BUY")).upper()
-    parsed["signal"] = "BUY" if sig not in ("BUY", "SELL") else sig
+async def single_flight(key, factory):
+    # The first caller for `key` runs factory(); concurrent callers await the same future.
+    while True:
+        fut = _INFLIGHT.get(key)
+        if fut is None:
+            break
+        stat_incr("analysis_coalesced")
+        try:
+            return dict(await asyncio.shield(fut))
+        except asyncio.CancelledError:
+            if not fut.cancelled():
+                raise
+            # the leader was cancelled: take over
+
+    fut = asyncio.get_running_loop().create_future()
+    _INFLIGHT[key] = fut
+    try:
+        result = await factory()
+    except asyncio.CancelledError:
+        fut.cancel()
+        raise
+    except Exception as e:
+        fut.set_exception(e)
+        fut.exception()  # mark retrieved; followers still receive it
+        raise
+    else:
+        fut.set_result(result)
+    finally:
+        _INFLIGHT.pop(key, None)
+    return dict(result)
+
+class NotAChart(Exception):
+    # the local gate rejected the image before the model call
+    def __init__(self, score):
+        super().__init__(f"not a chart (score {score:.2f})")
+        self.score = score
+
+async def analyze_chart(file_unique_id, download, paid=False, on_queued=None, on_partial=None, meta=None):
+    # Returns the raw model result (before TP rules). Lookup order:
+    # file_unique_id (no download needed) -> perceptual hash of the downscaled image -> model call.
+    # Images the local chart gate scores below CHART_GATE_THRESHOLD raise NotAChart instead.
+    # Concurrent requests for the same file or the same image share one in-flight analysis.
+    # Only the model call itself goes through SCHEDULER (cache hits are never queued).
+    # on_partial (streamed fields) only fires for the caller that actually runs the model call.
+    # meta (optional dict) receives "source" (file_cache | phash_cache | model | shared) and, for
+    # the caller that ran the model call, its token "usage".
+    meta = {} if meta is None else meta
+    meta["source"] = "shared"
+    file_key = f"f:{file_unique_id}"
+    result = ANALYSIS_CACHE.get(file_key)
+    if result is not None:
+        stat_incr("analysis_cache_hits_file")
+        meta["source"] = "file_cache"
+        return result
 
-    ms = str(parsed.get("market_state", "Neutral")).capitalize()
-    if ms not in ("Bullish", "Bearish", "Neutral"):
-        ms = "Neutral"
-    parsed["market_state"] = ms
+    async def by_file():
+        with STAGE_SECONDS.time("download"):
+            image_bytes = await download()
+        with STAGE_SECONDS.time("preprocess"):
+            prep = await run_preprocess(prepare_chart_image, image_bytes, 1100, 85)
+        if prep["chart_score"] < CHART_GATE_THRESHOLD:
+            stat_incr("chart_gate_rejects")
+            raise NotAChart(prep["chart_score"])
+
+        result = ANALYSIS_CACHE.get_similar(prep["phash"])
+        if result is not None:
+            stat_incr("analysis_cache_hits_phash")
+            meta["source"] = "phash_cache"
+        else:
+            result = await single_flight(f"p:{prep['phash']:064x}", lambda: by_image(prep))
+
+        ANALYSIS_CACHE.put(file_key, result)
+        return result
 
-    sym = str(parsed.get("symbol", "") or "").upper().strip()
-    tf = str(parsed.get("timeframe", "") or "").upper().strip()
-    # normalize timeframe
-    if tf and tf not in ("M1", "M5", "M15", "M30", "H1", "H4", "D1"):
-        tf = ""
-    parsed["symbol"] = sym
-    parsed["timeframe"] = tf
+    async def by_image(prep):
+        stat_incr("analysis_cache_misses")
+        with STAGE_SECONDS.time("queue_wait"):
+            await SCHEDULER.acquire(paid, on_queued)
+        try:
+            with STAGE_SECONDS.time("vision"):
+                result = await call_vision(prep["b64"], on_partial=on_partial)
+        finally:
+            SCHEDULER.release()
+        meta["source"], meta["usage"] = "model", result.pop("usage", None)
+        ANALYSIS_CACHE.put_phash(prep["phash"], result)
+        return result
+
+    return await single_flight(file_key, by_file)
 
-    return parsed
+# ============================================================
+# Telegram chart files (size selection + download buffers)
+# ============================================================
+def pick_photo_size(sizes, min_side=PHOTO_MIN_SIDE):
+    # Smallest PhotoSize whose long side reaches min_side; the largest when none does.
+    # Telegram keeps 90/320/800/1280/2560 px variants, so this usually skips the 2560 px one.
+    if not sizes:
+        return None
+    ordered = sorted(sizes, key=lambda p: (max(p.width, p.height), p.file_size or 0))
+    for p in ordered:
+        if max(p.width, p.height) >= min_side:
+            return p
+    return ordered[-1]
+
+def chart_file(msg):
+    # PhotoSize for compressed photos, Document for images sent as files (no smaller variants exist)
+    if msg.photo:
+        return pick_photo_size(msg.photo)
+    doc = getattr(msg, "document", None)
+    if doc is not None and (doc.mime_type or "").startswith("image/"):
+        return doc
+    return None
+
+async def download_chart_file(bot, f):
+    tg_file = await bot.get_file(f.file_id)
+    # Straight into a BytesIO: download_as_bytearray would build the payload and then copy it.
+    buf = BytesIO()
+    await tg_file.download_to_memory(buf)
+    data = buf.getvalue()
+    stat_incr("download_bytes", len(data))
+    return data
 
 # ============================================================
 # Fallback symbol/tf from caption (optional)
@@ -607,15 +2802,12 @@ def localize_signal(lang, sig):
     tt = T[lang]
     return tt["signal_buy"] if sig == "BUY" else tt["signal_sell"]
 
-def format_signal_message(lang, symbol, timeframe, result, trial_line):
+def _signal_head_lines(lang, symbol, timeframe, result):
     tt = T[lang]
 
     ms = result["market_state"]
     sig = result["signal"]
     conf = int(result.get("confidence", 50) or 50)
-    entry = str(result.get("entry_zone", "N/A") or "N/A")
-    tp1, tp2, tp3 = str(result.get("tp1", "N/A")), str(result.get("tp2", "N/A")), str(result.get("tp3", "N/A"))
-    sl = str(result.get("sl", "N/A"))
 
     # Emojis
     state_emoji = "📈" if ms == "Bullish" else ("📉" if ms == "Bearish" else "⏸️")
@@ -634,20 +2826,38 @@ def format_signal_message(lang, symbol, timeframe, result, trial_line):
     # ✅ PRO header
     header = tt["header"]
 
+    return [
+        header,
+        f"{sig_emoji} {sig_local} | {sym} | {tf} | {conf}%",
+        f"{state_emoji} {tt['market_state']}: {ms_local}",
+        f"🧭 {tt['market']}: {market_label}",
+    ]
+
+def _signal_level_lines(lang, result):
+    tt = T[lang]
+
+    entry = str(result.get("entry_zone", "N/A") or "N/A")
+    tp1, tp2, tp3 = str(result.get("tp1", "N/A")), str(result.get("tp2", "N/A")), str(result.get("tp3", "N/A"))
+    sl = str(result.get("sl", "N/A"))
+
+    return [
+        f"🎯 {tt['entry']}: {entry}",
+        f"✅ TP1: {tp1}",
+        f"✅ TP2: {tp2}",
+        f"✅ TP3: {tp3}",
+        f"🛑 {tt['sl']}: {sl}",
+    ]
+
+def format_signal_message(lang, symbol, timeframe, result, trial_line):
+    tt = T[lang]
+
     # ✅ Legal note (short, safe)
     legal_note = tt["legal_note"]
 
     lines = []
-    lines.append(header)
-    lines.append(f"{sig_emoji} {sig_local} | {sym} | {tf} | {conf}%")
-    lines.append(f"{state_emoji} {tt['market_state']}: {ms_local}")
-    lines.append(f"🧭 {tt['market']}: {market_label}")
+    lines.extend(_signal_head_lines(lang, symbol, timeframe, result))
     lines.append("")
-    lines.append(f"🎯 {tt['entry']}: {entry}")
-    lines.append(f"✅ TP1: {tp1}")
-    lines.append(f"✅ TP2: {tp2}")
-    lines.append(f"✅ TP3: {tp3}")
-    lines.append(f"🛑 {tt['sl']}: {sl}")
+    lines.extend(_signal_level_lines(lang, result))
     lines.append("")
     lines.append(f"🧠 {tt['note']}: {legal_note}")
 
@@ -659,6 +2869,413 @@ def format_signal_message(lang, symbol, timeframe, result, trial_line):
     lines.append(tt["educational"])
     return "\n".join(lines)
 
+def format_signal_progress(lang, symbol, timeframe, partial):
+    # Intermediate text while the model is still streaming:
+    # header + signal once signal/state/confidence are known, then entry + TP/SL.
+    if not all(k in partial for k in ("signal", "market_state", "confidence")):
+        return None
+    result = dict(partial)
+    lines = _signal_head_lines(lang, symbol, timeframe, result)
+    if "entry_zone" in result and "sl" in result:
+        result = enforce_tp_rules(result, symbol, timeframe)
+        lines.append("")
+        lines.extend(_signal_level_lines(lang, result))
+    lines.append("")
+    lines.append(T[lang]["analyzing"])
+    return "\n".join(lines)
+
+def retry_after_seconds(e):
+    ra = e.retry_after  # int seconds (PTB 21) or timedelta (newer PTB)
+    return float(ra.total_seconds()) if hasattr(ra, "total_seconds") else float(ra)
+
+class MessageEditor:
+    # Edits one placeholder message in place. Intermediate edits are rate-limited to one per
+    # STREAM_EDIT_INTERVAL (edits inside the window are dropped); the final edit goes out at once
+    # and only waits if Telegram answers RetryAfter.
+    def __init__(self, message):
+        self.message = message
+        self._text = message.text
+        self._at = time.monotonic()
+
+    async def edit(self, text, final=False, **kwargs):
+        if not text or text == self._text:
+            return
+        if not final and time.monotonic() - self._at < STREAM_EDIT_INTERVAL:
+            return
+        try:
+            await self.message.edit_text(text, **kwargs)
+        except RetryAfter as e:
+            if not final:
+                return
+            await asyncio.sleep(retry_after_seconds(e))
+            await self.message.edit_text(text, **kwargs)
+        except BadRequest as e:
+            if "not modified" not in str(e).lower():
+                raise
+        self._text = text
+        self._at = time.monotonic()
+
+# ============================================================
+# Outbound sender (rate-limited, persistent queue)
+# ============================================================
+# Messages the bot sends on its own (admin notifications, broadcasts) go through one sender
+# per host: a global token bucket (Bot API ~30 msg/s per token), one per chat (~1 msg/s),
+# slower ones for groups (20 msg/min). RetryAfter pauses everything for the advertised time.
+# Queued messages live in SQLite so a restart does not drop them; a broadcast keeps only a
+# cursor (last user id sent) and streams recipients from the user store.
+class TokenBucket:
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.at = time.monotonic()
+
+    def wait(self, now):
+        # seconds until a token is available (0 = now); a `now` read before the bucket was
+        # created or last refilled (callers await between reading the clock and asking) adds nothing
+        if now > self.at:
+            self.tokens = min(self.burst, self.tokens + (now - self.at) * self.rate)
+            self.at = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+class Outbox:
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("PRAGMA busy_timeout=5000")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS outbox (id INTEGER PRIMARY KEY, chat_id INTEGER NOT NULL,"
+            " text TEXT NOT NULL, not_before REAL NOT NULL DEFAULT 0, attempts INTEGER NOT NULL DEFAULT 0)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS broadcasts (id INTEGER PRIMARY KEY, admin_id INTEGER, text TEXT NOT NULL,"
+            " total INTEGER, cursor INTEGER, sent INTEGER DEFAULT 0, blocked INTEGER DEFAULT 0,"
+            " failed INTEGER DEFAULT 0, report_chat INTEGER, report_msg INTEGER, created REAL, finished REAL)"
+        )
+
+    def push(self, chat_id, text):
+        with self._lock:
+            return self._conn.execute("INSERT INTO outbox (chat_id, text) VALUES (?, ?)", (chat_id, text)).lastrowid
+
+    def claim(self, limit):
+        # due messages, leased for SEND_LEASE_TTL (a crashed sender's claims come back)
+        now = time.time()
+        with self._lock:
+            rows = self._conn.execute(
+                "UPDATE outbox SET not_before = ? WHERE id IN"
+                " (SELECT id FROM outbox WHERE not_before <= ? ORDER BY id LIMIT ?)"
+                " RETURNING id, chat_id, text, attempts",
+                (now + SEND_LEASE_TTL, now, limit),
+            ).fetchall()
+        return sorted(rows)
+
+    def done(self, row_id):
+        with self._lock:
+            self._conn.execute("DELETE FROM outbox WHERE id = ?", (row_id,))
+
+    def retry(self, row_id, delay, attempts, chat_id):
+        with self._lock:
+            self._conn.execute("UPDATE outbox SET not_before = ?, attempts = ?, chat_id = ? WHERE id = ?",
+                               (time.time() + delay, attempts, chat_id, row_id))
+
+    def pending(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+
+    def add_broadcast(self, admin_id, text, total, report_chat, report_msg):
+        with self._lock:
+            return self._conn.execute(
+                "INSERT INTO broadcasts (admin_id, text, total, report_chat, report_msg, created) VALUES (?, ?, ?, ?, ?, ?)",
+                (admin_id, text, total, report_chat, report_msg, time.time()),
+            ).lastrowid
+
+    def active_broadcast(self):
+        with self._lock:
+            cur = self._conn.execute("SELECT * FROM broadcasts WHERE finished IS NULL ORDER BY id LIMIT 1")
+            row = cur.fetchone()
+            return dict(zip([c[0] for c in cur.description], row)) if row else None
+
+    def save_broadcast(self, job, finished=False):
+        # False if the broadcast was cancelled meanwhile
+        with self._lock:
+            return self._conn.execute(
+                "UPDATE broadcasts SET cursor = ?, sent = ?, blocked = ?, failed = ?, finished = ?"
+                " WHERE id = ? AND finished IS NULL",
+                (job["cursor"], job["sent"], job["blocked"], job["failed"],
+                 time.time() if finished else None, job["id"]),
+            ).rowcount > 0
+
+    def cancel_broadcasts(self):
+        with self._lock:
+            return self._conn.execute("UPDATE broadcasts SET finished = ? WHERE finished IS NULL", (time.time(),)).rowcount
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+def broadcast_progress_text(job, final=False):
+    done = job["sent"] + job["blocked"] + job["failed"]
+    head = "✅ Broadcast finished" if final else "📣 Broadcast running"
+    text = (f"{head} #{job['id']}\n"
+            f"{done}/{job['total']} processed: {job['sent']} sent, {job['blocked']} blocked, {job['failed']} failed")
+    elapsed = time.time() - job["created"]
+    if not final and done and elapsed > 0:
+        rate = done / elapsed
+        text += f"\n{rate:.1f} msg/s, ~{max(0, job['total'] - done) / rate / 60:.0f} min left"
+    return text
+
+class OutboundSender:
+    def __init__(self, outbox):
+        self.outbox = outbox
+        self.bot = None
+        self.global_bucket = TokenBucket(SEND_GLOBAL_RATE, burst=max(1, int(SEND_GLOBAL_RATE)))
+        self._chat_buckets = OrderedDict()  # chat_id -> TokenBucket (LRU)
+        self._ready = deque()  # claimed items waiting for their chat bucket / retry delay
+        self._slots = asyncio.Semaphore(SEND_CONCURRENCY)
+        self._inflight = set()
+        self._wake = asyncio.Event()
+        self._paused_until = 0.0
+        self._job = None
+        self._job_check = 0.0
+        self._leader = False
+        self._lease_check = 0.0
+        self._task = None
+
+    def start(self, bot):
+        self.bot = bot
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self._inflight:
+            await asyncio.wait(self._inflight, timeout=5)
+        if self._job is not None:
+            self._job["cursor"] = self._job_cursor(self._job)
+            await asyncio.to_thread(self.outbox.save_broadcast, self._job)
+        if self._leader:
+            await session_call("delete", "sender_lease")
+            self._leader = False
+        await asyncio.to_thread(self.outbox.close)
+
+    # Outbox calls are SQLite writes (busy_timeout): all of them run off the event loop.
+    async def notify(self, chat_id, text):
+        await asyncio.to_thread(self.outbox.push, chat_id, text)
+        stat_incr("send_queued")
+        self._wake.set()
+
+    async def broadcast(self, admin_id, text, total, report_chat, report_msg):
+        job_id = await asyncio.to_thread(self.outbox.add_broadcast, admin_id, text, total, report_chat, report_msg)
+        self._job_check = 0.0
+        self._wake.set()
+        return job_id
+
+    async def cancel(self):
+        n = await asyncio.to_thread(self.outbox.cancel_broadcasts)
+        self._job = None
+        return n
+
+    async def status_text(self):
+        job = self._job or await asyncio.to_thread(self.outbox.active_broadcast)
+        lines = [f"📤 Outbox: {await asyncio.to_thread(self.outbox.pending)} queued"]
+        lines.append(broadcast_progress_text(job) if job else "No broadcast running.")
+        return "\n".join(lines)
+
+    async def _is_leader(self, now):
+        # one sender per host drains the outbox: the Bot API limits are per token, not per process
+        if now >= self._lease_check:
+            self._lease_check = now + SEND_LEASE_TTL / 3
+            if self._leader:
+                await session_call("set", "sender_lease", 1, SEND_LEASE_TTL)
+            else:
+                self._leader = await session_call("incr", "sender_lease", 1, SEND_LEASE_TTL, limit=1) is not None
+        return self._leader
+
+    def _chat_bucket(self, chat_id):
+        b = self._chat_buckets.get(chat_id)
+        if b is None:
+            rate = SEND_GROUP_PER_MIN / 60.0 if chat_id < 0 else SEND_CHAT_RATE
+            b = self._chat_buckets[chat_id] = TokenBucket(rate)
+            if len(self._chat_buckets) > 10000:
+                self._chat_buckets.popitem(last=False)
+        else:
+            self._chat_buckets.move_to_end(chat_id)
+        return b
+
+    async def _load_job(self):
+        row = await asyncio.to_thread(self.outbox.active_broadcast)
+        if row is None:
+            return
+        ids = sorted(await asyncio.to_thread(open_store().ids))
+        if row["cursor"] is not None:
+            ids = ids[bisect.bisect_right(ids, row["cursor"]):]
+        row.update(ids=ids, pos=0, open=set(), reported=time.monotonic())
+        self._job = row
+
+    @staticmethod
+    def _job_cursor(job):
+        # last user id that it and everyone before it have an outcome: ids picked but not yet sent
+        # (in flight, waiting for a retry) are sent again after a restart rather than skipped
+        upto = min(job["open"]) if job["open"] else job["pos"]
+        return job["ids"][upto - 1] if upto else job["cursor"]
+
+    async def _pick(self, now):
+        # next sendable item, or (None, seconds until one may be)
+        if not self._ready:
+            for row_id, chat_id, text, attempts in await asyncio.to_thread(self.outbox.claim, 32):
+                self._ready.append({"row": row_id, "job": None, "chat_id": chat_id, "text": text,
+                                    "attempts": attempts, "not_before": 0.0})
+        wait = 1.0
+        deferred = []
+        for i, item in enumerate(self._ready):
+            w = max(item["not_before"] - now, self._chat_bucket(item["chat_id"]).wait(now))
+            if w <= 0:
+                del self._ready[i]
+                break
+            if item["row"] is not None:
+                deferred.append((item, w))  # not held past its lease: back to the outbox until due
+            wait = min(wait, w)
+        else:
+            item = None
+        for d, w in deferred:
+            self._ready.remove(d)
+            await asyncio.to_thread(self.outbox.retry, d["row"], w, d["attempts"], d["chat_id"])
+        if item is not None:
+            return item, 0.0
+        job = self._job
+        if job is not None and job["pos"] < len(job["ids"]):
+            chat_id = job["ids"][job["pos"]]
+            job["open"].add(job["pos"])
+            item = {"row": None, "job": job, "pos": job["pos"], "chat_id": chat_id, "text": job["text"],
+                    "attempts": 0, "not_before": 0.0}
+            job["pos"] += 1
+            w = self._chat_bucket(chat_id).wait(now)
+            if w <= 0:
+                return item, 0.0
+            item["not_before"] = now + w
+            self._ready.append(item)
+            wait = min(wait, w)
+        return None, wait
+
+    async def _run(self):
+        while True:
+            try:
+                now = time.monotonic()
+                if not await self._is_leader(now):
+                    await asyncio.sleep(SEND_LEASE_TTL / 3)
+                    continue
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                job = self._job
+                if job is None and now >= self._job_check:
+                    self._job_check = now + 5
+                    await self._load_job()
+                elif job is not None:
+                    await self._job_tick(job, now)
+                w = self.global_bucket.wait(now)
+                if w > 0:
+                    await asyncio.sleep(w)
+                    continue
+                item, wait = await self._pick(now)
+                if item is None:
+                    try:
+                        await asyncio.wait_for(self._wake.wait(), timeout=wait)
+                    except asyncio.TimeoutError:
+                        pass
+                    self._wake.clear()
+                    continue
+                self.global_bucket.take()
+                self._chat_bucket(item["chat_id"]).take()
+                await self._slots.acquire()
+                task = asyncio.create_task(self._send(item))
+                self._inflight.add(task)
+                task.add_done_callback(self._inflight.discard)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"WARNING: outbound sender: {e}")
+                await asyncio.sleep(1)
+
+    async def _job_tick(self, job, now):
+        # persist the cursor, report progress, close the broadcast once everything is back
+        finished = job["pos"] >= len(job["ids"]) and not job["open"]
+        if not finished and now - job["reported"] < BROADCAST_REPORT_INTERVAL:
+            return
+        job["reported"] = now
+        job["cursor"] = self._job_cursor(job)
+        if not await asyncio.to_thread(self.outbox.save_broadcast, job, finished):
+            self._job = None  # cancelled (possibly by another process)
+            return
+        if finished:
+            self._job = None
+        self.global_bucket.take()
+        try:
+            await self.bot.edit_message_text(broadcast_progress_text(job, final=finished),
+                                             chat_id=job["report_chat"], message_id=job["report_msg"])
+        except Exception as e:
+            if "not modified" not in str(e).lower():
+                print(f"WARNING: broadcast progress report failed: {e}")
+
+    async def _retry(self, item, delay):
+        item["attempts"] += 1
+        if item["row"] is not None:
+            await asyncio.to_thread(self.outbox.retry, item["row"], delay, item["attempts"], item["chat_id"])
+        else:
+            item["not_before"] = time.monotonic() + delay
+            self._ready.append(item)
+
+    async def _send(self, item):
+        try:
+            await self.bot.send_message(chat_id=item["chat_id"], text=item["text"])
+            outcome = "sent"
+        except RetryAfter as e:
+            delay = retry_after_seconds(e)
+            self._paused_until = max(self._paused_until, time.monotonic() + delay)
+            stat_incr("send_retry_after")
+            await self._retry(item, delay)
+            return
+        except ChatMigrated as e:
+            item["chat_id"] = e.new_chat_id
+            await self._retry(item, 0)
+            return
+        except Forbidden:
+            outcome = "blocked"  # user blocked the bot / left the chat
+        except BadRequest as e:
+            outcome = "failed"  # chat not found, message rejected: retrying won't help
+            print(f"WARNING: send to {item['chat_id']} rejected: {e}")
+        except Exception as e:  # network errors, timeouts
+            if item["attempts"] + 1 < SEND_MAX_ATTEMPTS:
+                await self._retry(item, 2 ** item["attempts"])
+                return
+            outcome = "failed"
+            print(f"WARNING: send to {item['chat_id']} failed after {SEND_MAX_ATTEMPTS} attempts: {e}")
+        finally:
+            self._slots.release()
+        stat_incr(f"send_{outcome}")
+        if item["row"] is not None:
+            await asyncio.to_thread(self.outbox.done, item["row"])
+        else:
+            job = item["job"]
+            job[outcome] += 1
+            job["open"].discard(item["pos"])
+        self._wake.set()
+
+_OUTBOUND = None
+
+def outbound():
+    global _OUTBOUND
+    if _OUTBOUND is None:
+        _OUTBOUND = OutboundSender(Outbox(SEND_QUEUE_FILE))
+    return _OUTBOUND
+
 # ============================================================
 # Handlers
 # ============================================================
@@ -714,6 +3331,45 @@ async def cmd_setplan(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await set_plan(db, int(target_id), plan)
     await update.message.reply_text(tt["setplan_ok"].format(uid=target_id, plan=plan))
 
+async def cmd_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    uid = update.effective_user.id
+    if not is_admin(uid):
+        db = await load_db()
+        u = await get_user(db, uid)
+        await update.message.reply_text(T[u.get("lang", DEFAULT_LANG)]["admin_only"])
+        return
+
+    lines = ["📊 Stats"]
+    for k in sorted(STATS):
+        lines.append(f"{k}: {STATS[k]}")
+    if VISION_LATENCY.count():
+        p50, p95, p99 = (VISION_LATENCY.percentile(p) for p in (50, 95, 99))
+        lines.append(f"vision_latency_s: p50={p50:.2f} p95={p95:.2f} p99={p99:.2f} (n={VISION_LATENCY.count()})")
+    lines.append(f"vision_circuit: {VISION_BREAKER.state}")
+    await update.message.reply_text("\n".join(lines))
+
+async def cmd_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    uid = update.effective_user.id
+    if not is_admin(uid):
+        db = await load_db()
+        u = await get_user(db, uid)
+        await update.message.reply_text(T[u.get("lang", DEFAULT_LANG)]["admin_only"])
+        return
+
+    parts = (update.message.text or "").split(maxsplit=1)
+    arg = parts[1].strip() if len(parts) > 1 else ""
+    sender = outbound()
+    if arg.lower() == "cancel":
+        await update.message.reply_text(f"🛑 Cancelled {await sender.cancel()} broadcast(s).")
+        return
+    if not arg or arg.lower() == "status":
+        await update.message.reply_text(await sender.status_text() + "\n\nUsage: /broadcast <text> | status | cancel")
+        return
+
+    total = len(await asyncio.to_thread(open_store().ids))
+    msg = await update.message.reply_text(f"📣 Broadcast queued for {total} users.")
+    await sender.broadcast(uid, arg, total, msg.chat_id, msg.message_id)
+
 async def send_welcome_and_menu(chat_id, context, lang):
     tt = T[lang]
     # Welcome card (fancy + simple)
@@ -773,19 +3429,18 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Analyze (just prompt to send photo; no extra menus)
     if data == "menu_analyze":
         # Mark awaiting photo (UX)
-        context.user_data["awaiting_photo"] = True
+        await set_awaiting_photo(user_id, True)
         await query.message.reply_text(T[lang]["send_chart_now"])
         return
 
     # Activation flow
     if data == "paid_activate":
-        PENDING_EMAIL.add(user_id)
+        await set_pending_email(user_id, True)
         await query.message.reply_text(T[lang]["activate_ask_email"], reply_markup=cancel_keyboard(lang))
         return
 
     if data == "cancel_activate":
-        if user_id in PENDING_EMAIL:
-            PENDING_EMAIL.discard(user_id)
+        await set_pending_email(user_id, False)
         await query.message.reply_text(T[lang]["activate_cancelled"], reply_markup=main_menu(lang))
         return
 
@@ -798,36 +3453,82 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     lang = u.get("lang", DEFAULT_LANG)
     tt = T[lang]
 
-    # If user was asked for email, and they send photo => ignore email state, analyze photo (more pro UX)
-    if user_id in PENDING_EMAIL:
-        # keep pending activation, but allow analysis
-        pass
+    # If user was asked for email, and they send photo => ignore email state, analyze photo (more pro UX):
+    # the pending activation is kept and not even looked up here
 
     plan = (u.get("plan", "FREE") or "FREE").upper()
 
-    if plan == "FREE":
-        rem = await trial_remaining(u)
-        if rem <= 0:
-            await msg.reply_text(tt["trial_ended"], reply_markup=plans_keyboard(lang))
-            return
-
-    await msg.chat.send_action(ChatAction.TYPING)
+    chart = chart_file(msg)
+    if chart is None:
+        return
+    if (chart.file_size or 0) > IMAGE_MAX_FILE_MB * 1024 * 1024:
+        ANALYSES.inc("too_large")
+        await msg.reply_text(tt["image_too_large"].format(mb=IMAGE_MAX_FILE_MB))
+        return
 
-    photo = msg.photo[-1]
-    file = await context.bot.get_file(photo.file_id)
-    b = await file.download_as_bytearray()
+    try:
+        await SCHEDULER.enter_user(user_id)
+    except AnalysisBusy:
+        ANALYSES.inc("busy_user")
+        await msg.reply_text(tt["busy_user"])
+        return
 
     caption = msg.caption or ""
     sym_cap, tf_cap = guess_symbol_tf_from_caption(caption)
 
+    editor = None
+
+    async def send(text):
+        # final text: edit the streamed placeholder if there is one, else a normal reply
+        if editor is not None:
+            await editor.edit(text, final=True)
+        else:
+            await msg.reply_text(text)
+
+    # A FREE analysis reserves one trial credit up front; it is kept only once the signal has
+    # been delivered (committed) and handed back on every other exit, cancellation included.
+    reserved = committed = False
+    ANALYSES_IN_FLIGHT.inc()
+    t_admitted = time.perf_counter()
+    outcome = "error"
     try:
-        b64 = image_to_base64_jpeg(bytes(b), max_side=1100, quality=85)
-
-        # Analyze with OpenAI (thread)
-        result = await asyncio.to_thread(openai_analyze_chart, b64)
+        if plan == "FREE":
+            reserved = await reserve_trial(db, user_id)
+            if not reserved:
+                outcome = "trial_ended"
+                await msg.reply_text(tt["trial_ended"], reply_markup=plans_keyboard(lang))
+                return
+
+        await msg.chat.send_action(ChatAction.TYPING)
+        if STREAM_REPLIES:
+            editor = MessageEditor(await msg.reply_text(tt["analyzing"]))
+
+        async def download():
+            return await download_chart_file(context.bot, chart)
+
+        async def on_queued(pos):
+            if editor is not None:
+                await editor.edit(tt["queue_position"].format(pos=pos), final=True)
+            else:
+                await msg.reply_text(tt["queue_position"].format(pos=pos))
+
+        async def on_partial(fields):
+            sym = fields.get("symbol") or sym_cap
+            tf = fields.get("timeframe") or tf_cap
+            await editor.edit(format_signal_progress(lang, sym, tf, fields))
+
+        # Analyze with OpenAI (pooled async client), unless this image was seen recently
+        t_start = time.monotonic()
+        meta = {}
+        result = await analyze_chart(
+            chart.file_unique_id, download,
+            paid=(plan == "PAID"), on_queued=on_queued,
+            on_partial=on_partial if editor is not None else None,
+            meta=meta,
+        )
+        latency = time.monotonic() - t_start
 
-        # TP rules (keep your marketing TP1 close)
-        result = enforce_tp_rules(result)
+        t_post = time.perf_counter()
 
         # Determine symbol/tf:
         sym_img = (result.get("symbol", "") or "").strip().upper()
@@ -836,27 +3537,54 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
         symbol = sym_img or sym_cap or ""
         timeframe = tf_img or tf_cap or ""
 
+        # TP rules (keep your marketing TP1 close), per instrument and timeframe
+        result = enforce_tp_rules(result, symbol, timeframe)
+        record_signal(user_id, symbol, timeframe, result, latency, meta)
+
         # Trial update
         trial_line = ""
-        if plan == "FREE":
-            u["trial_used"] = int(u.get("trial_used", 0) or 0) + 1
-            await save_db(db)
-            rem_after = await trial_remaining(u)
+        if reserved:
+            rem_after = await trial_left(db, user_id)
             trial_line = (
                 tt["trial_remaining"].format(rem=rem_after, tot=FREE_TRIAL_LIMIT) + "\n" +
                 tt["subscribe_hint"]
             )
 
         text = format_signal_message(lang, symbol, timeframe, result, trial_line)
+        STAGE_SECONDS.observe(time.perf_counter() - t_post, "postprocess")
 
         # ✅ IMPORTANT: Do NOT send menu after analysis (as you requested)
-        await msg.reply_text(text)
+        with STAGE_SECONDS.time("reply"):
+            await send(text)
+        committed = True
+        outcome = "ok"
 
         # After successful analysis, no longer "awaiting_photo"
-        context.user_data["awaiting_photo"] = False
+        await set_awaiting_photo(user_id, False)
+
+    except AnalysisBusy as e:
+        outcome = f"busy_{e.reason}"
+        await send(tt["busy_full"] if e.reason == "queue_full" else tt["busy_timeout"])
+
+    except NotAChart:
+        outcome = "not_a_chart"
+        await send(tt["not_a_chart"])
 
     except Exception as e:
-        await msg.reply_text(f"{tt['analysis_failed']}\n\nDebug: {str(e)[:220]}")
+        ANALYSIS_ERRORS.inc(type(e).__name__)
+        # raw provider errors are only shown to admins
+        if is_admin(user_id):
+            await send(f"{tt['analysis_failed']}\n\nDebug: {str(e)[:220]}")
+        else:
+            await send(tt["analysis_failed"])
+
+    finally:
+        if reserved and not committed:
+            await refund_trial(db, user_id)
+        await SCHEDULER.leave_user(user_id)
+        ANALYSES_IN_FLIGHT.dec()
+        ANALYSES.inc(outcome)
+        ANALYSIS_SECONDS.observe(time.perf_counter() - t_admitted, outcome)
 
 async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
@@ -868,7 +3596,7 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     tt = T[lang]
 
     # Activation email step
-    if user_id in PENDING_EMAIL:
+    if await is_pending_email(user_id):
         # Allow user to still change language or open plans without being trapped
         # But since our buttons are INLINE, this mostly happens if they type manually.
         if t.startswith("/"):
@@ -880,7 +3608,7 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
 
         # accept
-        PENDING_EMAIL.discard(user_id)
+        await set_pending_email(user_id, False)
 
         username = update.effective_user.username or "NoUsername"
         cmd_ready = f"/setplan {user_id} PAID"
@@ -895,12 +3623,8 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
             f"(Admin email ref: {ADMIN_EMAIL})"
         )
 
-        if ADMIN_IDS:
-            for admin_id in ADMIN_IDS:
-                try:
-                    await context.bot.send_message(chat_id=admin_id, text=msg_admin)
-                except Exception:
-                    pass
+        for admin_id in ADMIN_IDS:
+            await outbound().notify(admin_id, msg_admin)
 
         await update.message.reply_text(tt["thanks_email"], reply_markup=main_menu(lang))
         return
@@ -912,10 +3636,136 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # If user typed random text, keep it clean and pro:
     await update.message.reply_text(tt["send_chart_now"])
 
+# ============================================================
+# Update dispatch (ordered per chat, concurrent across chats)
+# ============================================================
+# PTB's default processes one update at a time, so one user's analysis stalls everyone.
+# ChatOrderedProcessor runs updates of different chats concurrently (up to UPDATE_WORKERS)
+# while each chat's updates still run one after another in arrival order. Chats with work
+# queued take turns round-robin, and photo/document updates (analyses) may use at most
+# UPDATE_HEAVY_WORKERS of the workers, so button taps always find a free one.
+def _update_chat_key(update):
+    chat = getattr(update, "effective_chat", None)
+    return chat.id if chat is not None else object()  # no chat (inline, polls): unordered
+
+def _update_is_heavy(update):
+    msg = getattr(update, "effective_message", None)
+    return msg is not None and bool(getattr(msg, "photo", None) or getattr(msg, "document", None))
+
+class ChatOrderedProcessor(BaseUpdateProcessor):
+    def __init__(self, workers, heavy_workers, max_pending):
+        # max_pending bounds updates accepted but not finished (PTB's semaphore); workers bounds
+        # the ones actually running
+        super().__init__(max(max_pending, workers))
+        self.workers = workers
+        self.heavy_workers = min(heavy_workers, workers)
+        self._chats = {}  # chat key -> deque of [coroutine, future, heavy] (head runs first)
+        self._ready = deque()  # chat keys with work and nothing running, in turn order
+        self._running = 0
+        self._heavy_running = 0
+        self._tasks = set()  # running _run tasks, awaited on shutdown
+        self._closing = False
+
+    async def initialize(self):
+        self._closing = False
+
+    async def shutdown(self):
+        # drop updates that have not started, then let the running ones finish
+        self._closing = True
+        waiting = set(self._ready)
+        for key, queue in list(self._chats.items()):
+            started = 0 if key in waiting else 1
+            while len(queue) > started:
+                coroutine, future, _ = queue.pop()
+                coroutine.close()
+                future.cancel()
+            if not queue:
+                del self._chats[key]
+        self._ready.clear()
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._chats.clear()
+
+    async def do_process_update(self, update, coroutine):
+        if self._closing:
+            coroutine.close()
+            return
+        key = _update_chat_key(update)
+        future = asyncio.get_running_loop().create_future()
+        queue = self._chats.get(key)
+        if queue is None:
+            queue = self._chats[key] = deque()
+            self._ready.append(key)
+        queue.append([coroutine, future, _update_is_heavy(update)])
+        stat_max("dispatch_chats_max", len(self._chats))
+        self._dispatch()
+        await future
+
+    def _dispatch(self):
+        # start the next chat's head update while workers are free; a chat whose head is heavy
+        # waits its turn again if the heavy share is used up
+        skipped = 0
+        while self._ready and self._running < self.workers and skipped < len(self._ready):
+            key = self._ready.popleft()
+            head = self._chats[key][0]
+            if head[2] and self._heavy_running >= self.heavy_workers:
+                self._ready.append(key)
+                skipped += 1
+                continue
+            self._running += 1
+            self._heavy_running += head[2]
+            task = asyncio.create_task(self._run(key, head))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, key, head):
+        coroutine, future, heavy = head
+        try:
+            await coroutine
+            if not future.done():
+                future.set_result(None)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+        finally:
+            self._running -= 1
+            self._heavy_running -= heavy
+            queue = self._chats.get(key)
+            if queue and queue[0] is head:
+                queue.popleft()
+            if queue and not self._closing:
+                self._ready.append(key)
+            else:
+                self._chats.pop(key, None)
+            self._dispatch()
+
 # ============================================================
 # Main
 # ============================================================
-async def main():
+def build_application():
+    builder = Application.builder().token(BOT_TOKEN)
+    if UPDATE_WORKERS > 1:
+        builder = builder.concurrent_updates(
+            ChatOrderedProcessor(UPDATE_WORKERS, UPDATE_HEAVY_WORKERS, UPDATE_PENDING_MAX))
+    application = builder.build()
+
+    application.add_handler(CommandHandler("start", cmd_start))
+    application.add_handler(CommandHandler("myid", cmd_myid))
+    application.add_handler(CommandHandler("plans", cmd_plans))
+    application.add_handler(CommandHandler("setplan", cmd_setplan))
+    application.add_handler(CommandHandler("stats", cmd_stats))
+    application.add_handler(CommandHandler("broadcast", cmd_broadcast))
+
+    application.add_handler(CallbackQueryHandler(on_callback))
+
+    application.add_handler(MessageHandler(filters.PHOTO | filters.Document.IMAGE, handle_photo))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text))
+    return application
+
+def _startup_checks():
     if not BOT_TOKEN:
         raise RuntimeError("Missing TELEGRAM_BOT_TOKEN")
     if not OPENAI_API_KEY:
@@ -923,25 +3773,1233 @@ async def main():
     if not ADMIN_IDS:
         print("WARNING: ADMIN_IDS is empty. Payment requests won't reach you and /setplan won't work.")
 
-    app = Application.builder().token(BOT_TOKEN).build()
-
-    app.add_handler(CommandHandler("start", cmd_start))
-    app.add_handler(CommandHandler("myid", cmd_myid))
-    app.add_handler(CommandHandler("plans", cmd_plans))
-    app.add_handler(CommandHandler("setplan", cmd_setplan))
+async def _shutdown_resources(store, flusher):
+    flusher.cancel()
+    await asyncio.gather(flusher, return_exceptions=True)
+    await outbound().stop()
+    await close_openai_client()
+    shutdown_preprocess_pool()
+    await asyncio.to_thread(store.flush)
+    if history_store() is not None:
+        await asyncio.to_thread(history_store().flush)
+    sessions().close()
 
-    app.add_handler(CallbackQueryHandler(on_callback))
+async def main():
+    _startup_checks()
+    application = build_application()
 
-    app.add_handler(MessageHandler(filters.PHOTO, handle_photo))
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text))
+    store = open_store()
+    flusher = asyncio.create_task(db_flush_loop())
 
     print("✅ Bot starting (Polling)...")
-    await app.initialize()
-    await app.start()
-    await app.updater.start_polling(drop_pending_updates=True)
+    await application.initialize()
+    await application.start()
+    await application.bot.delete_webhook()  # polling and a webhook cannot coexist
+    await application.updater.start_polling(drop_pending_updates=True)
+    outbound().start(application.bot)
+    metrics_server = await start_metrics_server()
+
+    try:
+        while True:
+            await asyncio.sleep(3600)
+    finally:
+        if metrics_server is not None:
+            metrics_server.close()
+        await _shutdown_resources(store, flusher)
 
+# ============================================================
+# Webhook mode (ASGI: `uvicorn bot:app`)
+# ============================================================
+# Each uvicorn worker runs its own Application; updates are acknowledged with 200 as soon as
+# they are queued, and the handlers run in the background. Workers share the SQLite user store
+# (WAL); the json backend is single-process only and refuses to start in a second worker.
+# Per-chat ordering, SCHEDULER, ANALYSIS_CACHE and VISION_BREAKER stay per worker (see the
+# webhook config): run a single worker when those must hold bot-wide.
+_WEBHOOK = {}  # application, store, flusher of this worker
+
+async def _asgi_send(send, status, body, content_type="application/json"):
+    if isinstance(body, (dict, list)):
+        body = json.dumps(body)
+    if isinstance(body, str):
+        body = body.encode("utf-8")
+    await send({"type": "http.response.start", "status": status,
+                "headers": [(b"content-type", content_type.encode()), (b"content-length", str(len(body)).encode())]})
+    await send({"type": "http.response.body", "body": body})
+
+async def _asgi_body(receive, limit):
+    body = bytearray()
     while True:
-        await asyncio.sleep(3600)
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return None
+        body += message.get("body", b"")
+        if len(body) > limit:
+            return False
+        if not message.get("more_body"):
+            return bytes(body)
+
+async def webhook_startup():
+    _startup_checks()
+    application = build_application()
+    store = open_store()
+    flusher = asyncio.create_task(db_flush_loop())
+    await application.initialize()
+    await application.start()  # consumes application.update_queue
+    if WEBHOOK_URL:
+        await application.bot.set_webhook(WEBHOOK_URL + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET,
+                                          allowed_updates=Update.ALL_TYPES)
+        print(f"✅ Bot starting (Webhook: {WEBHOOK_URL}{WEBHOOK_PATH})")
+    else:
+        print("WARNING: WEBHOOK_URL (or RENDER_EXTERNAL_URL) is empty; setWebhook skipped.")
+    outbound().start(application.bot)
+    _WEBHOOK.update(application=application, store=store, flusher=flusher)
+
+async def webhook_shutdown():
+    application = _WEBHOOK.pop("application", None)
+    if application is None:
+        return
+    # the webhook stays registered: other workers / the next deploy keep receiving updates
+    await application.stop()
+    await application.shutdown()
+    await _shutdown_resources(_WEBHOOK.pop("store"), _WEBHOOK.pop("flusher"))
+
+async def _handle_webhook(scope, receive, send):
+    application = _WEBHOOK.get("application")
+    headers = dict(scope.get("headers") or [])
+    token = headers.get(b"x-telegram-bot-api-secret-token", b"").decode("latin-1")
+    if not hmac.compare_digest(token, WEBHOOK_SECRET):
+        stat_incr("webhook_forbidden")
+        await _asgi_send(send, 403, {"ok": False, "error": "bad secret token"})
+        return
+    body = await _asgi_body(receive, WEBHOOK_MAX_BODY)
+    if body is None:
+        return
+    if body is False:
+        await _asgi_send(send, 413, {"ok": False, "error": "body too large"})
+        return
+    if application is None:
+        await _asgi_send(send, 503, {"ok": False, "error": "starting"})  # Telegram retries later
+        return
+    try:
+        update = Update.de_json(json.loads(body), application.bot)
+    except Exception:
+        stat_incr("webhook_bad_request")
+        await _asgi_send(send, 400, {"ok": False, "error": "invalid update"})
+        return
+    application.update_queue.put_nowait(update)
+    stat_incr("webhook_updates")
+    await _asgi_send(send, 200, {"ok": True})
+
+async def app(scope, receive, send):
+    # ASGI entry point: lifespan, POST WEBHOOK_PATH, GET /healthz, GET /metrics
+    if scope["type"] == "lifespan":
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                try:
+                    await webhook_startup()
+                except Exception as e:
+                    await send({"type": "lifespan.startup.failed", "message": str(e)})
+                    return
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                try:
+                    await webhook_shutdown()
+                finally:
+                    await send({"type": "lifespan.shutdown.complete"})
+                return
+    if scope["type"] != "http":
+        return
+
+    path, method = scope.get("path", ""), scope.get("method", "GET")
+    if path == WEBHOOK_PATH and method == "POST":
+        await _handle_webhook(scope, receive, send)
+    elif path == "/healthz" and method in ("GET", "HEAD"):
+        ok = "application" in _WEBHOOK
+        await _asgi_send(send, 200 if ok else 503, {
+            "ok": ok,
+            "running": STATS.get("scheduler_running", 0),
+            "queued": STATS.get("scheduler_queue_depth", 0),
+            "circuit": VISION_BREAKER.state,
+        })
+    elif path == "/metrics" and method == "GET":
+        await _asgi_send(send, 200, render_metrics(), METRICS_CONTENT_TYPE)
+    else:
+        await _asgi_send(send, 404, {"ok": False, "error": "not found"})
+
+# ============================================================
+# Bulk analysis (offline CLI)
+# ============================================================
+BULK_IMAGE_EXTS = (".png", ".jpg", ".jpeg", ".webp", ".bmp")
+
+def _bulk_inputs(src):
+    # directory (recursive), text manifest (one path per line) or JSONL manifest ({"path": ...})
+    if os.path.isdir(src):
+        for root, _, files in os.walk(src):
+            for name in sorted(files):
+                if name.lower().endswith(BULK_IMAGE_EXTS):
+                    yield os.path.join(root, name)
+        return
+    base = os.path.dirname(os.path.abspath(src))
+    with open(src, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            path = json.loads(line)["path"] if line.startswith("{") else line
+            yield path if os.path.isabs(path) else os.path.join(base, path)
+
+def _bulk_done(out_path):
+    # resume checkpoint: every path already written with ok=true is skipped
+    done = set()
+    if os.path.exists(out_path):
+        with open(out_path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    continue
+                if rec.get("ok"):
+                    done.add(rec["path"])
+    return done
+
+def _bulk_prepare(path):
+    # runs in a worker process; same crop / token sizing / chart score as analyze_chart
+    with open(path, "rb") as f:
+        return prepare_chart_image(f.read(), 1100, 85)
+
+async def bulk_analyze(src, out_path, concurrency=16, workers=None):
+    done = _bulk_done(out_path)
+    paths = [p for p in _bulk_inputs(src) if p not in done]
+    print(f"bulk: {len(paths)} to analyze, {len(done)} already done", file=sys.stderr)
+
+    queue = asyncio.Queue()
+    for p in paths:
+        queue.put_nowait(p)
+
+    loop = asyncio.get_running_loop()
+    counts = {"ok": 0, "error": 0, "not_chart": 0}
+    t_start = time.monotonic()
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool, \
+            open(out_path, "a", encoding="utf-8") as out:
+
+        async def worker():
+            while True:
+                try:
+                    path = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                t0 = time.monotonic()
+                rec = {"path": path}
+                try:
+                    prep = await loop.run_in_executor(pool, _bulk_prepare, path)
+                    if prep["chart_score"] < CHART_GATE_THRESHOLD:
+                        raise NotAChart(prep["chart_score"])
+                    result = await call_vision(prep["b64"])
+                    result.pop("usage", None)
+                    rec["ok"] = True
+                    rec["result"] = enforce_tp_rules(result)
+                except NotAChart as e:
+                    # final verdict, not a failure: resume must not send it again
+                    rec["ok"] = True
+                    rec["not_chart"] = round(e.score, 3)
+                    counts["not_chart"] += 1
+                except Exception as e:
+                    rec["ok"] = False
+                    rec["error"] = str(e)[:300]
+                rec["latency_ms"] = int((time.monotonic() - t0) * 1000)
+                counts["ok" if rec["ok"] else "error"] += 1
+                out.write(json.dumps(rec, ensure_ascii=False) + "\n")
+                out.flush()
+                n = counts["ok"] + counts["error"]
+                if n % 100 == 0:
+                    rate = n / max(1e-9, time.monotonic() - t_start)
+                    print(f"bulk: {n}/{len(paths)} ({rate:.1f}/s), {counts['error']} errors", file=sys.stderr)
+
+        try:
+            await asyncio.gather(*(worker() for _ in range(max(1, concurrency))))
+        finally:
+            await close_openai_client()
+
+    elapsed = time.monotonic() - t_start
+    print(f"bulk: done {counts['ok']} ok ({counts['not_chart']} not charts), {counts['error']} errors "
+          f"in {elapsed:.1f}s", file=sys.stderr)
+    return counts
+
+# ============================================================
+# Backtest (recorded signals vs local OHLCV bars)
+# ============================================================
+BACKTEST_CHUNK_CELLS = 4_000_000  # signals x bars per NumPy pass; bounds memory (~32 MB per array)
+BACKTEST_OUTCOMES = {3: "tp3", 2: "tp2", 1: "tp1", 0: "open", -1: "sl"}
+
+def _ts_array(values):
+    # epoch seconds (float64) from epoch s/ms numbers, datetime64, or ISO / MT5 ("2024.01.02 10:00") strings
+    a = np.asarray(values)
+    if np.issubdtype(a.dtype, np.datetime64):
+        return a.astype("datetime64[ms]").astype(np.int64) / 1000.0
+    try:
+        x = a.astype(np.float64)
+        return np.where(x > 1e11, x / 1000.0, x)
+    except ValueError:
+        pass
+    strs = np.char.strip(a.astype(str)).ravel()
+    strs = strs.astype(f"U{max(10, strs.dtype.itemsize // 4)}")
+    codes = strs.view(np.uint32).reshape(len(strs), -1)  # one code point per column, 0-padded
+    digit = lambda cols: np.all((codes[:, cols] >= 48) & (codes[:, cols] <= 57), axis=1)
+    # MT5 dates ("2024.01.02 10:00"): only their date dots become dashes, never fractional seconds
+    mt5 = (codes[:, 4] == 46) & (codes[:, 7] == 46) & digit([0, 1, 2, 3, 5, 6, 8, 9])
+    if mt5.any():
+        strs = np.where(mt5, np.char.replace(strs, ".", "-", count=2), strs)
+    ends = np.char.str_len(strs)
+    rows = np.arange(len(strs))
+    offset = (ends >= 6) & (codes[rows, np.maximum(ends - 6, 0)] == 45) & (codes[rows, np.maximum(ends - 3, 0)] == 58)
+    if not np.any(np.char.find(strs, "+") >= 0) and not np.any(np.char.endswith(strs, "Z")) and not offset.any():
+        try:
+            return np.array(strs, dtype="datetime64[ms]").astype(np.int64) / 1000.0  # naive = UTC
+        except ValueError:
+            pass
+    return np.array([_parse_ts(v) for v in strs])
+
+def _parse_ts(v):
+    # one timestamp: epoch s/ms number or ISO string (naive = UTC)
+    try:
+        x = float(v)
+        return x / 1000.0 if x > 1e11 else x
+    except (TypeError, ValueError):
+        dt = datetime.fromisoformat(str(v).strip().replace("Z", "+00:00"))
+        return (dt if dt.tzinfo else dt.replace(tzinfo=timezone.utc)).timestamp()
+
+def load_ohlcv(path):
+    # -> (t seconds, high, low) sorted by time. CSV (any delimiter, MT5 <DATE>/<TIME> headers ok)
+    # or Parquet (needs pyarrow).
+    if path.endswith(".parquet"):
+        try:
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise RuntimeError("Parquet OHLCV files need pyarrow (pip install pyarrow)")
+        table = pq.read_table(path)
+        cols = {c.lower().strip("<>"): table.column(c).to_numpy() for c in table.column_names}
+    else:
+        with open(path, "r", encoding="utf-8", newline="") as f:
+            head = f.read(4096)
+            f.seek(0)
+            reader = csv.reader(f, csv.Sniffer().sniff(head, delimiters=",;\t"))
+            names = [c.lower().strip().strip("<>") for c in next(reader)]
+            data = list(zip(*reader))
+        cols = {n: np.array(data[i]) for i, n in enumerate(names)}
+
+    if "date" in cols and "time" in cols:
+        t = _ts_array(np.char.add(np.char.add(cols["date"].astype(str), " "), cols["time"].astype(str)))
+    else:
+        key = next((k for k in ("timestamp", "datetime", "time", "date", "ts") if k in cols), None)
+        if key is None:
+            raise RuntimeError(f"{path}: no time column")
+        t = _ts_array(cols[key])
+    high = cols["high"].astype(np.float64)
+    low = cols["low"].astype(np.float64)
+    order = np.argsort(t, kind="stable")
+    return t[order], high[order], low[order]
+
+def _ohlcv_path(ohlcv_dir, symbol):
+    # SYMBOL.csv / SYMBOL.parquet, else the finest SYMBOL_<TF> file
+    for ext in (".parquet", ".csv"):
+        p = os.path.join(ohlcv_dir, symbol + ext)
+        if os.path.exists(p):
+            return p
+    for tf in TIMEFRAMES:
+        for ext in (".parquet", ".csv"):
+            p = os.path.join(ohlcv_dir, f"{symbol}_{tf}{ext}")
+            if os.path.exists(p):
+                return p
+    return None
+
+def backtest_symbol(t, high, low, ts, buy, entry, tps, sl, max_bars):
+    # All signals of one symbol against its bars. A signal starts on the first bar opening after
+    # ts and is followed for max_bars bars. Returns:
+    #   hit (N, 4)  first bar offset touching TP1, TP2, TP3, SL (-1 = never)
+    #   secs (N, 4) seconds from the signal to those touches
+    #   mfe, mae    max favourable / adverse excursion (price) up to the exit (SL, TP3 or horizon)
+    # Sells are mirrored (prices negated) so one set of comparisons serves both sides. The horizon
+    # is walked in growing segments and only signals still open are carried into the next one;
+    # most signals resolve within the first few dozen bars.
+    n_bars, N = len(t), len(ts)
+    start = np.searchsorted(t, ts, side="right")
+    side = np.where(buy, 1.0, -1.0)
+    levels = np.column_stack([tps * side[:, None], sl * side])  # signed TP1-3, SL
+    signed_entry = entry * side
+    hit = np.full((N, 4), -1, dtype=np.int64)
+    mfe, mae = np.zeros(N), np.zeros(N)
+
+    active = np.arange(N)
+    lo, width = 0, 32
+    while lo < max_bars and active.size:
+        hi = min(max_bars, lo + width)
+        offs = np.arange(lo, hi)
+        rows = max(1, BACKTEST_CHUNK_CELLS // len(offs))
+        for a in range(0, active.size, rows):
+            ii = active[a:a + rows]
+            idx = start[ii, None] + offs
+            valid = idx < n_bars
+            idx = np.minimum(idx, n_bars - 1)
+            s = side[ii, None]
+            fav = np.where(s > 0, high[idx], -low[idx])
+            adv = np.where(s > 0, low[idx], -high[idx])
+            for k in range(4):
+                m = valid & ((fav >= levels[ii, k, None]) if k < 3 else (adv <= levels[ii, k, None]))
+                new = (hit[ii, k] < 0) & m.any(axis=1)
+                hit[ii[new], k] = lo + m[new].argmax(axis=1)
+
+            stops = np.where(hit[ii][:, [2, 3]] < 0, max_bars, hit[ii][:, [2, 3]]).min(axis=1)
+            upto = valid & (offs <= stops[:, None])
+            e = signed_entry[ii, None]
+            mfe[ii] = np.maximum(mfe[ii], np.where(upto, fav - e, -np.inf).max(axis=1))
+            mae[ii] = np.maximum(mae[ii], np.where(upto, e - adv, -np.inf).max(axis=1))
+        # still open: no SL/TP3 yet and bars left
+        active = active[(hit[active, 2] < 0) & (hit[active, 3] < 0) & (start[active] + hi < n_bars)]
+        lo, width = hi, width * 2
+
+    secs = np.where(hit >= 0, t[np.minimum(start[:, None] + np.maximum(hit, 0), n_bars - 1)] - ts[:, None], np.nan)
+    return hit, secs, mfe, mae
+
+def backtest_outcomes(hit):
+    # best TP reached strictly before the SL bar (a bar touching both counts as SL), else SL / open
+    sl_bar = np.where(hit[:, 3] < 0, np.iinfo(np.int64).max, hit[:, 3])
+    out = np.where(hit[:, 3] >= 0, -1, 0)
+    for k in (1, 2, 3):
+        out = np.where((hit[:, k - 1] >= 0) & (hit[:, k - 1] < sl_bar), k, out)
+    return out
+
+def read_signals(path):
+    # JSONL of recorded signals: flat records or bulk/history records with a "result" object;
+    # "ts" is required (epoch seconds/ms or ISO). Levels are read from the stored strings.
+    cols = {k: [] for k in ("symbol", "ts", "buy", "conf", "entry", "tp1", "tp2", "tp3", "sl")}
+    skipped = 0
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            rec = json.loads(line)
+            r = rec.get("result", rec)
+            entry = _parse_entry_anchor(str(r.get("entry_zone", r.get("entry", "")) or ""))
+            ts = rec.get("ts", r.get("ts"))
+            if entry is None or ts is None:
+                skipped += 1
+                continue
+            sym = str(r.get("symbol", "") or "").upper()
+            cols["symbol"].append(instrument_symbol(sym) or sym)
+            cols["ts"].append(_parse_ts(ts))
+            cols["buy"].append(str(r.get("signal", "BUY")).upper() != "SELL")
+            cols["conf"].append(int(r.get("confidence", 50) or 50))
+            cols["entry"].append(entry)
+            for k in ("tp1", "tp2", "tp3", "sl"):
+                nums = _extract_floats(str(r.get(k, "") or ""))
+                cols[k].append(nums[0] if nums else np.nan)
+    sig = {
+        "symbol": np.array(cols["symbol"], dtype=str),
+        "ts": np.array(cols["ts"], dtype=np.float64),
+        "buy": np.array(cols["buy"], dtype=bool),
+        "conf": np.array(cols["conf"], dtype=np.int64),
+        "entry": np.array(cols["entry"], dtype=np.float64),
+        "tps": np.array([cols["tp1"], cols["tp2"], cols["tp3"]], dtype=np.float64).reshape(3, -1).T,
+        "sl": np.array(cols["sl"], dtype=np.float64),
+    }
+    return sig, skipped
+
+def run_backtest(sig, bars_for_symbol, max_bars=1440):
+    # bars_for_symbol(symbol) -> (t, high, low) or None. Returns per-signal arrays aligned with sig;
+    # signals without bar data get outcome code -2.
+    N = len(sig["ts"])
+    res = {"outcome": np.full(N, -2, dtype=np.int64), "secs": np.full((N, 4), np.nan),
+           "mfe_pts": np.full(N, np.nan), "mae_pts": np.full(N, np.nan)}
+    for sym in np.unique(sig["symbol"]):
+        bars = bars_for_symbol(str(sym))
+        if bars is None or not len(bars[0]):
+            continue
+        sel = np.nonzero(sig["symbol"] == sym)[0]
+        hit, secs, mfe, mae = backtest_symbol(*bars, sig["ts"][sel], sig["buy"][sel], sig["entry"][sel],
+                                              sig["tps"][sel], sig["sl"][sel], max_bars)
+        spec = INSTRUMENTS.get(str(sym))
+        point = spec["point"] if spec else POINT_VALUE
+        res["outcome"][sel] = backtest_outcomes(hit)
+        res["secs"][sel] = secs
+        res["mfe_pts"][sel] = mfe / point
+        res["mae_pts"][sel] = mae / point
+    return res
+
+def backtest_report(sig, res):
+    # per symbol and per confidence bucket (confidence_label_key): hit rates, median time, MFE/MAE
+    tested = res["outcome"] > -2
+    print(f"signals: {len(tested)}, with bar data: {int(tested.sum())}")
+    if not tested.any():
+        return
+    buckets = np.array([confidence_label_key(c) for c in sig["conf"]])
+    out, secs = res["outcome"], res["secs"]
+    print(f"{'group':<14}{'n':>9}{'TP1':>7}{'TP2':>7}{'TP3':>7}{'SL':>7}{'open':>7}"
+          f"{'t TP1 m':>9}{'t SL m':>9}{'MFE pt':>9}{'MAE pt':>9}")
+
+    def row(label, m):
+        m = m & tested
+        n = int(m.sum())
+        if not n:
+            return
+        pct = lambda x: 100.0 * np.count_nonzero(x & m) / n
+        med = lambda col, x: np.median(secs[x & m, col]) / 60.0 if np.any(x & m) else float("nan")
+        print(f"{label:<14}{n:>9}{pct(out >= 1):>6.1f}%{pct(out >= 2):>6.1f}%{pct(out >= 3):>6.1f}%"
+              f"{pct(out == -1):>6.1f}%{pct(out == 0):>6.1f}%{med(0, out >= 1):>9.1f}{med(3, out == -1):>9.1f}"
+              f"{np.nanmean(res['mfe_pts'][m]):>9.0f}{np.nanmean(res['mae_pts'][m]):>9.0f}")
+
+    row("all", tested)
+    for sym in np.unique(sig["symbol"][tested]):
+        row(str(sym) or "?", sig["symbol"] == sym)
+    for key in ("strong_mom", "mild_mom", "neutral_mom", "low_conv"):
+        row(key, buckets == key)
+
+def _synthetic_backtest(signals, symbols=("XAUUSD", "EURUSD", "BTCUSD"), bars=525_600, seed=1):
+    # one year of random-walk M1 bars per symbol + random signals with engine TPs and a 300 pt SL
+    rng = np.random.default_rng(seed)
+    base = {"XAUUSD": 2350.0, "EURUSD": 1.085, "BTCUSD": 64000.0}
+    t = 1_700_000_000 + 60 * np.arange(bars, dtype=np.int64)
+    data = {}
+    for sym in symbols:
+        close = base.get(sym, 100.0) * np.exp(np.cumsum(rng.normal(0, 0.0004, bars)))
+        spread = close * np.abs(rng.normal(0, 0.0003, bars))
+        data[sym] = (t.astype(np.float64), close + spread, close - spread, close)
+
+    which = rng.integers(0, len(symbols), signals)
+    syms = np.array(symbols)[which]
+    at = rng.integers(0, bars - 1, signals)
+    entry = np.empty(signals)
+    for i, sym in enumerate(symbols):
+        entry[which == i] = data[sym][3][at[which == i]]
+    buy = rng.random(signals) < 0.5
+    conf = rng.integers(40, 95, signals)
+    tps, _, _ = compute_tp_sl(syms, np.full(signals, "M15"), buy, conf, entry, np.full(signals, 2), np.full(signals, np.nan))
+    point = np.array([INSTRUMENTS[sym]["point"] for sym in symbols])[which]
+    sl = entry - np.where(buy, 1.0, -1.0) * 300 * point
+    sig = {"symbol": syms, "ts": t[at] + 1.0, "buy": buy, "conf": conf, "entry": entry, "tps": tps, "sl": sl}
+    return sig, (lambda sym: data[sym][:3] if sym in data else None)
+
+def backtest(signals_path, ohlcv_dir, max_bars=1440, out_path="", synthetic=0):
+    t0 = time.perf_counter()
+    if synthetic:
+        sig, bars_for_symbol = _synthetic_backtest(synthetic)
+        skipped = 0
+    else:
+        if os.path.isdir(signals_path):
+            sig, skipped = history_signals(HistoryStore(signals_path))
+        else:
+            sig, skipped = read_signals(signals_path)
+        cache = {}
+
+        def bars_for_symbol(sym):
+            if sym not in cache:
+                path = _ohlcv_path(ohlcv_dir, sym)
+                cache[sym] = load_ohlcv(path) if path else None
+            return cache[sym]
+    t1 = time.perf_counter()
+    res = run_backtest(sig, bars_for_symbol, max_bars)
+    t2 = time.perf_counter()
+
+    backtest_report(sig, res)
+    print(f"load {t1 - t0:.1f}s, backtest {t2 - t1:.1f}s ({len(sig['ts']) / max(1e-9, t2 - t1):,.0f} signals/s)"
+          + (f", {skipped} records without ts/entry skipped" if skipped else ""))
+    if out_path:
+        with open(out_path, "w", encoding="utf-8") as out:
+            for i in range(len(sig["ts"])):
+                secs = res["secs"][i]
+                out.write(json.dumps({
+                    "symbol": str(sig["symbol"][i]), "ts": float(sig["ts"][i]),
+                    "outcome": BACKTEST_OUTCOMES.get(int(res["outcome"][i]), "no_data"),
+                    "secs_to": {k: (None if np.isnan(v) else float(v)) for k, v in zip(("tp1", "tp2", "tp3", "sl"), secs)},
+                    "mfe_pts": None if np.isnan(res["mfe_pts"][i]) else round(float(res["mfe_pts"][i]), 1),
+                    "mae_pts": None if np.isnan(res["mae_pts"][i]) else round(float(res["mae_pts"][i]), 1),
+                }) + "\n")
+
+def history_signals(history, since="", until=""):
+    # recorded signals straight from the columnar history, in read_signals() form
+    h = history.scan(["ts", "symbol", "signal", "confidence", "anchor", "tp1", "tp2", "tp3", "sl"], since, until)
+    ok = ~np.isnan(h["anchor"])
+    # broker spellings ("XAUUSDm", "EURUSD.pro") -> table symbol, as read_signals() does
+    syms, inv = np.unique(h["symbol"][ok].astype("U12"), return_inverse=True)
+    canon = np.array([instrument_symbol(s) or s.upper() for s in syms], dtype="U12")
+    return {
+        "symbol": canon[inv.ravel()] if len(syms) else syms,
+        "ts": h["ts"][ok],
+        "buy": h["signal"][ok] > 0,
+        "conf": h["confidence"][ok].astype(np.int64),
+        "entry": h["anchor"][ok],
+        "tps": np.column_stack([h["tp1"][ok], h["tp2"][ok], h["tp3"][ok]]),
+        "sl": h["sl"][ok],
+    }, int((~ok).sum())
+
+def history_report(root, since="", until=""):
+    history = HistoryStore(root)
+    t0 = time.perf_counter()
+    h = history.scan(["ts", "symbol", "signal", "confidence", "latency_ms", "tokens_in", "tokens_out", "source"],
+                     since, until)
+    scan = time.perf_counter() - t0
+    n = len(h["ts"])
+    days = history.segments(since, until)
+    print(f"history: {n:,} signals in {len(days)} day(s){f' ({days[0]} .. {days[-1]})' if days else ''}, scanned in {scan:.2f}s")
+    if not n:
+        return
+
+    src = np.bincount(h["source"], minlength=len(HISTORY_SOURCES))
+    print("source: " + ", ".join(f"{name}={100.0 * src[i] / n:.1f}%" for i, name in enumerate(HISTORY_SOURCES)))
+    model = h["source"] == HISTORY_SOURCES.index("model")
+    if model.any():
+        lat = h["latency_ms"][model]
+        print(f"model calls: {int(model.sum()):,}, latency p50={np.percentile(lat, 50):.0f}ms p95={np.percentile(lat, 95):.0f}ms,"
+              f" tokens in={int(h['tokens_in'].sum()):,} out={int(h['tokens_out'].sum()):,}"
+              f" ({h['tokens_in'][model].mean():.0f}/{h['tokens_out'][model].mean():.0f} per call)")
+
+    syms, inv = np.unique(h["symbol"], return_inverse=True)
+    count = np.bincount(inv, minlength=len(syms))
+    buys = np.bincount(inv, weights=(h["signal"] > 0), minlength=len(syms))
+    conf = np.bincount(inv, weights=h["confidence"], minlength=len(syms))
+    print(f"{'symbol':<12}{'n':>10}{'buy%':>8}{'conf':>7}")
+    for i in np.argsort(-count)[:20]:
+        print(f"{syms[i].decode('ascii') or '?':<12}{count[i]:>10,}{100.0 * buys[i] / count[i]:>7.1f}%{conf[i] / count[i]:>7.1f}")
+
+    per_day = np.bincount((h["ts"] // 86400 - h["ts"].min() // 86400).astype(np.int64))
+    print(f"signals/day: mean={per_day.mean():.0f} max={per_day.max()}")
+
+# ============================================================
+# Benchmarks
+# ============================================================
+def bench_journal(entries=1_000_000, users=50_000):
+    # Cold-start cost of the json backend: replay N journal entries on top of an empty snapshot.
+    import tempfile
+    rng = random.Random(1)
+    with tempfile.TemporaryDirectory() as d:
+        path = os.path.join(d, "db.json")
+        with open(path + ".journal", "w", encoding="utf-8") as f:
+            for q in range(1, entries + 1):
+                uid = str(rng.randrange(users))
+                r = rng.random()
+                if r < 0.8:
+                    e = {"k": "trial_used", "n": 1, "q": q, "u": uid, "op": "incr"}
+                elif r < 0.9:
+                    e = {"f": {"lang": rng.choice(list(LANGS))}, "q": q, "u": uid, "op": "set"}
+                else:
+                    e = {"f": {"plan": rng.choice(PLANS), "expires_at": 0}, "q": q, "u": uid, "op": "set"}
+                f.write(json.dumps(e, separators=(",", ":")) + "\n")
+        size_mb = os.path.getsize(path + ".journal") / 1e6
+
+        t0 = time.perf_counter()
+        store = JsonUserStore(path)
+        replay = time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        store.compact()
+        compact = time.perf_counter() - t0
+        store.close()
+
+        t0 = time.perf_counter()
+        JsonUserStore(path).close()
+        snapshot = time.perf_counter() - t0
+
+    print(f"journal: {entries} entries, {size_mb:.1f} MB, {len(store.ids())} users")
+    print(f"replay:   {replay:.2f}s ({entries / replay:,.0f} entries/s)")
+    print(f"compact:  {compact:.2f}s")
+    print(f"snapshot: {snapshot:.3f}s cold start after compaction")
+
+def _draw_synthetic_chart(w, h, rng):
+    img = Image.new("RGB", (w, h), (19, 23, 34))
+    d = ImageDraw.Draw(img)
+    top, axis = int(h * 0.08), int(w * 0.9)
+    d.rectangle([0, 0, w, top], fill=(42, 46, 57))
+    for i in range(8):
+        d.rectangle([10 + i * 60, top // 4, 50 + i * 60, top * 3 // 4], fill=(70, 75, 90))
+    for y in range(top, h, max(1, h // 10)):
+        d.line([0, y, axis, y], fill=(35, 40, 52))
+    for x in range(0, axis, max(1, w // 12)):
+        d.line([x, top, x, h], fill=(35, 40, 52))
+    d.line([axis, top, axis, h], fill=(90, 95, 110))
+    for y in range(top + 20, h, 60):
+        d.text((axis + 8, y), f"{2300 + (h - y) / 10:.1f}", fill=(200, 200, 210))
+    price = (top + h) / 2.0
+    cw = max(3, w // 160)
+    for x in range(cw, axis - cw * 2, cw * 2):
+        o = price
+        price = min(h - 20, max(top + 20, price + rng.uniform(-h / 40, h / 40)))
+        hi, lo = min(o, price) - rng.uniform(0, h / 60), max(o, price) + rng.uniform(0, h / 60)
+        col = (38, 166, 154) if price < o else (239, 83, 80)
+        d.line([x + cw // 2, hi, x + cw // 2, lo], fill=col)
+        d.rectangle([x, min(o, price), x + cw - 1, max(o, price) + 1], fill=col)
+    return img
+
+def _synthetic_chart(w=1280, h=720, seed=0, fmt="JPEG", chrome=False):
+    # Chart-like screenshot: dark background, grid, candles, price axis and a toolbar strip.
+    # chrome=True adds what real screenshots carry around the chart: a watchlist panel
+    # (desktop, even seeds) or phone status/nav bars and an order panel (odd seeds).
+    rng = random.Random(seed)
+    if not chrome:
+        img = _draw_synthetic_chart(w, h, rng)
+    else:
+        img = Image.new("RGB", (w, h), (12, 12, 14))
+        d = ImageDraw.Draw(img)
+        if seed % 2 == 0:
+            cw = int(w * 0.76)
+            img.paste(_draw_synthetic_chart(cw, h, rng), (0, 0))
+            d.rectangle([cw, 0, w, h], fill=(30, 34, 45))
+            for i, y in enumerate(range(20, h, 28)):
+                d.text((cw + 12, y), f"SYM{i:02d}   {rng.uniform(1, 3000):.2f}", fill=(220, 220, 225))
+                d.text((w - 60, y), f"{rng.uniform(-3, 3):+.2f}%", fill=(38, 166, 154) if i % 3 else (239, 83, 80))
+        else:
+            sb, nb, panel = int(h * 0.035), int(h * 0.06), int(h * 0.25)
+            d.text((20, sb // 3), "9:41", fill=(255, 255, 255))
+            img.paste(_draw_synthetic_chart(w, h - sb - nb - panel, rng), (0, sb))
+            y0 = h - nb - panel
+            d.rectangle([0, y0, w, h - nb], fill=(245, 246, 250))
+            for i, y in enumerate(range(y0 + 30, h - nb - 30, 50)):
+                d.text((30, y), f"Order {i}: {rng.uniform(1, 3000):.2f}", fill=(30, 30, 30))
+            d.rectangle([0, h - nb, w, h], fill=(28, 28, 30))
+            for i in range(5):
+                d.ellipse([w * (i + 0.4) / 5, h - nb * 0.8, w * (i + 0.6) / 5, h - nb * 0.2], fill=(90, 90, 95))
+    out = BytesIO()
+    img.save(out, format=fmt, quality=90)
+    return out.getvalue()
+
+def _synthetic_non_chart(w=1280, h=720, seed=0, fmt="JPEG"):
+    # What users send instead of charts: photos, selfies, memes, blank screens, chat screenshots
+    rng = random.Random(seed)
+    kind = ("photo", "selfie", "meme", "blank", "chat")[seed % 5]
+    if kind == "blank":
+        img = Image.new("RGB", (w, h), rng.choice([(255, 255, 255), (0, 0, 0), (18, 18, 20), (240, 240, 245)]))
+    elif kind == "chat":
+        img = Image.new("RGB", (w, h), (255, 255, 255))
+        d = ImageDraw.Draw(img)
+        y = h * 0.08
+        while y < h * 0.9:
+            mine = rng.random() < 0.5
+            bw, bh = rng.uniform(0.3, 0.7) * w, rng.uniform(0.04, 0.12) * h
+            x0 = w - bw - 20 if mine else 20
+            d.rounded_rectangle([x0, y, x0 + bw, y + bh], radius=20, fill=(220, 248, 198) if mine else (240, 240, 240))
+            for ly in range(int(y + 10), int(y + bh - 20), max(1, int(h * 0.025))):
+                d.text((x0 + 15, ly), "see you at the meeting tomorrow"[:int(bw / 14)], fill=(0, 0, 0), font_size=h // 45)
+            y += bh + h * 0.02
+    else:
+        img = Image.new("RGB", (w, h))
+        d = ImageDraw.Draw(img)
+        c0 = [rng.randrange(256) for _ in range(3)]
+        c1 = [rng.randrange(256) for _ in range(3)]
+        for y in range(h):
+            a = y / float(h)
+            d.line([0, y, w, y], fill=tuple(int(c0[i] * (1 - a) + c1[i] * a) for i in range(3)))
+        for _ in range(rng.randint(5, 25)):
+            x, y, r = rng.randrange(w), rng.randrange(h), rng.randint(w // 30, w // 5)
+            d.ellipse([x - r, y - r, x + r, y + r * rng.uniform(0.5, 2)], fill=tuple(rng.randrange(256) for _ in range(3)))
+        if kind == "selfie":
+            d.ellipse([w * 0.25, h * 0.15, w * 0.75, h * 0.8], fill=(224, 172, 140))
+            d.ellipse([w * 0.38, h * 0.35, w * 0.45, h * 0.4], fill=(40, 30, 30))
+            d.ellipse([w * 0.55, h * 0.35, w * 0.62, h * 0.4], fill=(40, 30, 30))
+        img = img.filter(ImageFilter.GaussianBlur(w / 200.0))
+        img = Image.blend(img, Image.effect_noise((w, h), 30).convert("RGB"), 0.12)
+        if kind == "meme":
+            d = ImageDraw.Draw(img)
+            for y in (h * 0.05, h * 0.85):
+                d.text((w * 0.1, y), "WHEN THE MARKET DUMPS", fill=(255, 255, 255), stroke_width=3,
+                       stroke_fill=(0, 0, 0), font_size=h // 12)
+    out = BytesIO()
+    img.save(out, format=fmt, quality=90)
+    return out.getvalue()
+
+class _StubMessage:
+    # just enough of telegram.Message for handle_photo
+    def __init__(self, log, text="", photo=None, caption=""):
+        self.log = log
+        self.text = text
+        self.photo = photo or []
+        self.caption = caption
+        self.document = None
+        self.chat = self
+
+    async def reply_text(self, text, **kwargs):
+        self.log.append(text)
+        return _StubMessage(self.log, text)
+
+    async def edit_text(self, text, **kwargs):
+        self.log.append(text)
+        self.text = text
+        return self
+
+    async def send_action(self, action):
+        pass
+
+async def loadtest(users=1000, photos=1, distinct=200, paid_ratio=0.2):
+    # End-to-end handle_photo throughput with stub Telegram objects and the mock vision backend.
+    import tempfile
+    from types import SimpleNamespace as NS
+    global DB_FILE, DB_SQLITE_FILE, _STORE, _HISTORY, _SESSIONS
+
+    images = [_synthetic_chart(1280, 720, seed=i) for i in range(max(1, distinct))]
+
+    async def get_file(file_id):
+        data = images[int(file_id)]
+
+        async def download_to_memory(out):
+            await asyncio.sleep(0.05)  # Telegram file download
+            out.write(data)
+        return NS(download_to_memory=download_to_memory)
+
+    ctx_bot = NS(get_file=get_file)
+    latencies, outcomes = [], {}
+    tt = T[DEFAULT_LANG]
+
+    async def user_session(uid):
+        ctx = NS(bot=ctx_bot, user_data={})
+        for k in range(photos):
+            idx = (uid * photos + k) % len(images)
+            log = []
+            photo = [NS(file_id=str(idx), file_unique_id=f"u{idx}", width=1280, height=720, file_size=len(images[idx]))]
+            update = NS(message=_StubMessage(log, photo=photo), effective_user=NS(id=uid, username=f"u{uid}"))
+            t0 = time.monotonic()
+            await handle_photo(update, ctx)
+            latencies.append(time.monotonic() - t0)
+            final = log[-1] if log else ""
+            kind = "ok" if final.startswith(tt["header"]) else (
+                "failed" if final.startswith(tt["analysis_failed"]) else "busy/other")
+            outcomes[kind] = outcomes.get(kind, 0) + 1
+
+    with tempfile.TemporaryDirectory() as d:
+        # both backends' files in the temp dir: a db.json next to the bot is never read or migrated
+        DB_FILE, DB_SQLITE_FILE, _STORE = os.path.join(d, "db.json"), os.path.join(d, "load.sqlite3"), None
+        _HISTORY = HistoryStore(os.path.join(d, "history"))
+        _SESSIONS = SqliteSessionStore(os.path.join(d, "sessions.sqlite3"))
+        db = open_store()
+        for uid in range(users):
+            db.insert(uid, _default_user())
+            if uid < users * paid_ratio:
+                db.update(uid, plan="PAID")
+
+        t0 = time.monotonic()
+        await asyncio.gather(*(user_session(uid) for uid in range(users)))
+        wall = time.monotonic() - t0
+        db.close()
+        _STORE = None
+        _HISTORY.flush()
+        recorded = len(_HISTORY.scan(["ts"])["ts"])
+        _HISTORY = None
+        _SESSIONS.close()
+        _SESSIONS = None
+    await close_openai_client()
+    shutdown_preprocess_pool()
+
+    xs = sorted(latencies)
+    pct = lambda p: xs[min(len(xs) - 1, int(p / 100.0 * (len(xs) - 1)))]
+    print(f"users={users} photos/user={photos} distinct images={len(images)} backend={VISION_BACKEND} stream={STREAM_REPLIES}")
+    print(f"analyses: {len(xs)} in {wall:.2f}s -> {len(xs) / wall:.1f}/s")
+    print(f"handle_photo latency s: p50={pct(50):.2f} p95={pct(95):.2f} p99={pct(99):.2f} max={xs[-1]:.2f}")
+    print(f"outcomes: {outcomes}, recorded to history: {recorded}")
+    print("stats: " + ", ".join(f"{k}={STATS[k]}" for k in sorted(STATS)))
+
+async def bench_dispatch(seconds=10.0, photo_rate=20.0, tap_rate=50.0, analysis=3.0, users=2000):
+    # Synthetic updates fed to each processor the way Application does (one task per update):
+    # photos from some users hold a handler for `analysis` s, taps from other users take 5 ms.
+    from types import SimpleNamespace as NS
+    from telegram.ext import SimpleUpdateProcessor
+
+    rng = random.Random(7)
+    arrivals, t = [], 0.0
+    while t < seconds:
+        t += rng.expovariate(photo_rate + tap_rate)
+        photo = rng.random() < photo_rate / (photo_rate + tap_rate)
+        chat = rng.randrange(users // 2) if photo else users // 2 + rng.randrange(users // 2)
+        arrivals.append((t, chat, photo, False))
+    # a few taps right behind the same chat's own photo, to check ordering
+    arrivals += [(t0 + 0.01, chat, False, True) for t0, chat, photo, _ in arrivals[:200] if photo]
+    arrivals.sort()
+
+    async def run(processor):
+        taps, own_taps, busy, overlap = [], [], set(), 0
+
+        async def handler(at, chat, photo, own):
+            nonlocal overlap
+            overlap += chat in busy  # another update of this chat still running
+            busy.add(chat)
+            await asyncio.sleep(analysis if photo else 0.005)
+            busy.discard(chat)
+            if not photo:
+                (own_taps if own else taps).append(time.monotonic() - at)
+
+        t0 = time.monotonic()
+        tasks = []
+        for at, chat, photo, own in arrivals:
+            delay = t0 + at - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            update = NS(effective_chat=NS(id=chat), effective_message=NS(photo=[1] if photo else None, document=None))
+            coroutine = handler(time.monotonic(), chat, photo, own)
+            if processor is None:  # PTB default: the fetcher awaits each update in turn
+                tasks.append(coroutine)
+            else:
+                tasks.append(asyncio.create_task(processor.process_update(update, coroutine)))
+        if processor is None:
+            for coroutine in tasks:
+                await coroutine
+        else:
+            await asyncio.gather(*tasks)
+        return taps, own_taps, overlap, time.monotonic() - t0
+
+    photos = sum(1 for a in arrivals if a[2])
+    own = sum(1 for a in arrivals if a[3])
+    print(f"{len(arrivals)} updates over {seconds:.0f}s: {photos} photos ({analysis:.1f}s each), "
+          f"{len(arrivals) - photos} taps ({own} right behind their chat's photo), "
+          f"workers={UPDATE_WORKERS} heavy={UPDATE_HEAVY_WORKERS}")
+    pct = lambda xs, p: sorted(xs)[min(len(xs) - 1, int(p / 100.0 * (len(xs) - 1)))] * 1000 if xs else 0.0
+    for name, processor in (("sequential", None),
+                            ("concurrent", SimpleUpdateProcessor(UPDATE_WORKERS)),
+                            ("ordered", ChatOrderedProcessor(UPDATE_WORKERS, UPDATE_HEAVY_WORKERS, UPDATE_PENDING_MAX))):
+        if name == "sequential" and photos * analysis > 120:
+            print("sequential: skipped (would take", f"{photos * analysis:.0f}s)")
+            continue
+        taps, own_taps, overlap, wall = await run(processor)
+        print(f"{name:>10}: tap latency p50={pct(taps, 50):.0f}ms p99={pct(taps, 99):.0f}ms "
+              f"max={pct(taps, 100):.0f}ms | behind own photo p50={pct(own_taps, 50):.0f}ms | "
+              f"same-chat overlaps: {overlap} | wall {wall:.1f}s")
+
+def _prepare_reference(image_bytes, max_side=1100, quality=85):
+    # the original pipeline (full decode, convert, bicubic resize, optimized encode), for comparison
+    img = Image.open(BytesIO(image_bytes)).convert("RGB")
+    w, h = img.size
+    scale = min(1.0, float(max_side) / float(max(w, h)))
+    if scale < 1.0:
+        img = img.resize((int(w * scale), int(h * scale)))
+    out = BytesIO()
+    img.save(out, format="JPEG", quality=quality, optimize=True)
+    return base64.b64encode(out.getvalue()).decode("utf-8")
+
+def _bench_rate(fn, corpus, seconds):
+    n, t0 = 0, time.perf_counter()
+    while time.perf_counter() - t0 < seconds:
+        fn(corpus[n % len(corpus)])
+        n += 1
+    return n / (time.perf_counter() - t0)
+
+def bench_preprocess(seconds=3.0, workers=None):
+    # images/sec for typical 2-4 MP phone screenshots (JPEG as Telegram delivers photos, PNG as documents)
+    sizes = [(1080, 1920), (1080, 2400), (1170, 2532), (1284, 2778)]
+    workers = workers or PREPROCESS_WORKERS
+    for fmt in ("JPEG", "PNG"):
+        corpus = [_synthetic_chart(w, h, seed=i, fmt=fmt) for i, (w, h) in enumerate(sizes)]
+        mp = sum(w * h for w, h in sizes) / len(sizes) / 1e6
+        ref = _bench_rate(_prepare_reference, corpus, seconds)
+        new = _bench_rate(prepare_chart_image, corpus, seconds)
+
+        total = max(8, int(new * seconds * workers))
+        with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+            list(pool.map(prepare_chart_image, corpus * workers))  # warm up workers
+            t0 = time.perf_counter()
+            list(pool.map(prepare_chart_image, (corpus[i % len(corpus)] for i in range(total)), chunksize=1))
+            pooled = total / (time.perf_counter() - t0)
+
+        print(f"{fmt} {mp:.1f} MP avg:")
+        print(f"  reference pipeline: {ref:7.1f} img/s (1 core)")
+        print(f"  fast path:          {new:7.1f} img/s (1 core)  x{new / ref:.1f}")
+        print(f"  process pool:       {pooled:7.1f} img/s ({workers} workers, {pooled / workers:.1f} img/s/core)")
+
+def eval_encoder(src="", synthetic=24):
+    # Input-token and encode-latency comparison for MODEL_VISION: whole screenshot at 1100 px vs
+    # crop + token-grid sizing.
+    if src:
+        names = [p for p in _bulk_inputs(src)]
+        corpus = []
+        for p in names:
+            with open(p, "rb") as f:
+                corpus.append(f.read())
+    else:
+        sizes = [(1280, 720), (1920, 1080), (1080, 2400), (1170, 2532)]
+        names = [f"synthetic-{i}" for i in range(synthetic)]
+        corpus = [_synthetic_chart(*sizes[(i // 2) % len(sizes)], seed=i, chrome=True) for i in range(synthetic)]
+
+    rows = []
+    for name, data in zip(names, corpus):
+        t0 = time.perf_counter()
+        ref = _downscale_rgb(data, 1100)
+        ref_b64 = _jpeg_base64(ref, 85)
+        t1 = time.perf_counter()
+        prep = prepare_chart_image(data, 1100, 85)
+        t2 = time.perf_counter()
+        rows.append((name, estimate_image_tokens(*ref.size), estimate_image_tokens(*prep["size"]),
+                     len(ref_b64), len(prep["b64"]), t1 - t0, t2 - t1, prep["crop"] is not None, prep["size"]))
+        print(f"{name}: {ref.size[0]}x{ref.size[1]} -> {prep['size'][0]}x{prep['size'][1]}"
+              f" crop={prep['crop']} tokens {rows[-1][1]} -> {rows[-1][2]}")
+
+    n = len(rows) or 1
+    tok0, tok1 = sum(r[1] for r in rows), sum(r[2] for r in rows)
+    kb0, kb1 = sum(r[3] for r in rows) / 1024.0, sum(r[4] for r in rows) / 1024.0
+    print(f"model: {MODEL_VISION} ({image_token_model()[0]} accounting), images: {len(rows)}, "
+          f"cropped: {sum(r[7] for r in rows)}")
+    print(f"input tokens/image: {tok0 / n:.0f} -> {tok1 / n:.0f} ({100.0 * (tok1 - tok0) / max(1, tok0):+.0f}%)")
+    print(f"upload KB/image:    {kb0 / n:.0f} -> {kb1 / n:.0f}")
+    print(f"encode ms/image:    {1000 * sum(r[5] for r in rows) / n:.1f} -> {1000 * sum(r[6] for r in rows) / n:.1f}")
+
+def bench_history(days=90, per_day=20_000):
+    # append + scan speed of the columnar history: `days` segments of `per_day` signals
+    import tempfile
+    rng = random.Random(1)
+    names = [s.encode() for s in INSTRUMENTS]
+    with tempfile.TemporaryDirectory() as d:
+        history = HistoryStore(d)
+        t0 = time.perf_counter()
+        start = 1_700_000_000 - 1_700_000_000 % 86400
+        for day in range(days):
+            for i in range(per_day):
+                history.append((start + day * 86400 + i * 86400.0 / per_day, rng.randrange(50_000), rng.choice(names),
+                                b"H1", rng.choice((1, -1)), rng.randrange(40, 95), 2350.0, 2352.0, 2354.0, 2356.0,
+                                2345.0, rng.randrange(2000, 9000), 900, 40, rng.randrange(4)))
+            history.flush()
+        write = time.perf_counter() - t0
+        size = sum(os.path.getsize(os.path.join(r, f)) for r, _, fs in os.walk(d) for f in fs)
+        t0 = time.perf_counter()
+        h = history.scan(["symbol", "confidence", "latency_ms"])
+        scan = time.perf_counter() - t0
+        sig, _ = history_signals(history)
+        full = time.perf_counter() - t0 - scan
+    n = days * per_day
+    print(f"history: {n:,} signals over {days} days, {size / 1e6:.1f} MB ({size / n:.0f} B/signal)")
+    print(f"append+flush: {write:.2f}s ({n / write:,.0f}/s)")
+    print(f"scan 3 columns: {scan:.3f}s ({n / scan:,.0f}/s); backtest columns: {full:.3f}s ({len(h['symbol']):,} rows)")
+
+def bench_tp(n=1_000_000, sample=20_000):
+    # compute_tp_sl over n synthetic signals in one pass vs the per-result live path
+    rng = np.random.default_rng(1)
+    names = list(INSTRUMENTS) + ["UNKNOWN1", "XAUUSD.m"]
+    bases = {"XAUUSD": 2350.0, "EURUSD": 1.085, "GBPUSD": 1.27, "USDJPY": 155.0, "BTCUSD": 64000.0}
+    symbols = np.array(names)[rng.integers(0, len(names), n)]
+    timeframes = np.array(TIMEFRAMES)[rng.integers(0, len(TIMEFRAMES), n)]
+    base = np.array([bases.get(instrument_symbol(x), 100.0) for x in names])[rng.integers(0, len(names), n)]
+    anchor = base * (1 + rng.normal(0, 0.01, n))
+    buy = rng.random(n) < 0.5
+    conf = rng.integers(40, 95, n)
+    entry_digits = rng.integers(0, 5, n)
+    model_sl = anchor * np.where(buy, 0.995, 1.005)
+
+    t0 = time.perf_counter()
+    tps, sl, digits = compute_tp_sl(symbols, timeframes, buy, conf, anchor, entry_digits, model_sl)
+    vec = time.perf_counter() - t0
+
+    results = [{"symbol": str(symbols[i]), "timeframe": str(timeframes[i]), "signal": "BUY" if buy[i] else "SELL",
+                "confidence": int(conf[i]), "entry_zone": f"{anchor[i]:.2f}", "sl": f"{model_sl[i]:.2f}"}
+               for i in range(min(n, sample))]
+    t0 = time.perf_counter()
+    for r in results:
+        enforce_tp_rules(r)
+    per_row = (time.perf_counter() - t0) / max(1, len(results))
+
+    print(f"signals: {n:,} ({len(names)} symbols x {len(TIMEFRAMES)} timeframes)")
+    print(f"vectorized: {vec:.3f}s ({n / vec:,.0f} signals/s)")
+    print(f"per result: {per_row * 1e6:.1f} us ({1 / per_row:,.0f} signals/s, {n * per_row:.1f}s for {n:,})")
+
+GATE_FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "gate")
+
+def eval_gate(src="", synthetic=40, threshold=None):
+    # Precision/recall of the local chart gate ("chart" = positive class).
+    # src: directory with chart/ and other/ subdirectories of labelled images (default: the
+    # fixtures/gate set shipped with the bot). Synthetic selfies/memes/blanks are always added as
+    # negatives; synthetic charts only while there are no real ones.
+    threshold = CHART_GATE_THRESHOLD if threshold is None else threshold
+    src = src or (GATE_FIXTURES if os.path.isdir(GATE_FIXTURES) else "")
+    labelled = []
+    if src:
+        for label in ("chart", "other"):
+            folder = os.path.join(src, label)
+            for p in (_bulk_inputs(folder) if os.path.isdir(folder) else []):
+                with open(p, "rb") as f:
+                    labelled.append((os.path.relpath(p, src), label == "chart", f.read()))
+    sizes = [(1280, 720), (1920, 1080), (1080, 2400), (1170, 2532)]
+    if not any(c for _, c, _ in labelled):
+        labelled += [(f"synthetic/chart-{i}", True, _synthetic_chart(*sizes[(i // 2) % 4], seed=i, chrome=bool(i % 3)))
+                     for i in range(synthetic // 2)]
+    labelled += [(f"synthetic/other-{i}", False, _synthetic_non_chart(*sizes[(i // 2) % 4], seed=i))
+                 for i in range(synthetic - synthetic // 2)]
+
+    scored, ms = [], 0.0
+    for name, is_chart, data in labelled:
+        sm = _chart_thumbnail(_downscale_rgb(data, 2200, exact=False))  # shared with detect_chart_region
+        t0 = time.perf_counter()
+        score = chart_score(chart_features(sm))
+        ms += (time.perf_counter() - t0) * 1000
+        scored.append((name, is_chart, score))
+
+    def metrics(th):
+        tp = sum(1 for _, c, sc in scored if c and sc >= th)
+        fp = sum(1 for _, c, sc in scored if not c and sc >= th)
+        fn = sum(1 for _, c, sc in scored if c and sc < th)
+        return tp / float(max(1, tp + fp)), tp / float(max(1, tp + fn))
+
+    for name, is_chart, score in scored:
+        if is_chart != (score >= threshold):
+            print(f"misclassified: {name} ({'chart' if is_chart else 'other'}) score={score:.2f}")
+    precision, recall = metrics(threshold)
+    print(f"images: {len(scored)} from {src or 'synthetic'} ({sum(1 for _, c, _ in scored if c)} charts, "
+          f"{sum(1 for n, _, _ in scored if n.startswith('synthetic/'))} synthetic), "
+          f"gate {ms / max(1, len(scored)):.1f} ms/image")
+    print(f"threshold {threshold:.2f}: precision={precision:.3f} recall={recall:.3f}")
+    for th in (0.2, 0.3, 0.4, 0.5, 0.6, 0.7):
+        p, r = metrics(th)
+        print(f"  threshold {th:.1f}: precision={p:.3f} recall={r:.3f}")
+
+# ============================================================
+# CLI
+# ============================================================
+def cli(argv=None):
+    global OPENAI_BASE_URL, OPENAI_API_KEY, VISION_BACKEND, STREAM_REPLIES
+    parser = argparse.ArgumentParser(prog="bot.py", description="Trading AI bot")
+    sub = parser.add_subparsers(dest="cmd")
+    sub.add_parser("run", help="run the Telegram bot (default)")
+    p = sub.add_parser("migrate-db", help="one-shot import of db.json into the SQLite store")
+    p.add_argument("--json", default=DB_FILE)
+    p.add_argument("--sqlite", default=DB_SQLITE_FILE)
+
+    p = sub.add_parser("bench-journal", help="benchmark json-backend journal replay")
+    p.add_argument("--entries", type=int, default=1_000_000)
+    p.add_argument("--users", type=int, default=50_000)
+
+    p = sub.add_parser("bulk", help="analyze a directory or manifest of chart images to JSONL")
+    p.add_argument("input", help="image directory, or manifest (.txt paths / .jsonl with 'path')")
+    p.add_argument("--out", default="bulk_results.jsonl", help="JSONL output; re-running resumes from it")
+    p.add_argument("--concurrency", type=int, default=16, help="vision calls in flight")
+    p.add_argument("--workers", type=int, default=None, help="preprocessing processes (default: CPU count)")
+    p.add_argument("--base-url", default="", help="vision endpoint, e.g. a local stand-in server")
+
+    p = sub.add_parser("mock-server", help="serve a deterministic mock of the Responses API")
+    p.add_argument("--host", default="127.0.0.1")
+    p.add_argument("--port", type=int, default=8765)
+    p.add_argument("--latency", default=MOCK_LATENCY, help="const:S | uniform:A,B | exp:MEAN | lognormal:MU,SIGMA")
+    p.add_argument("--error-rate", type=float, default=MOCK_ERROR_RATE)
+    p.add_argument("--malformed-rate", type=float, default=MOCK_MALFORMED_RATE)
+    p.add_argument("--seed", type=int, default=MOCK_SEED)
+
+    p = sub.add_parser("loadtest", help="drive handle_photo with N concurrent stub users")
+    p.add_argument("--users", type=int, default=1000)
+    p.add_argument("--photos", type=int, default=1, help="photos per user (sent one after another)")
+    p.add_argument("--distinct", type=int, default=200, help="distinct images (fewer = more cache hits)")
+    p.add_argument("--paid-ratio", type=float, default=0.2)
+    p.add_argument("--base-url", default="", help="use a running mock-server instead of the in-process mock")
+    p.add_argument("--no-stream", action="store_true")
+
+    p = sub.add_parser("bench-preprocess", help="benchmark image preprocessing (images/sec per core)")
+    p.add_argument("--seconds", type=float, default=3.0)
+    p.add_argument("--workers", type=int, default=None)
+
+    p = sub.add_parser("eval-encoder", help="input tokens before/after chart auto-crop + token-grid sizing (for MODEL_VISION)")
+    p.add_argument("input", nargs="?", default="", help="image directory or manifest (default: synthetic corpus)")
+    p.add_argument("--synthetic", type=int, default=24)
+
+    p = sub.add_parser("bench-tp", help="benchmark the vectorized TP/SL engine")
+    p.add_argument("--signals", type=int, default=1_000_000)
+
+    p = sub.add_parser("recompute-tp", help="recompute TP/SL levels of bulk results (e.g. after editing INSTRUMENTS_FILE)")
+    p.add_argument("input", help="bulk JSONL results")
+    p.add_argument("--out", required=True)
+
+    p = sub.add_parser("backtest", help="score recorded signals against local OHLCV bars")
+    p.add_argument("signals", nargs="?", default="", help="signals JSONL (needs ts, symbol, signal, entry_zone, tp1-tp3, sl) or a history directory")
+    p.add_argument("--ohlcv", default="", help="directory of SYMBOL[_TF].csv / .parquet bar files")
+    p.add_argument("--max-bars", type=int, default=1440, help="bars to follow each signal")
+    p.add_argument("--out", default="", help="optional per-signal JSONL")
+    p.add_argument("--synthetic", type=int, default=0, help="N random signals on generated bars (timing)")
+
+    p = sub.add_parser("history-report", help="summarize the signal history")
+    p.add_argument("--dir", default=HISTORY_DIR or "history")
+    p.add_argument("--since", default="", help="YYYY-MM-DD (inclusive)")
+    p.add_argument("--until", default="", help="YYYY-MM-DD (inclusive)")
+
+    p = sub.add_parser("bench-history", help="benchmark signal history append and scan")
+    p.add_argument("--days", type=int, default=90)
+    p.add_argument("--per-day", type=int, default=20_000)
+
+    p = sub.add_parser("bench-dispatch", help="tap latency while analyses run, per update processor")
+    p.add_argument("--seconds", type=float, default=10.0)
+    p.add_argument("--photo-rate", type=float, default=20.0, help="photos/s")
+    p.add_argument("--tap-rate", type=float, default=50.0, help="button taps/s")
+    p.add_argument("--analysis", type=float, default=3.0, help="seconds per analysis")
+
+    p = sub.add_parser("eval-gate", help="precision/recall of the local chart gate")
+    p.add_argument("input", nargs="?", default="", help="directory with chart/ and other/ (default: fixtures/gate)")
+    p.add_argument("--synthetic", type=int, default=40, help="synthetic images for an empty class")
+    p.add_argument("--threshold", type=float, default=None, help=f"default: CHART_GATE_THRESHOLD ({CHART_GATE_THRESHOLD})")
+
+    args = parser.parse_args(argv)
+
+    if args.cmd == "bench-tp":
+        bench_tp(args.signals)
+        return
+
+    if args.cmd == "recompute-tp":
+        with open(args.input, "r", encoding="utf-8") as f:
+            records = [json.loads(line) for line in f if line.strip()]
+        with open(args.out, "w", encoding="utf-8") as out:
+            for rec in recompute_tp(records):
+                out.write(json.dumps(rec, ensure_ascii=False) + "\n")
+        print(f"✅ Recomputed {sum(1 for r in records if r.get('ok'))} signals -> {args.out}")
+        return
+
+    if args.cmd == "backtest":
+        if not args.synthetic and not (args.signals and args.ohlcv):
+            parser.error("backtest needs SIGNALS and --ohlcv (or --synthetic N)")
+        backtest(args.signals, args.ohlcv, args.max_bars, args.out, args.synthetic)
+        return
+
+    if args.cmd == "history-report":
+        history_report(args.dir, args.since, args.until)
+        return
+
+    if args.cmd == "bench-history":
+        bench_history(args.days, args.per_day)
+        return
+
+    if args.cmd == "bench-dispatch":
+        asyncio.run(bench_dispatch(args.seconds, args.photo_rate, args.tap_rate, args.analysis))
+        return
+
+    if args.cmd == "eval-gate":
+        eval_gate(args.input, args.synthetic, args.threshold)
+        return
+
+    if args.cmd == "eval-encoder":
+        eval_encoder(args.input, args.synthetic)
+        return
+
+    if args.cmd == "bench-preprocess":
+        bench_preprocess(args.seconds, args.workers)
+        return
+
+    if args.cmd == "mock-server":
+        responder = MockResponder(args.latency, args.error_rate, args.malformed_rate, args.seed)
+        asyncio.run(run_mock_server(args.host, args.port, responder))
+        return
+
+    if args.cmd == "loadtest":
+        if args.base_url:
+            VISION_BACKEND, OPENAI_BASE_URL = "openai", args.base_url.rstrip("/")
+            OPENAI_API_KEY = OPENAI_API_KEY or "local"
+        else:
+            VISION_BACKEND = "mock"
+        STREAM_REPLIES = STREAM_REPLIES and not args.no_stream
+        asyncio.run(loadtest(args.users, args.photos, args.distinct, args.paid_ratio))
+        return
+
+    if args.cmd == "bulk":
+        if args.base_url:
+            OPENAI_BASE_URL = args.base_url.rstrip("/")
+            OPENAI_API_KEY = OPENAI_API_KEY or "local"
+        counts = asyncio.run(bulk_analyze(args.input, args.out, args.concurrency, args.workers))
+        sys.exit(1 if counts["error"] else 0)
+
+    if args.cmd == "bench-journal":
+        bench_journal(args.entries, args.users)
+        return
+
+    if args.cmd == "migrate-db":
+        n = migrate_json_to_sqlite(args.json, args.sqlite)
+        print(f"✅ Migrated {n} users from {args.json} to {args.sqlite}")
+        return
 
-if __name__ == "__main__":
     asyncio.run(main())
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,21 @@
+import pytest
+
+import bot
+
+
+@pytest.mark.parametrize("spelling, symbol", [
+    ("XAUUSD", "XAUUSD"),
+    ("xauusdm", "XAUUSD"),
+    ("XAUUSD.m", "XAUUSD"),
+    ("XAUUSD.pro", "XAUUSD"),
+    ("EURUSD-ECN", "EURUSD"),
+    ("GBPUSD.raw", "GBPUSD"),
+    ("BTCUSD.micro", "BTCUSD"),
+    ("GOLD", "XAUUSD"),
+    ("EURUSDXYZ", ""),
+    ("FOO", ""),
+    ("", ""),
+    (None, ""),
+])
+def test_instrument_symbol(spelling, symbol):
+    assert bot.instrument_symbol(spelling) == symbol
@@ -0,0 +1,55 @@
+import warnings
+
+import numpy as np
+
+import bot
+
+T0 = 1704189600.0  # 2024-01-02 10:00:00 UTC
+
+
+def _ts(values):
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        return bot._ts_array(values).tolist()
+
+
+def test_epoch_seconds_and_millis():
+    assert _ts([T0, T0 * 1000]) == [T0, T0]
+
+
+def test_iso_fractional_seconds():
+    assert _ts(["2024-01-02T10:00:00.500", "2024-01-02 10:00:00"]) == [T0 + 0.5, T0]
+
+
+def test_mt5_dates():
+    assert _ts(["2024.01.02 10:00", "2024.01.02 10:00:30.250"]) == [T0, T0 + 30.25]
+
+
+def test_mixed_mt5_and_iso():
+    assert _ts(["2024.01.02 10:00", "2024-01-02T10:00:00.5"]) == [T0, T0 + 0.5]
+
+
+def test_timezone_offsets():
+    assert _ts(["2024-01-02T10:00:00Z", "2024-01-02T11:00:00+01:00", "2024-01-02T05:00:00-05:00"]) == [T0, T0, T0]
+
+
+def test_datetime64():
+    assert _ts(np.array(["2024-01-02T10:00:00"], dtype="datetime64[s]")) == [T0]
+
+
+def test_load_ohlcv_mt5_export(tmp_path):
+    path = tmp_path / "XAUUSD_M1.csv"
+    path.write_text("<DATE>\t<TIME>\t<OPEN>\t<HIGH>\t<LOW>\t<CLOSE>\n"
+                    "2024.01.02\t10:01:00\t1\t3\t0.5\t2\n"
+                    "2024.01.02\t10:00:00\t1\t2\t0.5\t1\n")
+    t, high, low = bot.load_ohlcv(str(path))
+    assert t.tolist() == [T0, T0 + 60]  # sorted by time
+    assert high.tolist() == [2.0, 3.0] and low.tolist() == [0.5, 0.5]
+
+
+def test_load_ohlcv_iso_fractional(tmp_path):
+    path = tmp_path / "EURUSD.csv"
+    path.write_text("timestamp,open,high,low,close\n"
+                    "2024-01-02T10:00:00.500,1.1,1.2,1.0,1.1\n")
+    t, high, low = bot.load_ohlcv(str(path))
+    assert t.tolist() == [T0 + 0.5] and high.tolist() == [1.2]
@@ -0,0 +1,32 @@
+import asyncio
+import time
+
+import bot
+
+
+def test_unsendable_claims_go_back_to_the_outbox(tmp_path):
+    async def run():
+        sender = bot.OutboundSender(bot.Outbox(str(tmp_path / "outbox.sqlite3")))
+        await sender.notify(-100, "first")
+        await sender.notify(-100, "second")  # same group chat: its bucket allows one now
+        now = time.monotonic()
+        item, _ = await sender._pick(now)
+        assert item["text"] == "first"
+        sender._chat_bucket(-100).take()
+        item, wait = await sender._pick(now)
+        assert item is None and wait > 0
+        assert not sender._ready  # not held in memory past its lease
+        assert sender.outbox.claim(32) == []  # deferred in the outbox until the bucket allows it
+        assert sender.outbox.pending() == 2
+        sender.outbox.close()
+
+    asyncio.run(run())
+
+
+def test_broadcast_cursor_stops_before_the_oldest_unsent():
+    job = {"ids": [10, 20, 30, 40], "pos": 4, "open": {1, 3}, "cursor": None}
+    assert bot.OutboundSender._job_cursor(job) == 10
+    job["open"] = set()
+    assert bot.OutboundSender._job_cursor(job) == 40
+    job.update(pos=2, open={0, 1}, cursor=5)
+    assert bot.OutboundSender._job_cursor(job) == 5  # nothing settled since the saved cursor
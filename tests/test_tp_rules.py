@@ -0,0 +1,58 @@
+import math
+import random
+
+import bot
+
+
+def _signal(symbol="XAUUSD", signal="BUY", conf=75, entry="2345.10 - 2346.20", sl="2340"):
+    return {"symbol": symbol, "timeframe": "H1", "signal": signal, "confidence": conf, "entry_zone": entry, "sl": sl}
+
+
+def test_scalar_path_matches_vectorized():
+    rng = random.Random(1)
+    symbols = list(bot.INSTRUMENTS) + ["FOO", "XAUUSDm", ""]
+    for _ in range(2000):
+        row = (rng.choice(symbols), rng.choice(list(bot.TIMEFRAMES) + [""]), rng.random() < 0.5,
+               rng.randint(0, 100), rng.uniform(0.5, 70000), rng.randint(0, 5),
+               rng.choice([float("nan"), rng.uniform(1, 1000)]))
+        tps, sl, digits = bot.tp_sl_one(*row)
+        vtps, vsl, vdigits = bot.compute_tp_sl(*([v] for v in row))
+        assert list(tps) == vtps[0].tolist()
+        assert digits == int(vdigits[0])
+        assert (math.isnan(sl) and math.isnan(vsl[0])) or sl == vsl[0]
+
+
+def test_buy_targets_above_sell_below():
+    buy = bot.enforce_tp_rules(_signal(signal="BUY"))
+    sell = bot.enforce_tp_rules(_signal(signal="SELL"))
+    b = [float(buy[k]) for k in ("tp1", "tp2", "tp3")]
+    s = [float(sell[k]) for k in ("tp1", "tp2", "tp3")]
+    assert b == sorted(b) and b[0] > 2345.1
+    assert s == sorted(s, reverse=True) and s[0] < 2346.2
+
+
+def test_strong_confidence_widens_targets():
+    weak = bot.enforce_tp_rules(_signal(conf=bot.CONF_STRONG - 1))
+    strong = bot.enforce_tp_rules(_signal(conf=bot.CONF_STRONG))
+    assert weak["tp1"] == strong["tp1"]
+    assert float(strong["tp3"]) >= float(weak["tp3"])
+
+
+def test_result_not_mutated():
+    result = _signal()
+    before = dict(result)
+    out = bot.enforce_tp_rules(result)
+    assert result == before and out is not result
+
+
+def test_no_entry_passes_through():
+    result = _signal(entry="")
+    assert bot.enforce_tp_rules(result) is result
+
+
+def test_recompute_matches_live_path():
+    results = [_signal(), _signal(symbol="EURUSD", signal="SELL", entry="1.0850", sl=""), _signal(symbol="FOO")]
+    records = [{"ok": True, "result": r} for r in results]
+    for rec, r in zip(bot.recompute_tp(records), results):
+        live = bot.enforce_tp_rules(r)
+        assert {k: rec["result"][k] for k in ("tp1", "tp2", "tp3", "sl")} == {k: live[k] for k in ("tp1", "tp2", "tp3", "sl")}
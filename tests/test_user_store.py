@@ -0,0 +1,91 @@
+import os
+
+import pytest
+
+import bot
+
+
+def _json_store(tmp_path):
+    return bot.JsonUserStore(str(tmp_path / "db.json"))
+
+
+def test_journal_replays_on_reopen(tmp_path):
+    store = _json_store(tmp_path)
+    store.insert(42, bot._default_user())
+    store.update(42, plan="PAID")
+    assert store.incr(42, "trial_used", 1, limit=3) == 1
+    store.close()
+    assert not os.path.exists(tmp_path / "db.json")  # nothing compacted yet: journal only
+
+    store = _json_store(tmp_path)
+    u = store.get(42)
+    assert u["plan"] == "PAID" and u["trial_used"] == 1
+    store.close()
+
+
+def test_compact_then_more_entries(tmp_path):
+    store = _json_store(tmp_path)
+    store.insert(1, bot._default_user())
+    store.update(1, lang="ar")
+    store.compact()
+    assert not os.path.exists(store.journal_path)
+    store.update(1, plan="PAID")
+    store.close()
+
+    store = _json_store(tmp_path)
+    assert store.get(1)["lang"] == "ar" and store.get(1)["plan"] == "PAID"
+    store.close()
+
+
+def test_json_store_is_single_process(tmp_path):
+    store = _json_store(tmp_path)
+    try:
+        with pytest.raises(RuntimeError):
+            _json_store(tmp_path)  # a second owner (flock per open file, so same process counts)
+    finally:
+        store.close()
+    _json_store(tmp_path).close()  # released on close
+
+
+def test_incr_limit_and_floor(tmp_path):
+    store = bot.SqliteUserStore(str(tmp_path / "db.sqlite3"))
+    store.insert(7, bot._default_user())
+    assert store.incr(7, "trial_used", 1, limit=2) == 1
+    assert store.incr(7, "trial_used", 1, limit=2) == 2
+    assert store.incr(7, "trial_used", 1, limit=2) is None
+    assert store.incr(7, "trial_used", -5) == 0
+    store.close()
+
+
+def test_migration_includes_journal(tmp_path):
+    json_path, sqlite_path = str(tmp_path / "db.json"), str(tmp_path / "db.sqlite3")
+    store = bot.JsonUserStore(json_path)
+    store.insert(42, bot._default_user())
+    store.update(42, plan="PAID")
+    store.close()
+
+    assert bot.migrate_json_to_sqlite(json_path, sqlite_path) == 1
+    assert bot._json_store_files(json_path) == []
+    assert os.path.exists(json_path + ".journal.migrated")
+    assert bot.migrate_json_to_sqlite(json_path, sqlite_path) == 0  # already migrated
+
+    db = bot.SqliteUserStore(sqlite_path)
+    assert db.get(42)["plan"] == "PAID"
+    db.close()
+
+
+def test_migration_keeps_existing_rows(tmp_path):
+    json_path, sqlite_path = str(tmp_path / "db.json"), str(tmp_path / "db.sqlite3")
+    db = bot.SqliteUserStore(sqlite_path)
+    db.insert(1, dict(bot._default_user(), plan="PAID"))
+    db.close()
+    store = bot.JsonUserStore(json_path)
+    store.insert(1, bot._default_user())
+    store.insert(2, bot._default_user())
+    store.close()
+
+    bot.migrate_json_to_sqlite(json_path, sqlite_path)
+    db = bot.SqliteUserStore(sqlite_path)
+    assert db.get(1)["plan"] == "PAID"  # INSERT OR IGNORE: the SQLite row wins
+    assert db.get(2) is not None
+    db.close()